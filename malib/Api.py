@@ -7,24 +7,312 @@ import struct
 import threading
 import Queue
 import time
+import select
 import traceback
+import codeStore
+import metrics
+import random
+import math
+import uuid
+import config
+from collections import OrderedDict
 
 HOST_AGENT      = 0
 BROADCAST_EVENT = 1
+# (HOST_AGENT_REF, code hash, briefcase) for code the peer already has
+HOST_AGENT_REF  = 2
+# (CODE_FETCH, code hash) sent back by a peer missing the referenced code
+CODE_FETCH      = 3
+# (CODE_PUT, code hash, code) the answer to CODE_FETCH
+CODE_PUT        = 4
+# (MULTI_MESSAGE, [messages]) a burst of messages to one peer in one frame
+MULTI_MESSAGE   = 5
+# (RELAY_EVENT, message id, event, args, route) an event the receiver
+# delivers to its agents and passes on as route says, see multicast
+RELAY_EVENT     = 6
+# seconds between idle checks of a peer link and the idle time after which
+# a link is pinged (and a sender without a link retired)
 POOL_CHECK_CONN_INTERVAL = 60
 POOL_CONN_IDLE_TIME = 60
+# a peer that sent CODE_FETCH asks again if CODE_PUT is this many seconds
+# overdue, after CODE_FETCH_TRIES it drops the agents waiting for the code
+CODE_FETCH_TIMEOUT = 5
+CODE_FETCH_TRIES = 3
+# after sending a HOST_AGENT_REF the pool watches for CODE_FETCH replies
+# closely for this many seconds, as long as the peer may keep asking
+POOL_REPLY_WATCH_TIME = CODE_FETCH_TIMEOUT * CODE_FETCH_TRIES + 1
+POOL_REPLY_POLL_INTERVAL = 0.05
+# seconds shutdown waits for the peer senders to flush their queues
+POOL_SHUTDOWN_WAIT = 5
 
 Logger = logging.getLogger('malib')
 
+class _PeerSender( threading.Thread ):
+    """ Owns the link to one peer, messages for it are queued on q. A
+        connect or handshake that fails puts the peer in backoff, doubling
+        from config.PoolBackoffBase up to config.PoolBackoffMax seconds,
+        messages that arrive for it meanwhile are dropped right away.
+    """
+
+    def __init__(self, pool, addr):
+        threading.Thread.__init__(self, name="malib-peer-%s:%s" % addr)
+        self.daemon = True
+        self.pool = pool
+        self.addr = addr
+        self.q = Queue.Queue()
+        self.s = None
+        self.slink = None
+        # hashes of the code sent in full over the open connection
+        self.known_code = set()
+        self.lastUsedTime = time.time()
+        self.watch_replies_until = 0
+        self.failures = 0
+        self.retry_at = 0
+        self.sent = 0
+        self.dropped = 0
+        peer = "%s:%s" % addr
+        metrics.Registry.gauge( "malib_pool_queue_depth",
+            "messages queued for a peer", fn=self.q.qsize, peer=peer )
+        self.send_time = metrics.Registry.histogram( "malib_pool_send_seconds",
+            "time to connect if needed, encrypt and write a frame to a peer",
+            peer=peer )
+
+    def run(self):
+        try:
+            self._run()
+        except:
+            Logger.error( traceback.format_exc() )
+        self._drop()
+
+    def unregister(self):
+        "forget the metrics of this sender, it is going away"
+        peer = "%s:%s" % self.addr
+        metrics.Registry.remove( "malib_pool_queue_depth", peer=peer )
+        metrics.Registry.remove( "malib_pool_send_seconds", peer=peer )
+
+    def stats(self):
+        stats = {
+            'queued': self.q.qsize(),
+            'connected': self.s is not None,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failures': self.failures,
+            'backoff': max(0, self.retry_at - time.time())
+        }
+        if self.slink:
+            stats['link'] = self.slink.stats()
+        return stats
+
+    def _run(self):
+        while True:
+            self._service_replies()
+            timeout = POOL_CHECK_CONN_INTERVAL
+            if time.time() < self.watch_replies_until:
+                timeout = POOL_REPLY_POLL_INTERVAL
+            try:
+                msg = self.q.get( timeout=timeout )
+            except Queue.Empty:
+                if self._idle():
+                    break
+                continue
+            if msg is None:
+                break
+            (msgs, stop) = self._coalesce( msg )
+            self._deliver( msgs )
+            if stop:
+                break
+
+    def _coalesce(self, msg):
+        """ collect what else is queued within the window, returns
+            ([messages], shutdown requested) """
+        msgs = [msg]
+        deadline = time.time() + config.PoolCoalesceWindow
+        while len(msgs) < config.PoolCoalesceMax:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    msg = self.q.get( timeout=timeout )
+                else:
+                    msg = self.q.get_nowait()
+            except Queue.Empty:
+                break
+            if msg is None:
+                return (msgs, True)
+            msgs.append( msg )
+        return (msgs, False)
+
+    def _deliver(self, msgs):
+        """ send msgs, a message that cannot be sent (unmarshallable args,
+            say) is dropped on its own and the sender carries on """
+        try:
+            self._send( msgs )
+        except Exception:
+            # raised encoding the frame, before anything was written
+            if len(msgs) > 1:
+                for msg in msgs:
+                    self._deliver( [msg] )
+                return
+            Logger.error("dropped message for peer %s: %s" % (str(self.addr), traceback.format_exc()))
+            self.dropped += 1
+
+    def _connect(self):
+        if time.time() < self.retry_at:
+            return False
+        # bound the connects and handshakes in flight across all peers
+        with self.pool.connecting:
+            try:
+                link = self._open()
+            except p2pp.LegacyPeer:
+                # remembered now, the second link speaks its handshake
+                Logger.info("peer %s is a legacy node, connecting again" % str(self.addr))
+                link = self._open()
+        if not link:
+            return False
+        (self.s, self.slink) = link
+        self.known_code = set()
+        self.failures = 0
+        return True
+
+    def _open(self):
+        "connect and run the handshake, returns (socket, link) or False"
+        s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        l_onoff = 1
+        l_linger = 10
+        s.setsockopt( socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', l_onoff, l_linger))
+        s.settimeout( config.PoolConnectTimeout )
+        try:
+            s.connect( self.addr )
+        except socket.error:
+            Logger.warning("Connect failed for peer %s" % str(self.addr))
+            return self._failed( s )
+        s.settimeout(15) 
+        slink = p2pp.SecureLink( "%s:%s" % self.addr )
+        try:
+            slink.setup( s, initiator=True, peer=self.addr )
+        except p2pp.LegacyPeer:
+            s.close()
+            raise
+        except Exception:
+            # a socket error or a reply that is not a handshake
+            Logger.warning("Handshake failed for peer %s" % str(self.addr))
+            return self._failed( s )
+        return (s, slink)
+
+    def _failed(self, s):
+        s.close()
+        self.failures += 1
+        backoff = config.PoolBackoffBase * 2 ** (self.failures - 1)
+        self.retry_at = time.time() + min(backoff, config.PoolBackoffMax)
+        return False
+
+    def _send( self, msgs ):
+        started = time.time()
+        if self.s is None and not self._connect():
+            self.dropped += len(msgs)
+            pub.sendMessage("peer-connect-failed", addr=self.addr )
+            return
+
+        msgs = [self._code_ref( m ) if m[0] == HOST_AGENT else m
+                for m in msgs]
+        if len(msgs) == 1:
+            msg = msgs[0]
+        else:
+            msg = (MULTI_MESSAGE, msgs)
+
+        try:
+            self.slink.send( self.s, msg )
+            self.sent += len(msgs)
+            self.send_time.observe( time.time() - started )
+        except socket.error:
+            Logger.warning("send failed for peer %s" % str(self.addr))
+            pub.sendMessage("peer-send-failed", addr=self.addr )
+            self.dropped += len(msgs)
+            self._drop()
+            return
+
+        self.lastUsedTime = time.time()
+
+    def _code_ref(self, msg):
+        "replace code the peer was already sent with its hash"
+        (_p1, code, briefcase) = msg
+        codeHash = codeStore.Store.put( code )
+        if codeHash in self.known_code:
+            self.watch_replies_until = time.time() + POOL_REPLY_WATCH_TIME
+            return (HOST_AGENT_REF, codeHash, briefcase)
+        self.known_code.add( codeHash )
+        return msg
+
+    def _service_replies(self):
+        "answer CODE_FETCH requests the peer sent back over the link"
+        if self.s is None:
+            return
+        ready, _p1, _p2 = select.select( [self.s], [], [], 0 )
+        if not ready:
+            return
+        try:
+            msg = self.slink.recv( self.s )
+            if msg[0] != CODE_FETCH:
+                Logger.error("unexpected reply %s from %s" % (str(msg[0]),str(self.addr)))
+                return
+            code = codeStore.Store.get( msg[1] )
+            if code is None:
+                Logger.error("peer %s asked for code %s we no longer have" % (str(self.addr),msg[1]))
+                # the next agent with it goes out in full
+                self.known_code.discard( msg[1] )
+                return
+            self.slink.send( self.s, (CODE_PUT, msg[1], code) )
+        except socket.error:
+            Logger.warning("link to peer %s closed" % str(self.addr))
+            self._drop()
+
+    def _idle(self):
+        """ ping an idle link to find out whether it is still up, returns
+            True when this sender has retired """
+        idle = time.time() - self.lastUsedTime
+        if idle <= POOL_CONN_IDLE_TIME:
+            return False
+        if self.s is not None:
+            try:
+                msg = (BROADCAST_EVENT,"ping",(),)                 
+                self.slink.send( self.s, msg )
+                return False
+            except socket.error:
+                Logger.warning("test failed for peer %s" % str(self.addr))
+                pub.sendMessage("peer-send-failed", addr=self.addr )
+                self._drop()
+        return self.pool._retire( self )
+
+    def _drop(self):
+        if self.s is None:
+            return
+        try: 
+            self.s.shutdown( socket.SHUT_RDWR )     
+        except:
+            pass
+        self.s.close()
+        self.s = None
+        self.slink = None
+
+
 class _ConnectionPool( threading.Thread ):
-    
+    """ Routes outbound messages to one _PeerSender thread per destination,
+        so an unreachable peer or a slow handshake only holds up the
+        messages for that peer. At most config.PoolMaxConnecting connects
+        and handshakes run at the same time. Messages queued for the same
+        peer within config.PoolCoalesceWindow are sent as one MULTI_MESSAGE
+        frame, so a burst costs one encryption and one write.
+    """
 
     def __init__(self):
         threading.Thread.__init__(self)
 
+        # addr -> _PeerSender
         self.pool = {}
+        self.lock = threading.Lock()
+        self.connecting = threading.BoundedSemaphore( config.PoolMaxConnecting )
         self.msgq = Queue.Queue()
-        self.next_conn_check = time.time() + POOL_CHECK_CONN_INTERVAL
+        metrics.Registry.gauge( "malib_pool_routing_queue_depth",
+            "messages waiting to be routed to a peer sender", fn=self.msgq.qsize )
 
     def shutdown(self):
         #    Sentinel value that is interpreted as a shutdown message.
@@ -32,6 +320,12 @@ class _ConnectionPool( threading.Thread ):
 
     def send(self, addr, msg):
         self.msgq.put( (addr,msg) )
+
+    def peerStats(self):
+        "addr -> queue depth, delivery and backoff counters of its sender"
+        with self.lock:
+            senders = self.pool.items()
+        return dict( (addr, sender.stats()) for (addr, sender) in senders )
         
     def run(self):
         Logger.info("Connection Pool thread started")
@@ -48,70 +342,43 @@ class _ConnectionPool( threading.Thread ):
     def _run(self):
         
         while True:
-                       
-            now = time.time() 
-            if now > self.next_conn_check:
-                Logger.info("checking open connections") 
-                self._check_connections( now )          
-                self.next_conn_check = now + POOL_CHECK_CONN_INTERVAL  
-
-            try:
-                (addr,msg) = self.msgq.get( timeout=2 )
-            except Queue.Empty:
-                Logger.info("empty queue") 
-                continue
+            (addr,msg) = self.msgq.get()
             Logger.info("msgq.get -> (%s,%s)" % (str(addr),str(msg)))
 
             # shutdown event  
             if addr == None and msg == None:
                 break
-            self._send( addr, msg )
-        
+            self._route( addr, msg )
          
-        for (s,lastUsedTime,slink) in self.pool.values():    
-            s.shutdown( socket.SHUT_RDWR )
-
-    def _send( self, addr, msg ):
-        if addr in self.pool:
-            (s,lastUsedTime,slink) = self.pool[addr]
-        else: 
-            s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-            l_onoff = 1
-            l_linger = 10
-            s.setsockopt( socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', l_onoff, l_linger))
-            try:
-                s.connect( addr )
-            except socket.error:
-                Logger.warning("Connect failed for peer %s" % str(addr))
-                pub.sendMessage("peer-connect-failed", addr=addr )
-                return 
-            s.settimeout(15) 
-            slink = p2pp.SecureLink()
-            slink.setup( s )
+        with self.lock:
+            senders = self.pool.values()
+            self.pool = {}
+        for sender in senders:
+            sender.q.put( None )
+        # senders stuck connecting are daemons and are not waited for long
+        deadline = time.time() + POOL_SHUTDOWN_WAIT
+        for sender in senders:
+            sender.join( max(0, deadline - time.time()) )
+            sender.unregister()
 
-        try:
-            slink.send( s, msg )
-        except socket.error:
-            Logger.warning("send failed for peer %s" % str(addr))
-            pub.sendMessage("peer-send-failed", addr=addr )
-
-        self.pool[addr]=(s,time.time(),slink)
-
-    def _check_connections(self, now):
-        for (addr, (s,lastTimeUsed,slink)) in self.pool.items():
-             idle = now - lastTimeUsed
-             if idle > POOL_CONN_IDLE_TIME:
-                 try:
-                     msg = (BROADCAST_EVENT,"ping",(),)                 
-                     slink.send( s, msg )
-                 except socket.error:
-                     Logger.warning("test failed for peer %s" % str(addr))
-                     pub.sendMessage("peer-send-failed", addr=addr )
-                     try: 
-                         s.shutdown( socket.SHUT_RDWR )     
-                     except:
-                         pass
-                     del self.pool[addr]  
+    def _route(self, addr, msg):
+        with self.lock:
+            sender = self.pool.get( addr )
+            if sender is None:
+                sender = _PeerSender( self, addr )
+                self.pool[addr] = sender
+                sender.start()
+            sender.q.put( msg )
+
+    def _retire(self, sender):
+        "remove an idle sender unless a message was routed to it meanwhile"
+        with self.lock:
+            if not sender.q.empty() or self.pool.get( sender.addr ) is not sender:
+                return False
+            del self.pool[sender.addr]
+            # under the lock, a new sender for the peer registers the same
+            sender.unregister()
+            return True
 
 
 # Connection pool thread for manging open connections to peers.
@@ -125,6 +392,193 @@ def sendBroadcast( addr, event, *args):
     msg = (BROADCAST_EVENT,event,args,)
     ConnectionPool.send( addr, msg )  
 
+def sendRelay( msgid, event, args, route, local=None ):
+    """ pass an event on along route, ('tree', addrs) has the receiver
+        relay to the addresses of its subtree, ('gossip', members, ttl) to
+        config.MulticastFanout random members while ttl lasts. local is the
+        address the event arrived at, see isOwnAddress """
+    global  ConnectionPool
+
+    for (addr, next_route) in relayRoutes( route, local ):
+        msg = (RELAY_EVENT,msgid,event,args,next_route,)
+        ConnectionPool.send( addr, msg )
+
+def relayRoutes( route, local=None ):
+    "the (addr, route for addr) pairs the holder of route sends to"
+    fanout = max(1, config.MulticastFanout)
+    if route[0] == 'tree':
+        addrs = [tuple(a) for a in route[1] if not isOwnAddress( a, local )]
+        # split into fanout subtrees, the head of each relays to the rest
+        size = int( math.ceil( len(addrs) / float(fanout) ) )
+        return [(addrs[i], ('tree', addrs[i+1:i+size]))
+                for i in range(0, len(addrs), max(1, size))]
+    (_p1, members, ttl) = route
+    if ttl <= 0:
+        return []
+    members = [tuple(m) for m in members if not isOwnAddress( m, local )]
+    targets = random.sample( members, min(fanout, len(members)) )
+    return [(addr, ('gossip', route[1], ttl - 1)) for addr in targets]
+
+_resolved = {}
+_own_hosts = None
+
+def _resolve( host ):
+    "the ip address of host, looked up once"
+    ip = _resolved.get( host )
+    if ip is None:
+        try:
+            ip = socket.gethostbyname( host )
+        except socket.error:
+            ip = host
+        _resolved[host] = ip
+    return ip
+
+def isOwnAddress( addr, local=None ):
+    """ whether addr is this node: its port is config.BindPort and its host
+        is local (the address a link to this node arrived at), config.BindHost
+        or, when that is "" and this node listens on every interface, a
+        loopback or other address of this host """
+    global _own_hosts
+
+    (host, port) = addr
+    if port != config.BindPort:
+        return False
+    ip = _resolve( host )
+    if local and ip == _resolve( local[0] ):
+        return True
+    if config.BindHost not in ("", "0.0.0.0"):
+        return ip == _resolve( config.BindHost )
+    if _own_hosts is None:
+        try:
+            _own_hosts = set( socket.gethostbyname_ex( socket.gethostname() )[2] )
+        except socket.error:
+            _own_hosts = set()
+    return ip.startswith( "127." ) or ip == "0.0.0.0" or ip in _own_hosts
+
+def gossipRounds( n ):
+    "relay hops for gossip to reach n peers with a few rounds to spare"
+    fanout = max(2, config.MulticastFanout)
+    return int( math.ceil( math.log( max(n, 2), fanout ) ) ) + 2
+
+
+class _SeenIds:
+    """ Ids of the relayed events this node has already delivered, bounded
+        to config.MulticastSeenSize entries (oldest go first). """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, msgid):
+        "True if msgid was seen before, remembers it otherwise"
+        with self.lock:
+            if msgid in self.ids:
+                self.duplicates += 1
+                return True
+            self.ids[msgid] = True
+            while len(self.ids) > config.MulticastSeenSize:
+                self.ids.popitem( last=False )
+            return False
+
+# relayed events already delivered on this node
+SeenIds = _SeenIds()
+
+def cacheable( ttl ):
+    """ Decorator marking a MalibApiBase method as safe to memoize. The
+        agent controller answers a call with the same arguments within
+        ttl seconds from ResultCache without invoking the method again.
+
+            class MyApi( Api.MalibApiBase ):
+                @Api.cacheable( 5 )
+                def hostname(self):
+                    ...
+    """
+    def mark( func ):
+        func.cache_ttl = ttl
+        return func
+    return mark
+
+
+def concurrent( func ):
+    """ Decorator marking a MalibApiBase method as safe to run on several
+        api worker threads at once (see config.ApiWorkers), other methods
+        are run one at a time. """
+    func.concurrent = True
+    return func
+
+
+class _ResultCache:
+    """ Results of cacheable api methods keyed by (method, args), bounded
+        to config.ApiCacheSize entries of which the least recently used go
+        first. Results are kept by reference, a method must not modify an
+        object it returned. Calls with unhashable arguments are not cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, args) -> (expiry time, result)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.hit_count = metrics.Registry.counter( "malib_api_cache_hits_total",
+            "api calls answered from the result cache" )
+        self.miss_count = metrics.Registry.counter( "malib_api_cache_misses_total",
+            "cacheable api calls that invoked the method" )
+
+    def get(self, key):
+        "(True, result) for a live entry, (False, None) otherwise"
+        with self.lock:
+            entry = self.entries.pop( key, None )
+            if entry is not None and entry[0] < time.time():
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self.miss_count.inc()
+                return (False, None)
+            self.entries[key] = entry
+            self.hits += 1
+        self.hit_count.inc()
+        return (True, entry[1])
+
+    def put(self, key, result, ttl):
+        with self.lock:
+            self.entries.pop( key, None )
+            self.entries[key] = (time.time() + ttl, result)
+            while len(self.entries) > config.ApiCacheSize:
+                self.entries.popitem( last=False )
+                self.evictions += 1
+
+    def invalidate(self, meth=None, *args):
+        """ drop the result of meth(*args), of every call of meth without
+            args or everything without meth """
+        with self.lock:
+            if meth is None:
+                self.entries.clear()
+            elif args:
+                self.entries.pop( (meth, args), None )
+            else:
+                for key in [k for k in self.entries if k[0] == meth]:
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+# results of the cacheable api methods called in this process
+ResultCache = _ResultCache()
+
 def sendAgent( addr, code, briefcase ):
     global  ConnectionPool
 
@@ -152,13 +606,97 @@ class MalibApiBase:
         pub.sendMessage("localBroadcast", event=event, args=args )
 
     def multicast(self, addrList, event, *args ):
+        """ config.MulticastMode "direct" sends the event to every address,
+            "tree" sends to config.MulticastFanout peers that relay it down
+            a spanning tree of addrList and "gossip" to as many random
+            peers that each do the same for a few rounds. The relay modes
+            cost the origin O(fanout) sends, receivers drop copies of an
+            event they have already seen. This node's own address in
+            addrList is skipped, its agents get the event locally.
+        """
         # send message to agents hosted locally
         pub.sendMessage("localBroadcast", event=event, args=args )
         # send to a list of remote hosts.
-        for addr in addrList:
-            thread.start_new_thread( sendBroadcast, (addr, event, args,) )  
+        addrList = [tuple(addr) for addr in addrList if not isOwnAddress( addr )]
+        if config.MulticastMode == "direct":
+            for addr in addrList:
+                sendBroadcast( addr, event, *args )
+            return
+        msgid = uuid.uuid4().hex
+        SeenIds.seen( msgid )
+        if config.MulticastMode == "gossip":
+            route = ('gossip', addrList, gossipRounds( len(addrList) ))
+        else:
+            route = ('tree', addrList)
+        sendRelay( msgid, event, args, route )
 
     def sendAgent(self, code, briefcase ):
         thread.start_new_thread( sendAgent, (code, briefcase,) )
 
 
+
+
+def unittest():
+    saved = (config.BindHost, config.BindPort, config.MulticastFanout)
+    try:
+        config.BindHost = ""
+        config.MulticastFanout = 2
+        own = ('127.0.0.1', config.BindPort)
+        assert isOwnAddress( ('localhost', config.BindPort) )
+        assert not isOwnAddress( ('127.0.0.1', config.BindPort + 1) )
+        assert isOwnAddress( ('10.255.0.1', config.BindPort), ('10.255.0.1', config.BindPort) )
+
+        # every peer of a tree is reached once, wherever this node is in it
+        addrs = [('10.255.0.%d' % i, config.BindPort) for i in range(1, 8)]
+        for pos in range(len(addrs) + 1):
+            reached = []
+            routes = [('tree', addrs[:pos] + [own] + addrs[pos:])]
+            while routes:
+                for (addr, route) in relayRoutes( routes.pop() ):
+                    reached.append( addr )
+                    routes.append( route )
+            assert sorted(reached) == addrs, "tree with own address at %d" % pos
+
+        for i in range(20):
+            for (addr, route) in relayRoutes( ('gossip', addrs + [own], 3) ):
+                assert addr != own and route == ('gossip', addrs + [own], 2)
+        assert relayRoutes( ('gossip', addrs, 0) ) == []
+    finally:
+        (config.BindHost, config.BindPort, config.MulticastFanout) = saved
+
+    # a message that can't be sent doesn't take the peer sender down
+    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    s.bind( ('127.0.0.1', 0) )
+    s.listen( 1 )
+    received = []
+    def serve():
+        conn, _addr = s.accept()
+        link = p2pp.SecureLink()
+        link.setup( conn )
+        try:
+            while True:
+                received.append( link.recv( conn ) )
+        except socket.error:
+            pass
+    t = threading.Thread( target=serve )
+    t.daemon = True
+    t.start()
+    sender = _PeerSender( _ConnectionPool(), s.getsockname() )
+    sender._deliver( [(BROADCAST_EVENT, "bad", (object(),)), (BROADCAST_EVENT, "ok", (1,))] )
+    sender._deliver( [(BROADCAST_EVENT, "ok", (2,))] )
+    deadline = time.time() + 10
+    while len(received) < 2 and time.time() < deadline:
+        time.sleep( 0.05 )
+    assert [m[1:] for m in received] == [("ok", (1,)), ("ok", (2,))], str(received)
+    assert sender.dropped == 1 and sender.sent == 2
+
+    peer = "%s:%s" % sender.addr
+    sender.unregister()
+    for name in ("malib_pool_queue_depth", "malib_pool_send_seconds"):
+        assert metrics.Registry.metrics[name].get( (('peer', peer),) ) is None, name
+    sender._drop()
+    s.close()
+    print "Api unittest passed"
+
+if __name__ == '__main__':
+    unittest()
@@ -1,18 +1,367 @@
 import sandbox
+import codeStore
+import framing
+import wireCodec
+import quota
+import metrics
+import Api
+import config
 import socket
 import threading
 import Queue
 import select
+import struct
+import marshal
 import sys
+import time
+import uuid
+import errno
+import os
+import tempfile
 import logging
+from collections import deque
 
 Logger = logging.getLogger("malib")
 
+# upper bound on the attach message a new sandbox connection presents
+MAX_TOKEN_MSG = 256
+# an agent with more unread event bytes than this is dropped
+MAX_EVENT_BACKLOG = 64 * 1024 * 1024
+# an agent with more untaken rpc answer bytes than this is not read from
+# until it takes them
+MAX_RPC_BACKLOG = 64 * 1024 * 1024
+# seconds a woken agent has to subscribe to its topics again, events for
+# topics it has not subscribed to by then are dropped
+WAKE_TIMEOUT = 30
+# fraction of a cpu an agent may use between usage samples and still count
+# as idle, a busy agent is not hibernated
+IDLE_CPU = 0.01
+# seconds shutdown waits for the api worker threads to finish their calls
+WORKER_SHUTDOWN_WAIT = 5
+
+# agent attach states
+SPAWNED = 0    # process started, waiting for its rpc/evt connections
+IDLE    = 1    # connected, parked in the warm pool waiting for code
+RUNNING = 2    # init message sent, agent code is executing
+HIBERNATING = 3  # asked to hand over its briefcase, events are held back
+HIBERNATED  = 4  # state saved to disk, the process is killed
+
+
+# Poller readiness flags
+READ  = 1
+WRITE = 2
+
+
+def valid_calls( calls ):
+    "whether an rpc frame is a list of (request id, method, args) calls"
+    if type(calls) is not list:
+        return False
+    for call in calls:
+        if type(call) is not tuple or len(call) != 3:
+            return False
+        if type(call[1]) is not str or type(call[2]) not in (tuple, list):
+            return False
+    return True
+
+class Poller:
+    """ Readiness notification for the agent controller and the event loop
+        peer server. Uses epoll where available, then poll and finally
+        select which is all windows has. Hang ups and errors are reported
+        as READ so the following recv sees the disconnect.
+    """
+    def __init__(self):
+        self.rfds = set()
+        self.wfds = set()
+        # poll() takes milliseconds, epoll() seconds
+        self.scale = 1
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            self.bits = (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR,
+                         select.EPOLLOUT)
+        elif hasattr(select, 'poll'):
+            self.impl = select.poll()
+            self.bits = (select.POLLIN | select.POLLHUP | select.POLLERR,
+                         select.POLLOUT)
+            self.scale = 1000
+        else:
+            self.impl = None
+
+    def _mask(self, write, read=True):
+        mask = 0
+        if read:
+            mask |= self.bits[0]
+        if write:
+            mask |= self.bits[1]
+        return mask
+
+    def register(self, fd, write=False, read=True):
+        "watch fd, with read False only for write readiness and hang ups" 
+        if read:
+            self.rfds.add( fd )
+        if write:
+            self.wfds.add( fd )
+        if self.impl:
+            self.impl.register( fd, self._mask(write, read) )
+
+    def modify(self, fd, write):
+        "turn interest in write readiness on or off" 
+        if write:
+            self.wfds.add( fd )
+        else:
+            self.wfds.discard( fd )
+        if self.impl:
+            self.impl.modify( fd, self._mask(write) )
+
+    def unregister(self, fd):
+        self.rfds.discard( fd )
+        self.wfds.discard( fd )
+        if self.impl:
+            try:
+                self.impl.unregister( fd )
+            except (KeyError, IOError, OSError, ValueError):
+                pass
+
+    def poll(self, timeout):
+        "returns a list of (fd, READ|WRITE) for the ready descriptors" 
+        if self.impl is None:
+            r, w, _p1 = select.select(list(self.rfds),list(self.wfds),[],timeout)
+            ready = dict( (fd, READ) for fd in r )
+            for fd in w:
+                ready[fd] = ready.get(fd, 0) | WRITE
+            return ready.items()
+
+        ready = []
+        for (fd, ev) in self.impl.poll( timeout * self.scale ):
+            mask = 0
+            if ev & self.bits[0]:
+                mask |= READ
+            if ev & self.bits[1]:
+                mask |= WRITE
+            ready.append( (fd, mask) )
+        return ready
+
+    def close(self):
+        if hasattr(self.impl, 'close'):
+            self.impl.close()
+
+
+class Wakeup:
+    """ Wakes the agent controller's poll loop from other threads, through
+        a self-pipe (a loopback udp socket on windows, where select only
+        takes sockets). Notifications coalesce: after the first, notify()
+        writes nothing until the controller has called clear(), so a burst
+        of messages costs one write and one wakeup.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = False
+        self.closed = False
+        if os.name == 'nt':
+            self.r = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+            self.r.bind( ('127.0.0.1',0) )
+            self.r.setblocking(0)
+            self.w = None
+        else:
+            import fcntl
+            (self.r, self.w) = os.pipe()
+            for fd in (self.r, self.w):
+                flags = fcntl.fcntl( fd, fcntl.F_GETFL )
+                fcntl.fcntl( fd, fcntl.F_SETFL, flags | os.O_NONBLOCK )
+
+    def fileno(self):
+        if self.w is None:
+            return self.r.fileno()
+        return self.r
+
+    def notify(self):
+        if self.pending:
+            return
+        self.pending = True
+        with self.lock:
+            # the descriptor number may be reused once closed
+            if self.closed:
+                return
+            try:
+                if self.w is None:
+                    self.r.sendto( "x", self.r.getsockname() )
+                else:
+                    os.write( self.w, "x" )
+            except (OSError, socket.error):
+                # the pipe is full, a wakeup is already on its way
+                pass
+
+    def clear(self):
+        """ called by the controller before it drains its queue. The pipe is
+            emptied before pending is reset, a notify() in between finds
+            pending still set and its message is queued already """
+        try:
+            while True:
+                if self.w is None:
+                    self.r.recv( 4096 )
+                elif len( os.read( self.r, 4096 ) ) < 4096:
+                    break
+        except (OSError, socket.error):
+            # nothing left to read
+            pass
+        self.pending = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.w is None:
+                self.r.close()
+            else:
+                os.close( self.r )
+                os.close( self.w )
+
+
+class AgentRecord(object):
+    """ Book keeping for one sandbox process.
+
+        token is generated at spawn time and is presented by the child on
+        both of its connections, that is how the controller pairs the rpc
+        and event sockets of a sandbox. agentId is assigned when the
+        sandbox is handed the code of an arriving agent.
+    """
+    __slots__ = ('token', 'proc', 'rpc', 'evt', 'state', 'agentId',
+                 'code', 'briefcase', 'deadline', 'started', 'rpc_calls',
+                 'events_sent', 'topics', 'ring', 'evt_backlog',
+                 'backlog_bytes', 'reader', 'cgroup', 'usage', 'throttled',
+                 'source', 'last_active', 'held', 'held_bytes', 'hibernate_asked',
+                 'requested', 'profiling',
+                 'profile', 'frames', 'job', 'rpc_backlog', 'rpc_backlog_bytes')
+
+    def __init__(self, token, proc):
+        self.token = token
+        self.proc = proc
+        self.rpc = None
+        # read ahead buffer of the rpc socket
+        self.reader = framing.FrameReader()
+        self.evt = None
+        self.state = SPAWNED
+        self.agentId = None
+        self.code = None
+        self.briefcase = None
+        self.deadline = time.time() + config.SandboxAttachTimeout
+        self.started = None
+        self.rpc_calls = 0
+        self.events_sent = 0
+        self.topics = set()
+        self.ring = None
+        # event packets the event socket could not take yet
+        self.evt_backlog = []
+        self.backlog_bytes = 0
+        # cgroup of the sandbox (see quota), last usage sample
+        self.cgroup = None
+        self.usage = None
+        self.throttled = False
+        # agent code as received, kept to hibernate the agent
+        self.source = None
+        self.last_active = time.time()
+        # (event, encoded event) held back while HIBERNATING and when
+        # the agent was asked to hibernate
+        self.held = []
+        self.held_bytes = 0
+        self.hibernate_asked = None
+        # when the agent to run in this sandbox arrived
+        self.requested = None
+        # whether the agent is being profiled and its last profile report
+        self.profiling = False
+        self.profile = None
+        # rpc frames waiting to be answered and the one being answered,
+        # ([calls], [answers so far]), see AgentController._run_job
+        self.frames = deque()
+        self.job = None
+        # rpc answers the rpc socket could not take yet
+        self.rpc_backlog = []
+        self.rpc_backlog_bytes = 0
+
+    def stats(self):
+        return {
+            'agentId': self.agentId,
+            'pid': self.proc.pid,
+            'started': self.started,
+            'rpc_calls': self.rpc_calls,
+            'events_sent': self.events_sent,
+            'topics': list(self.topics),
+            'usage': self.usage,
+            'throttled': self.throttled
+        }
+
+
+class ApiWorkers:
+    """ Threads that run host api methods for the controller. Methods marked
+        Api.concurrent run on any of size threads at once, all others one at
+        a time on a thread of their own, as they did on the controller
+        thread. invoke( func, meth, args ) makes the call and done( tag,
+        result ) is called with its result on the worker thread.
+    """
+    def __init__(self, size, invoke, done):
+        self.invoke = invoke
+        self.done = done
+        self.concurrent = Queue.Queue()
+        self.serial = Queue.Queue()
+        self.threads = []
+        for (q, n) in ((self.serial, 1), (self.concurrent, size)):
+            for i in range(n):
+                t = threading.Thread( target=self._work, args=(q,),
+                    name="malib-api-%d" % len(self.threads) )
+                # a method stuck in io must not keep the process alive
+                t.daemon = True
+                t.start()
+                self.threads.append( t )
+
+    def submit(self, func, meth, args, tag):
+        if getattr( func, 'concurrent', False ):
+            self.concurrent.put( (func, meth, args, tag) )
+        else:
+            self.serial.put( (func, meth, args, tag) )
+
+    def shutdown(self):
+        "stop the threads, a call stuck in io is not waited for long"
+        self.serial.put( None )
+        for i in range(len(self.threads) - 1):
+            self.concurrent.put( None )
+        deadline = time.time() + WORKER_SHUTDOWN_WAIT
+        for t in self.threads:
+            t.join( max(0, deadline - time.time()) )
+
+    def _work(self, q):
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            (func, meth, args, tag) = job
+            self.done( tag, self.invoke( func, meth, args ) )
+
+
+class HibernatedAgent(object):
+    """ What stays in memory of an agent hibernated to disk: the events it
+        was subscribed to and those that arrived for it since. """
+    __slots__ = ('agentId', 'path', 'topics', 'queued', 'queued_bytes',
+                 'waking', 'wake_started')
+
+    def __init__(self, agentId, path, topics):
+        self.agentId = agentId
+        self.path = path
+        self.topics = set(topics)
+        # (event, encoded event) in arrival order
+        self.queued = []
+        self.queued_bytes = 0
+        self.waking = False
+        self.wake_started = None
+
+
 class AgentController( threading.Thread ):
     """ 
        Uses 3 loopback sockets for IPC (this is platform neutral since windows
        only allows a select on a socket and doesn't support poll())
 
+       With config.AgentIpc = "unix" the rpc and event listeners are not
+       opened, each sandbox is instead handed its own pre-connected unix
+       socketpairs and, if config.AgentShmSize is set, a shared memory ring
+       that carries events of config.AgentShmThreshold bytes or more.
+
        One socket is used for IPC calls from the agent using the API calls
        an instance of the user supplied API object. This is the sole API
        that the agent can use. The socket binds to a random port and N number
@@ -22,162 +371,1026 @@ class AgentController( threading.Thread ):
        agents. This forms a pub/sub model, again this is a server socket that
        services client connections from agents.
 
-       The third socket is used as an alert utility since we can't select on 
-       a message queue and a socket at the same time, I use a udp socket as
-       an alert to instruct the agent controller that there is a inbound message.
+       The third descriptor is used as an alert utility since we can't select
+       on a message queue and a socket at the same time, a Wakeup (a self-pipe)
+       tells the agent controller that there are inbound messages.
+
+       Readiness is taken from a Poller (epoll on linux) and every registered
+       file descriptor maps to a (handler, argument) pair in fdmap, so
+       dispatching a ready socket and tearing an agent down cost the same no
+       matter how many agents are hosted.
+
+       RPC frames carry a list of (request id, method, args) calls which are
+       all answered in a single frame, that lets agents batch and pipeline
+       calls (see sandbox.Batch). Answers are written without blocking, an
+       agent with more than MAX_RPC_BACKLOG bytes of answers backed up is
+       not read from until it has taken them.
+
+       Events are routed by name. Agents subscribe through ApiIface.register
+       and the controller keeps an event name -> subscribers index, each
+       event is marshalled once and only written to its subscribers.
+
+       Attaching a sandbox never blocks the controller. Every child is given
+       a token when it is spawned and presents it as the first message on
+       both of its connections, each AgentRecord moves from SPAWNED to IDLE
+       or RUNNING as its connections are accepted and paired while all other
+       agents keep being served.
+
+       To hide interpreter start up from arriving agents the controller keeps
+       a pool of up to config.SandboxPoolSize idle sandbox processes that are
+       already connected and waiting for their init message. The pool is
+       refilled at no more than config.SandboxPoolRefillRate spawns a second,
+       hits and misses are counted in poolStats().
+
+       Sandboxes are spawned with the resource limits of the quota module.
+       Every config.AgentUsageInterval seconds the cpu time and memory of
+       each agent is sampled (see usageStats) and an agent over its quota is
+       killed or throttled as config.AgentQuotaPolicy says.
+
+       With config.HibernateIdleTime set, an agent that has neither made a
+       rpc call, been sent an event nor used more than IDLE_CPU of a cpu for
+       that long is hibernated. It is
+       sent the HIBERNATE event, answers with its Briefcase and exits, its
+       code, briefcase and topics are written to config.HibernateDir. The
+       first event for one of its topics wakes it in a (warm) sandbox, the
+       agent code runs again with the saved Briefcase and the events that
+       arrived meanwhile are delivered as it subscribes to them again.
+
+       Agents are profiled from the start with config.AgentProfile or on
+       request with profileAgent(), their sandbox times every function
+       call and sends the totals back every config.AgentProfileInterval
+       seconds, see agentProfile().
+
+       Api methods marked with Api.cacheable are answered from
+       Api.ResultCache while a result for the same arguments is fresh.
+
+       With config.ApiWorkers set, api methods run on ApiWorkers threads so
+       a slow one holds up neither the other agents nor events. An agent's
+       frames are still answered one at a time in order, a frame whose
+       call went to a worker is resumed when the result is back.
     """
     def __init__(self, agentApi ):
         threading.Thread.__init__(self)
 
         self.agentApi = agentApi
         self.msgq = Queue.Queue()
-        self.msgq_alert = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.msgq_alert.bind( ('127.0.0.1',0) )
-        
-        self.msgq_alert_port = self.msgq_alert.getsockname()[1]  
-        self.connList = [self.msgq_alert]
-        self.rpc_conn = set()
-        self.evt_conn = set()
-        self.agent_proc_list = []  
+        self.msgq_alert = Wakeup()
         self.running = True
 
+        # fd -> (handler, argument) for everything the poller watches
+        self.poller = Poller()
+        self.fdmap = {}
+        self._watch( self.msgq_alert, self._service_alert, None )
+
+        # accepted connections that have not presented their token yet,
+        # socket -> ('rpc'|'evt', partially read token message)
+        self.pending_conn = {}
+        # token -> AgentRecord for sandboxes that are not fully attached
+        self.spawning = {}
+        # agentId -> AgentRecord for running agents
+        self.agents = {}
+        # event name -> set of subscribed AgentRecords
+        self.topics = {}
+        # rpc methods served by the controller rather than agentApi
+        self.control = {
+            sandbox.SUBSCRIBE: self._rpc_subscribe,
+            sandbox.UNSUBSCRIBE: self._rpc_unsubscribe,
+            sandbox.HIBERNATE: self._rpc_hibernate,
+            sandbox.PROFILE: self._rpc_profile
+        }
+
+        # warm sandbox pool, records attached but not yet given code
+        self.idle_sandboxes = []
+        self.pool_next_spawn = 0
+        self.pool_hits = 0
+        self.pool_misses = 0
+
+        self.next_usage_check = 0
+        self.last_usage_check = None
+        # cgroups of killed sandboxes, removed once they are empty
+        self.dead_cgroups = []
+
+        # agentId -> HibernatedAgent, asleep or waking up
+        self.hibernated = {}
+        # event name -> set of HibernatedAgents subscribed to it
+        self.sleepers = {}
+        self.next_idle_check = 0
+        self.hibernations = 0
+        self.wakes = 0
+        self.wake_latency = 0.0
+        self.wake_latency_max = 0.0
+
+        # rpc method -> latency histogram, see _rpc_time
+        self.rpc_times = {}
+        # ApiWorkers running the api methods, started by run()
+        self.workers = None
+        self.events_multicast = metrics.Registry.counter( "malib_events_multicast_total",
+            "events multicast to the local agents" )
+        self.events_delivered = metrics.Registry.counter( "malib_events_delivered_total",
+            "events written to subscribed agents" )
+        self.spawn_time = {
+            'warm': metrics.Registry.histogram( "malib_agent_spawn_seconds",
+                "time from an agent's arrival to its code being sent to a sandbox",
+                start="warm" ),
+            'cold': metrics.Registry.histogram( "malib_agent_spawn_seconds",
+                "time from an agent's arrival to its code being sent to a sandbox",
+                start="cold" )
+        }
+
     def shutdown(self):
-        msg = (self._service_shutdown, ())
-        self.msgq.put( msg )
-        self.msgq_alert.sendto( "x", self.msgq_alert.getsockname() )
+        self._post( self._service_shutdown, () )
+
+    def _post(self, func, args):
+        "have the controller thread call func(*args)"
+        self.msgq.put( (func, args) )
+        self.msgq_alert.notify()
                   
 
-    def hostTheAgent( self, code, breifcase ):
-        rpcPort = self.rpc_s.getsockname()[1]
-        evtPort = self.evt_s.getsockname()[1]           
-        proc = sandbox.create_agent_subprocess( rpcPort, evtPort )
-        self.agent_proc_list.append( proc ) 
+    def poolStats(self):
+        return {
+            'size': config.SandboxPoolSize,
+            'refill_rate': config.SandboxPoolRefillRate,
+            'idle': len(self.idle_sandboxes),
+            'hits': self.pool_hits,
+            'misses': self.pool_misses
+        }
+
+    def agentStats(self, agentId):
+        "statistics of a running agent, None if it is not hosted here" 
+        rec = self.agents.get( agentId )
+        if rec:
+            return rec.stats()
+
+    def profileAgent(self, agentId, on=True):
+        "turn profiling of a running agent on or off, see agentProfile"
+        self._post( self._service_profileAgent, (agentId, on) )
+
+    def agentProfile(self, agentId):
+        """ the last profile a profiled agent sent, None if it has sent
+            none or is not hosted here. A dict with the seconds profiled
+            ('elapsed'), the time spent waiting for rpc replies ('rpc_wait',
+            'rpc_calls') and in listen ('listen_wait') and 'functions', a
+            "file:line(name)" -> (calls, total seconds, own seconds) map """
+        rec = self.agents.get( agentId )
+        if rec:
+            return rec.profile
 
-        msg = (self._service_hostTheAgent, (code, breifcase))
-        self.msgq.put( msg )         
-        self.msgq_alert.sendto( "x", self.msgq_alert.getsockname() )
+    def cacheStats(self):
+        "size, hits, misses and hit rate of the api result cache" 
+        return Api.ResultCache.stats()
+
+    def invalidateCache(self, meth=None, *args):
+        "drop cached api results, see Api.ResultCache.invalidate" 
+        Api.ResultCache.invalidate( meth, *args )
+
+    def usageStats(self):
+        "agentId -> last sampled cpu time, memory and throttle counts" 
+        return dict( (agentId, rec.usage) for (agentId, rec) in self.agents.items() )
+
+    def hibernationStats(self):
+        "resident and hibernated agent counts and wake up latency" 
+        stats = {
+            'resident': len(self.agents),
+            'hibernated': len(self.hibernated),
+            'hibernations': self.hibernations,
+            'wakes': self.wakes,
+            'wake_latency_avg': 0.0,
+            'wake_latency_max': self.wake_latency_max
+        }
+        if self.wakes:
+            stats['wake_latency_avg'] = self.wake_latency / self.wakes
+        return stats
+
+    def load(self):
+        "number of agents running or being started" 
+        n = len(self.agents)
+        for rec in self.spawning.values():
+            if rec.code is not None:
+                n += 1
+        return n
+
+    def hostTheAgent( self, code, breifcase, agentId=None ):
+        "queue an agent for hosting, returns the id it will run under" 
+        if agentId is None:
+            agentId = uuid.uuid4().hex
+        self._post( self._service_hostTheAgent, (agentId, code, breifcase) )
+        return agentId
 
     def multicastEvent( self, eventId, *args ):
-          
-        msg = (self._service_multicastEvent, (eventId, args))
-        self.msgq.put( msg )
-        try:
-            self.msgq_alert.sendto( "x", self.msgq_alert.getsockname() )
-        except:
-            if self.running:
-                Logger.error("unexpected broken pipe for msgq alert") 
+        self._post( self._service_multicastEvent, (eventId, args) )
+
+    # fd registry
+
+    def _watch(self, s, handler, arg, write=False, read=True):
+        fd = s.fileno()
+        self.fdmap[fd] = (handler, arg)
+        self.poller.register( fd, write, read )
+
+    def _unwatch(self, s):
+        fd = s.fileno()
+        self.fdmap.pop( fd, None )
+        self.poller.unregister( fd )
         
     def _service_multicastEvent(self, eventId, argList ):
-        for r in self.evt_conn:
+        sleepers = self.sleepers.get( eventId )
+        if sleepers:
+            self._queue_for_sleepers( sleepers, eventId, argList )
+        subscribers = self.topics.get( eventId )
+        if not subscribers:
+            return
+        parts = wireCodec.dumps( (eventId,argList) )
+        packet = None
+        delivered = 0
+        self.events_multicast.inc()
+        for rec in list(subscribers):
+            if rec.state == HIBERNATING:
+                rec.held.append( (eventId, parts) )
+                rec.held_bytes += wireCodec.size( parts )
+                if rec.held_bytes > MAX_EVENT_BACKLOG:
+                    Logger.warning("agent %s does not answer HIBERNATE, resuming it" % rec.agentId)
+                    self._resume( rec )
+                continue
+            h = self.hibernated.get( rec.agentId )
+            if h and h.queued:
+                # woken agent still catching up, keep the events in order
+                h.queued.append( (eventId, parts) )
+                h.queued_bytes += wireCodec.size( parts )
+                continue
             try:
-                msg = (eventId,argList)
-                sandbox.sendMessage( r, msg )
-            except sandbox.Disconnect:
-                self.evt_conn.remove( r )
-                self.connList.remove( r )         
+                packet = self._send_event( rec, parts, packet )
+                rec.events_sent += 1
+                delivered += 1
+            except socket.error:
+                self._drop_agent( rec )
+        self.events_delivered.inc( delivered )
+
+    def _send_event(self, rec, parts, packet=None):
+        """ write an encoded event, large ones go through the shm ring.
+            packet is the framed event if it was already built for another
+            agent, the one used is returned for the next agent. """
+        data = None
+        if rec.ring and wireCodec.size(parts) >= config.AgentShmThreshold:
+            try:
+                pos = rec.ring.put( parts )
+            except sandbox.RingCorrupt, e:
+                Logger.warning("agent %s corrupted its shm ring: %s" % (rec.agentId, str(e)))
+                raise socket.error, "shm ring corrupted"
+            if pos is not None:
+                data = sandbox.packMessage( (sandbox.SHM_EVENT, pos) )
+        if data is None:
+            if packet is None:
+                packet = sandbox.frameParts( parts )
+            data = packet
+
+        rec.last_active = time.time()
+        # never block on an agent, it may be waiting on an rpc answer
+        if not rec.evt_backlog:
+            n = self._write( rec.evt, data )
+            if n == len(data):
+                return packet
+            data = data[n:]
+            self._watch( rec.evt, self._flush_events, rec, write=True )
+        rec.evt_backlog.append( data )
+        rec.backlog_bytes += len(data)
+        if rec.backlog_bytes > MAX_EVENT_BACKLOG:
+            Logger.warning("agent %s is not reading its events" % rec.agentId)
+            raise socket.error, "event backlog overflow"
+        return packet
+
+    def _write(self, s, data):
+        "non blocking send, returns the number of bytes written" 
+        try:
+            return s.send( data )
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def _flush_events(self, rec):
+        "the event socket of rec became writable (or was closed)" 
+        try:
+            while rec.evt_backlog:
+                packet = rec.evt_backlog[0]
+                n = self._write( rec.evt, packet )
+                rec.backlog_bytes -= n
+                if n < len(packet):
+                    rec.evt_backlog[0] = packet[n:]
+                    return
+                rec.evt_backlog.pop(0)
+        except socket.error:
+            self._drop_agent( rec )
+            return
+        self._unwatch( rec.evt )
+
+    def _rpc_subscribe(self, rec, event):
+        self.topics.setdefault( event, set() ).add( rec )
+        rec.topics.add( event )
+        h = self.hibernated.get( rec.agentId )
+        if h and h.waking:
+            self._resubscribed( rec, h, event )
+        return True
+
+    def _rpc_unsubscribe(self, rec, event):
+        rec.topics.discard( event )
+        subscribers = self.topics.get( event )
+        if subscribers:
+            subscribers.discard( rec )
+            if not subscribers:
+                del self.topics[event]
+        return True
         
+    def _rpc_profile(self, rec, report):
+        "the profile report of an agent" 
+        rec.profile = report
+        return True
+
+    def _service_profileAgent(self, agentId, on):
+        rec = self.agents.get( agentId )
+        if rec is None or rec.state != RUNNING or rec.profiling == on:
+            return
+        rec.profiling = on
+        if sandbox.PROFILE_ON is not None:
+            # reaches the agent even if it never listens
+            try:
+                os.kill( rec.proc.pid, on and sandbox.PROFILE_ON or sandbox.PROFILE_OFF )
+            except OSError:
+                pass
+            return
+        interval = None
+        if on:
+            interval = config.AgentProfileInterval
+        try:
+            self._send_event( rec, wireCodec.dumps( (sandbox.PROFILE, (interval,)) ) )
+        except socket.error:
+            self._drop_agent( rec )
+
+    def _rpc_hibernate(self, rec, briefcase):
+        "the agent's answer to HIBERNATE, returns whether it may exit" 
+        if rec.state != HIBERNATING or briefcase is None:
+            Logger.info("agent %s can't hibernate" % rec.agentId)
+            self._resume( rec )
+            return False
+        if rec.last_active > rec.hibernate_asked:
+            # made rpc calls or used the cpu since it was asked, it is busy
+            Logger.info("agent %s became busy, not hibernating it" % rec.agentId)
+            self._resume( rec )
+            return False
+        h = HibernatedAgent( rec.agentId,
+            os.path.join(self._hibernate_dir(), rec.agentId + ".agent"),
+            rec.topics )
+        state = {'code': rec.source, 'briefcase': briefcase, 'topics': list(rec.topics)}
+        try:
+            f = open( h.path, "wb" )
+            try:
+                for part in wireCodec.dumps( state ):
+                    f.write( part )
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            Logger.error("hibernating agent %s failed: %s" % (rec.agentId, str(e)))
+            self._resume( rec )
+            return False
+
+        for (event, parts) in rec.held:
+            h.queued.append( (event, parts) )
+            h.queued_bytes += wireCodec.size( parts )
+        rec.held = []
+        rec.held_bytes = 0
+        self.hibernated[h.agentId] = h
+        for event in h.topics:
+            self.sleepers.setdefault( event, set() ).add( h )
+        self.hibernations += 1
+        # dropped by _service_rpc once the answer is sent
+        rec.state = HIBERNATED
+        Logger.info("agent %s hibernated to %s" % (rec.agentId, h.path))
+        return True
+
+    def _resume(self, rec):
+        "an agent that was asked to hibernate keeps running" 
+        rec.state = RUNNING
+        rec.last_active = time.time()
+        held, rec.held = rec.held, []
+        rec.held_bytes = 0
+        for (event, parts) in held:
+            try:
+                self._send_event( rec, parts )
+            except socket.error:
+                self._drop_agent( rec )
+                return
+
+    def _hibernate_dir(self):
+        path = config.HibernateDir
+        if path is None:
+            path = os.path.join( tempfile.gettempdir(), "malib-hibernate" )
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+        return path
+
+    def _check_idle(self, now):
+        "ask agents idle for config.HibernateIdleTime to hibernate" 
+        if config.HibernateIdleTime is None or now < self.next_idle_check:
+            return
+        self.next_idle_check = now + min(config.HibernateIdleTime, 1.0)
+        for h in self.hibernated.values():
+            rec = self.agents.get( h.agentId )
+            if h.waking and rec and now - h.wake_started > WAKE_TIMEOUT:
+                Logger.warning("agent %s did not subscribe to %s again" % (h.agentId, list(h.topics)))
+                for event in list(h.topics):
+                    self._resubscribed( rec, h, event )
+        for rec in self.agents.values():
+            # an agent without topics could never be woken up
+            if rec.state != RUNNING or not rec.topics or rec.evt_backlog or rec.job \
+                    or rec.rpc_backlog:
+                continue
+            if now - rec.last_active < config.HibernateIdleTime:
+                continue
+            Logger.info("agent %s is idle, hibernating it" % rec.agentId)
+            try:
+                self._send_event( rec, wireCodec.dumps( (sandbox.HIBERNATE, ()) ) )
+            except socket.error:
+                self._drop_agent( rec )
+                continue
+            rec.state = HIBERNATING
+            rec.hibernate_asked = rec.last_active
+
+    def _queue_for_sleepers(self, sleepers, eventId, argList):
+        parts = wireCodec.dumps( (eventId,argList) )
+        for h in list(sleepers):
+            h.queued.append( (eventId, parts) )
+            h.queued_bytes += wireCodec.size( parts )
+            if h.queued_bytes > MAX_EVENT_BACKLOG:
+                Logger.warning("too many events queued for agent %s, dropping the oldest" % h.agentId)
+                (_event, old) = h.queued.pop(0)
+                h.queued_bytes -= wireCodec.size( old )
+            if not h.waking:
+                self._wake( h )
+
+    def _wake(self, h):
+        "host a hibernated agent again under its own id" 
+        Logger.info("waking agent %s" % h.agentId)
+        h.waking = True
+        h.wake_started = time.time()
+        try:
+            f = open( h.path, "rb" )
+            try:
+                state = wireCodec.loads( f.read(), copy=True )
+            finally:
+                f.close()
+            os.unlink( h.path )
+        except (IOError, OSError, ValueError, EOFError), e:
+            Logger.error("can't wake agent %s: %s" % (h.agentId, str(e)))
+            self._forget( h )
+            return
+        self._service_hostTheAgent( h.agentId, state['code'], state['briefcase'] )
+
+    def _resubscribed(self, rec, h, event):
+        "a woken agent subscribed to event again" 
+        if event in h.topics:
+            h.topics.discard( event )
+            self.sleepers[event].discard( h )
+            if not self.sleepers[event]:
+                del self.sleepers[event]
+        self._deliver_queued( rec, h )
+
+    def _deliver_queued(self, rec, h):
+        """ hand a woken agent the queued events in arrival order, up to the
+            first one for a topic it has not subscribed to again """
+        while h.queued and h.queued[0][0] not in h.topics:
+            (event, parts) = h.queued.pop(0)
+            h.queued_bytes -= wireCodec.size( parts )
+            if event not in rec.topics:
+                continue
+            try:
+                self._send_event( rec, parts )
+                rec.events_sent += 1
+            except socket.error:
+                self._drop_agent( rec )
+                return
+        if not h.topics:
+            self._forget( h )
+            latency = time.time() - h.wake_started
+            self.wakes += 1
+            self.wake_latency += latency
+            self.wake_latency_max = max(self.wake_latency_max, latency)
+            Logger.info("agent %s woke up in %.3fs" % (h.agentId, latency))
+
+    def _forget(self, h):
+        self.hibernated.pop( h.agentId, None )
+        for event in h.topics:
+            sleepers = self.sleepers.get( event )
+            if sleepers:
+                sleepers.discard( h )
+                if not sleepers:
+                    del self.sleepers[event]
+
     def _service_shutdown(self):
         self.running = False  
 
+    def _service_alert(self, _arg):
+        """ run everything queued when the wakeup was cleared, messages
+            posted meanwhile notify again """
+        self.msgq_alert.clear()
+        for i in xrange( self.msgq.qsize() ):
+            try:
+                (func,args) = self.msgq.get_nowait()
+            except Queue.Empty:
+                break
+            func( *args )
     
-    def _service_hostTheAgent(self, code, briefcase):
+    def _service_hostTheAgent(self, agentId, code, briefcase):
         "service incoming mobile agent" 
-        initialized = False
-        agent_comm = {}
-        Logger.info("host incoming agent")
-        while not initialized:         
-            ready, _p1, _p2 = select.select([self.rpc_s,self.evt_s],[],[],1)
-            for r in ready:
-                if r is self.rpc_s:
-                    agent_comm['rpc'], _addr = self.rpc_s.accept()                
-                    self.connList.append( agent_comm['rpc'] )
-                elif r is self.evt_s:
-                    agent_comm['evt'], _addr = self.evt_s.accept()                
-                    self.connList.append( agent_comm['evt'] )
-                    msg = ('init',(code,briefcase))
-                    Logger.info("sending agent the init message")
-                    sandbox.sendMessage( agent_comm['evt'], msg )
-                    initialized = True
+        Logger.info("host incoming agent %s" % agentId)
+        requested = time.time()
+        while self.idle_sandboxes:
+            rec = self.idle_sandboxes.pop(0)
+            rec.agentId = agentId
+            rec.requested = requested
+            try:
+                self._start_agent( rec, code, briefcase )
+            except (sandbox.Disconnect, socket.error):
+                Logger.warning("warm sandbox died while idle, discarding it")
+                self._close_sandbox( rec )
+                continue
+            self.pool_hits += 1
+            self.spawn_time['warm'].observe( time.time() - requested )
+            return
+
+        # pool is empty, pay for a cold start. The code is started once
+        # the new sandbox has attached, see _attach
+        self.pool_misses += 1
+        self._spawn_sandbox( agentId, code, briefcase, requested )
+
+    def _spawn_sandbox(self, agentId=None, code=None, briefcase=None, requested=None):
+        """ start a sandbox process for an agent, or for the pool if code is
+            None, it attaches asynchronously """
+        token = uuid.uuid4().hex
+        cgroup = quota.createCgroup( "agent-" + token )
+        limits = quota.limits( cgroup )
+        if config.AgentIpc == "unix":
+            (proc, rpc, evt, ring) = sandbox.create_agent_socketpair_subprocess(
+                config.AgentShmSize, limits )
+            rec = AgentRecord( None, proc )
+            rec.rpc, rec.evt, rec.ring = rpc, evt, ring
+        else:
+            rpcPort = self.rpc_s.getsockname()[1]
+            evtPort = self.evt_s.getsockname()[1]           
+            proc = sandbox.create_agent_subprocess( rpcPort, evtPort, token, limits )
+            rec = AgentRecord( token, proc )
+        rec.cgroup = cgroup
+        rec.agentId = agentId
+        rec.requested = requested
+        rec.code = code
+        rec.briefcase = briefcase
+
+        if config.AgentIpc == "unix":
+            # the sandbox is connected from birth, nothing to pair
+            self._attached( rec )
+        else:
+            self.spawning[token] = rec
+        return rec
+
+    def _accept(self, (listener, kind)):
+        conn, _addr = listener.accept()
+        conn.setblocking(0)
+        self.pending_conn[conn] = (kind, "")
+        self._watch( conn, self._service_pending, conn )
+
+    def _service_pending(self, conn):
+        "read the token a new connection presents, never blocks" 
+        try:
+            data = conn.recv(4096)
+        except socket.error:
+            data = "" 
+        (kind, buf) = self.pending_conn[conn]
+        buf += data
+        hdrsize = struct.calcsize(sandbox.HDR_FORMAT)
+        if data and len(buf) >= hdrsize:
+            size = struct.unpack(sandbox.HDR_FORMAT, buf[:hdrsize])[0]
+            if size > MAX_TOKEN_MSG:
+                data = ""
+            elif len(buf) >= hdrsize + size:
+                del self.pending_conn[conn]
+                self._unwatch( conn )
+                conn.setblocking(1)
+                try:
+                    token = marshal.loads( buf[hdrsize:hdrsize+size] )
+                except (ValueError, EOFError, TypeError):
+                    token = None
+                self._attach( conn, kind, token )
+                return
+
+        if not data:
+            # disconnected or garbage before presenting a token
+            del self.pending_conn[conn]
+            self._unwatch( conn )
+            conn.close()
+        else:
+            self.pending_conn[conn] = (kind, buf)
+
+    def _attach(self, conn, kind, token):
+        "pair a connection with the sandbox that presented the token" 
+        rec = self.spawning.get(token)
+        if rec is None or getattr(rec,kind) is not None:
+            Logger.warning("dropping sandbox connection with unknown token")
+            conn.close()
+            return
+        setattr(rec, kind, conn)
+        if rec.rpc is None or rec.evt is None:
+            return
+
+        del self.spawning[token]
+        self._attached( rec )
+
+    def _attached(self, rec):
+        "a sandbox has both connections, start it or park it in the pool" 
+        if rec.code is None:
+            rec.state = IDLE
+            self.idle_sandboxes.append( rec )
+        else:
+            code, briefcase = rec.code, rec.briefcase
+            rec.code = rec.briefcase = None
+            try:
+                self._start_agent( rec, code, briefcase )
+            except (sandbox.Disconnect, socket.error):
+                Logger.warning("sandbox for agent %s died on start" % rec.agentId)
+                self._close_sandbox( rec )
+                return
+            self.spawn_time['cold'].observe( time.time() - rec.requested )
+
+    def _start_agent(self, rec, code, briefcase):
+        "hand code and briefcase to a connected sandbox" 
+        rec.source = code
+        cobj = codeStore.Store.compiled( code )
+        if cobj is not None:
+            code = cobj
+        # else the source is sent and the agent fails in its sandbox
+        rec.profiling = config.AgentProfile
+        profile = (config.AgentProfile, config.AgentProfileInterval)
+        parts = wireCodec.dumps( ('init',(code,briefcase,profile)) )
+        Logger.info("sending agent the init message")
+        rec.evt.setblocking(0)
+        rec.rpc.setblocking(0)
+        self._send_event( rec, parts )
 
         # lookup to facilitate rpc calls and events 
-        self.rpc_conn.add( agent_comm['rpc'] )
-        self.evt_conn.add( agent_comm['evt'] )
-    
-                     
+        rec.state = RUNNING
+        rec.started = time.time()
+        self.agents[rec.agentId] = rec
+        self._watch( rec.rpc, self._service_rpc, rec )
 
-    def _proc(self, timeout):
-        ready, _p1, _p2 = select.select(self.connList,[],[],timeout)
-        for r in ready:          
-            if r is self.msgq_alert:   
-                (data,_p3) = self.msgq_alert.recvfrom(1)      
-                (func,args) = self.msgq.get()
-                func( *args )
-        
-            elif r in self.rpc_conn:
+    def _drop_agent(self, rec):
+        "tear down a running agent" 
+        if self.agents.pop( rec.agentId, None ) is None:
+            return
+        Logger.info("agent %s disconnected" % rec.agentId)
+        h = self.hibernated.get( rec.agentId )
+        if h and h.waking:
+            # died before it was fully awake
+            self._forget( h )
+        for event in list(rec.topics):
+            self._rpc_unsubscribe( rec, event )
+        self._unwatch( rec.rpc )
+        if rec.evt_backlog:
+            self._unwatch( rec.evt )
+        self._close_sandbox( rec )
+
+    def _close_sandbox(self, rec):
+        for s in (rec.rpc, rec.evt):
+            if s is None:
+                continue
+            try:
+                s.close()
+            except socket.error:
+                pass
+        try:
+            rec.proc.kill()
+            rec.proc.poll()
+        except OSError:
+            pass
+        if rec.cgroup and not rec.cgroup.remove():
+            self.dead_cgroups.append( rec.cgroup )
+
+    def _reap_spawning(self, now):
+        "kill sandboxes that failed to attach in time" 
+        for (token, rec) in self.spawning.items():
+            if now > rec.deadline:
+                Logger.warning("sandbox %s failed to attach, killing it" % token)
+                del self.spawning[token]
+                self._close_sandbox( rec )
+
+    def _check_usage(self, now):
+        """ sample the usage of every agent and enforce the quota policy, an
+            agent that used more than IDLE_CPU of a cpu since the last sample
+            counts as active """
+        if now < self.next_usage_check:
+            return
+        self.next_usage_check = now + config.AgentUsageInterval
+        elapsed = None
+        if self.last_usage_check is not None:
+            elapsed = now - self.last_usage_check
+        self.last_usage_check = now
+        self.dead_cgroups = [cg for cg in self.dead_cgroups if not cg.remove()]
+
+        for rec in self.agents.values():
+            last = rec.usage
+            if rec.cgroup:
                 try:
-                    meth,args = sandbox.recvMessage( r )
-                except sandbox.Disconnect:
-                    self.rpc_conn.remove( r )
-                    self.connList.remove( r )
-                    continue                    
-
-                if hasattr(self.agentApi,meth):
-                    func = getattr(self.agentApi,meth)
-                    try: 
-                        result = func( *args )
-                    except:
-                        result = {
-                            'error': (str(sys.exc_type),str(sys.exc_value)) 
-                        }
-                else:
-                    result = {
-                        'error': ("<type 'exceptions.NameError'>","Unknown method '%s'" % meth)
-                    }
-                # return result back to waiting agent
-                sandbox.sendMessage( r, result )
+                    rec.usage = rec.cgroup.usage()
+                except (IOError, OSError, ValueError):
+                    rec.usage = None
+            else:
+                rec.usage = quota.procUsage( rec.proc.pid )
+            if rec.usage is None:
+                continue
+            if last and elapsed and \
+                    rec.usage['cpu_seconds'] - last['cpu_seconds'] > IDLE_CPU * elapsed:
+                rec.last_active = now
+            exceeded = quota.overQuota( rec.usage )
+            if exceeded is None:
+                continue
+            if config.AgentQuotaPolicy == "kill":
+                Logger.warning("agent %s is over its %s quota, killing it" % (rec.agentId, exceeded))
+                self._drop_agent( rec )
+            elif not rec.throttled:
+                Logger.warning("agent %s is over its %s quota, throttling it" % (rec.agentId, exceeded))
+                rec.throttled = True
+                try:
+                    if rec.cgroup:
+                        rec.cgroup.capCpu( config.AgentThrottleCpu )
+                    else:
+                        quota.renice( rec.proc.pid, quota.NICE_MAX )
+                except (IOError, OSError), e:
+                    Logger.error("throttling agent %s failed: %s" % (rec.agentId, str(e)))
+
+    def _warm_count(self):
+        "idle sandboxes plus those still attaching without code" 
+        n = len(self.idle_sandboxes)
+        for rec in self.spawning.values():
+            if rec.code is None:
+                n += 1
+        return n
+
+    def _refill_pool(self):
+        "keep up to config.SandboxPoolSize idle sandboxes warm" 
+        if self._warm_count() >= config.SandboxPoolSize:
+            return
+        now = time.time()
+        if now < self.pool_next_spawn:
+            return
+        self._spawn_sandbox()
+        self.pool_next_spawn = now + 1.0 / config.SandboxPoolRefillRate
+
+    def _poll_timeout(self):
+        timeout = 5
+        if self.spawning:
+            timeout = 1
+        if self._warm_count() < config.SandboxPoolSize:
+            timeout = min(timeout, max(0, self.pool_next_spawn - time.time()))
+        if self.agents or self.dead_cgroups:
+            timeout = min(timeout, max(0, self.next_usage_check - time.time()))
+        if self.agents and config.HibernateIdleTime is not None:
+            timeout = min(timeout, max(0, self.next_idle_check - time.time()))
+        return timeout
+
+    def _service_rpc(self, rec):
+        """ queue every complete frame of (request id, method, args) calls
+            that has arrived and answer them, a partial frame waits for the
+            rest. Backed up answers are written first """
+        r = rec.rpc
+        try:
+            if rec.rpc_backlog:
+                self._flush_answers( rec )
+                if rec.rpc_backlog_bytes > MAX_RPC_BACKLOG:
+                    return
+            n = rec.reader.fill( r )
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            n = 0
+        if n == 0:
+            self._drop_agent( rec )
+            return
+
+        while True:
+            try:
+                frame = rec.reader.frame( sandbox.HDR_FORMAT )
+                if frame is None:
+                    break
+                # the reader reuses its memory, segments must be copied out
+                calls = wireCodec.loads( frame[1], copy=True )
+            except (socket.error, ValueError, TypeError, EOFError), e:
+                # an oversized or garbled frame, the agent is not trusted
+                # with the controller thread
+                Logger.error("bad rpc frame from agent %s: %s" % (rec.agentId, str(e)))
+                self._drop_agent( rec )
+                return
+            if not valid_calls( calls ):
+                Logger.error("malformed rpc calls from agent %s" % rec.agentId)
+                self._drop_agent( rec )
+                return
+            rec.frames.append( calls )
+        self._next_job( rec )
+
+    def _next_job(self, rec):
+        "answer the queued frames of an agent until one waits for a worker"
+        while rec.job is None and rec.frames and rec.agentId in self.agents:
+            rec.job = (rec.frames.popleft(), [])
+            self._run_job( rec )
+
+    def _run_job(self, rec):
+        """ answer the calls of the frame in progress in order. A call that
+            goes to a worker suspends the frame, _service_callDone resumes
+            it with the result """
+        (calls, answer) = rec.job
+        while len(answer) < len(calls):
+            (reqid, meth, args) = calls[len(answer)]
+            rec.rpc_calls += 1
+            started = time.time()
+            (func, args, result) = self._resolve( rec, meth, args )
+            if func is not None:
+                if self.workers and meth not in self.control:
+                    self.workers.submit( func, meth, args, (rec, meth, started) )
+                    return
+                result = self._invoke( func, meth, args )
+            answer.append( (reqid, result) )
+            self._rpc_time( meth ).observe( time.time() - started )
+        rec.job = None
+        rec.last_active = time.time()
+
+        # return results back to waiting agent
+        try:
+            self._send_answer( rec, sandbox.packMessage( answer ) )
+        except socket.error:
+            self._drop_agent( rec )
+        if rec.state == HIBERNATED:
+            self._drop_agent( rec )
+
+    def _send_answer(self, rec, data):
+        "write an rpc answer without blocking, the rest waits in rpc_backlog"
+        if not rec.rpc_backlog:
+            n = self._write( rec.rpc, data )
+            if n == len(data):
+                return
+            data = data[n:]
+        rec.rpc_backlog.append( data )
+        rec.rpc_backlog_bytes += len(data)
+        self._rpc_interest( rec )
+
+    def _flush_answers(self, rec):
+        "write what rpc_backlog holds until the socket takes no more"
+        while rec.rpc_backlog:
+            data = rec.rpc_backlog[0]
+            n = self._write( rec.rpc, data )
+            rec.rpc_backlog_bytes -= n
+            if n < len(data):
+                rec.rpc_backlog[0] = data[n:]
+                break
+            rec.rpc_backlog.pop(0)
+        self._rpc_interest( rec )
+
+    def _rpc_interest(self, rec):
+        """ watch the rpc socket for writing while answers are backed up
+            and stop reading it once they exceed MAX_RPC_BACKLOG """
+        write = len(rec.rpc_backlog) > 0
+        read = rec.rpc_backlog_bytes <= MAX_RPC_BACKLOG
+        fd = rec.rpc.fileno()
+        if (fd in self.poller.wfds) == write and (fd in self.poller.rfds) == read:
+            return
+        self._unwatch( rec.rpc )
+        self._watch( rec.rpc, self._service_rpc, rec, write, read )
+
+    def _call_done(self, tag, result):
+        "a worker finished a call, called on the worker thread"
+        self._post( self._service_callDone, (tag, result) )
+
+    def _service_callDone(self, tag, result):
+        (rec, meth, started) = tag
+        if rec.job is None or self.agents.get( rec.agentId ) is not rec:
+            # the agent went away meanwhile
+            return
+        (calls, answer) = rec.job
+        answer.append( (calls[len(answer)][0], result) )
+        self._rpc_time( meth ).observe( time.time() - started )
+        self._run_job( rec )
+        self._next_job( rec )
+
+    def _rpc_time(self, meth):
+        "latency histogram of an rpc method, unknown methods share one"
+        hist = self.rpc_times.get( meth )
+        if hist is None:
+            if meth not in self.control and not hasattr(self.agentApi,meth):
+                meth = "<unknown>"
+            hist = metrics.Registry.histogram( "malib_rpc_seconds",
+                "time to answer an rpc call of an agent", method=meth )
+            if meth != "<unknown>":
+                self.rpc_times[meth] = hist
+        return hist
+
+    def _resolve(self, rec, meth, args):
+        """ (function, args, None) for a call to make, (None, None, result)
+            for one answered without calling anything """
+        if meth in self.control:
+            return (self.control[meth], (rec,) + tuple(args), None)
+        if not hasattr(self.agentApi,meth):
+            return (None, None, {
+                'error': ("<type 'exceptions.NameError'>","Unknown method '%s'" % meth)
+            })
+        func = getattr(self.agentApi,meth)
+        if getattr( func, 'cache_ttl', None ) is not None:
+            try:
+                (hit, result) = Api.ResultCache.get( (meth, tuple(args)) )
+                if hit:
+                    return (None, None, result)
+            except TypeError:
+                # unhashable arguments are not cached
+                pass
+        return (func, args, None)
+
+    def _invoke(self, func, meth, args):
+        "make a call, on the controller or a worker thread" 
+        try: 
+            result = func( *args )
+        except:
+            (exc_type, exc_value) = sys.exc_info()[:2]
+            return {
+                'error': (str(exc_type),str(exc_value)) 
+            }
+        ttl = getattr( func, 'cache_ttl', None )
+        if ttl is not None:
+            try:
+                Api.ResultCache.put( (meth, tuple(args)), result, ttl )
+            except TypeError:
+                pass
+        return result
+
+    def _proc(self, timeout):
+        for (fd, _mask) in self.poller.poll( timeout ):
+            # an earlier handler in this pass may have torn the fd down
+            entry = self.fdmap.get( fd )
+            if entry:
+                (handler, arg) = entry
+                handler( arg )
     
 
 
     def run(self):
         Logger.info("agentController starting")   
-        self.rpc_s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)    
-        self.rpc_s.bind( ('127.0.0.1',0) )
-        self.rpc_s.listen(1)
+        listeners = []
+        if config.AgentIpc != "unix":
+            self.rpc_s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)    
+            self.rpc_s.bind( ('127.0.0.1',0) )
+            self.rpc_s.listen(socket.SOMAXCONN)
 
-        self.evt_s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.evt_s.bind( ('127.0.0.1',0) )
-        self.evt_s.listen(1)
+            self.evt_s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.evt_s.bind( ('127.0.0.1',0) )
+            self.evt_s.listen(socket.SOMAXCONN)
 
-        self.connList.append( self.rpc_s )
-        self.connList.append( self.evt_s )
+            self._watch( self.rpc_s, self._accept, (self.rpc_s, 'rpc') )
+            self._watch( self.evt_s, self._accept, (self.evt_s, 'evt') )
+            listeners = [self.rpc_s, self.evt_s]
+        if config.ApiWorkers > 0:
+            self.workers = ApiWorkers( config.ApiWorkers, self._invoke,
+                self._call_done )
 
         while self.running:
-            self._proc(5)
+            self._proc( self._poll_timeout() )
+            if self.running:
+                self._reap_spawning( time.time() )
+                self._check_usage( time.time() )
+                self._check_idle( time.time() )
+                self._refill_pool()
 
-        # close all connections  
-        for s in self.connList:
-            try:
-                s.shutdown( socket.SHUT_RDWR )
-            except socket.error:
-                pass
-        
-        # destroy agents
-        for proc in self.agent_proc_list:
-            try:
-                proc.kill()
-            except:
-                pass   
+        if self.workers:
+            self.workers.shutdown()
+        # close all connections and destroy agents
+        for conn in self.pending_conn.keys():
+            conn.close()
+        for rec in self.agents.values() + self.idle_sandboxes + self.spawning.values():
+            for s in (rec.rpc, rec.evt):
+                try:
+                    s.shutdown( socket.SHUT_RDWR )
+                except (socket.error, AttributeError):
+                    pass
+            self._close_sandbox( rec )
+        self._unwatch( self.msgq_alert )
+        self.msgq_alert.close()
+        for s in listeners:
+            s.close()
+        self.poller.close()
         Logger.info("agentController exiting")   
 
 def unittest():
     import logging
     import Api
    
-    Logger.basicConfig( filename="/dev/stdout", level=Logger.DEBUG )
+    logging.basicConfig( filename="/dev/stdout", level=logging.INFO )
 
     class TestApi( Api.MalibApiBase ):
+        got = []
         def test(self, *args):
             Logger.info( str(args) )
+        def ok(self, x):
+            self.got.append( x )
         
     import time
 
@@ -217,7 +1430,57 @@ Api.log("info","exiting")
     ac.multicastEvent( "help", 90 )
     time.sleep( 1 )
 
+    # agents sending what no sandbox would must not take the controller down
+    for code in ['Api.s.sendall("\\x7f\\xff\\xff\\xff")\nApi.listen(5)\n',
+                 'Api.s.sendall("\\x00\\x00\\x00\\x02\\x01\\x02")\nApi.listen(5)\n',
+                 'Api.s.sendall("\\x00\\x00\\x00\\x01N")\nApi.listen(5)\n',
+                 'Api._submit([("__subscribe__", 5)])\nApi.listen(5)\n',
+                 'Api._submit([(1, 2)])\nApi.listen(5)\n',
+                 'Api.ok("alive")\n']:
+        ac.hostTheAgent( code, {} )
+    deadline = time.time() + 10
+    while not testApi.got and time.time() < deadline:
+        time.sleep( 0.1 )
+    assert ac.is_alive() and testApi.got == ["alive"], "controller survived bad agents"
+
     ac.shutdown()
+    ac.join()
+    assert not [t for t in ac.workers.threads if t.is_alive()], "api workers joined"
+
+    # an idle agent is hibernated and woken by its event with its state,
+    # large code included
+    idle = config.HibernateIdleTime
+    config.HibernateIdleTime = 1
+    try:
+        ac = AgentController( testApi )
+        ac.start()
+        code = "#" + "x" * max(1, config.OutOfBandMin) + """
+Briefcase.setdefault( 'n', 0 )
+def ping( *args ):
+    Briefcase['n'] += 1
+    Api.ok( Briefcase['n'] )
+Api.register( "ping", ping )
+while True:
+    Api.listen( 10 )
+"""
+        testApi.got = []
+        ac.hostTheAgent( code, {} )
+        time.sleep( 1 )
+        ac.multicastEvent( "ping" )
+        deadline = time.time() + 10
+        while ac.hibernationStats()['hibernated'] == 0 and time.time() < deadline:
+            time.sleep( 0.1 )
+        assert ac.hibernationStats()['hibernated'] == 1, "idle agent hibernated"
+        ac.multicastEvent( "ping" )
+        deadline = time.time() + 10
+        while len(testApi.got) < 2 and time.time() < deadline:
+            time.sleep( 0.1 )
+        assert testApi.got == [1, 2], "woken agent kept its Briefcase"
+        ac.shutdown()
+        ac.join()
+    finally:
+        config.HibernateIdleTime = idle
+    print "agentController unittest passed"
 
     
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+"""
+Benchmarks of the malib hot paths, run on loopback and reported as JSON:
+
+  spawn      time from hostTheAgent() to the agent's first rpc call, with
+             a cold sandbox and with one from the warm pool
+  rpc        rpc round trips a second an agent makes through AgentController
+  fanout     events a second multicast to 1, 4 and 16 local agents
+  handshake  SecureLink handshakes a second, full and resumed
+  bulk       encrypted throughput of one SecureLink, and of every cipher
+             suite on its own (p2pp.benchmark)
+  peers      events a second broadcast over the connection pool to agents
+             hosted by several Peer processes
+
+The peers benchmark starts every Peer in a process of its own (the
+connection pool is one per process) on consecutive ports from --port.
+
+    python bench.py [--quick] [--peers N] [--port P] [--only NAME,...]
+"""
+
+import config
+import agentController
+import p2pp
+import peer
+import Api
+import Queue
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+Logger = logging.getLogger("malib")
+
+# seconds to wait for agents to report before a benchmark gives up
+REPORT_TIMEOUT = 60
+
+SPAWN_AGENT = """
+Api.report( "ready", Briefcase['i'] )
+"""
+
+RPC_AGENT = """
+for i in xrange( Briefcase['calls'] ):
+    Api.ping()
+Api.report( "done", Briefcase['calls'] )
+"""
+
+FANOUT_AGENT = """
+count = [0]
+done = []
+def got( *args ):
+    count[0] += 1
+def end( *args ):
+    done.append( True )
+Api.register( "bench", got )
+Api.register( "bench-end", end )
+Api.report( "ready", Briefcase['i'] )
+while not done:
+    Api.listen( 10 )
+Api.report( "done", count[0] )
+"""
+
+
+class BenchApi( Api.MalibApiBase ):
+    "agent api that timestamps the calls of the benchmark agents"
+
+    def __init__(self):
+        self.reports = Queue.Queue()
+        self.pings = 0
+        self.first_ping = None
+        self.last_ping = None
+
+    def ping(self):
+        # called from the controller thread only
+        now = time.time()
+        if self.first_ping is None:
+            self.first_ping = now
+        self.last_ping = now
+        self.pings += 1
+
+    def report(self, kind, value):
+        self.reports.put( (time.time(), kind, value) )
+
+    def wait(self, kind, n):
+        "the (time, value) of the next n reports of kind"
+        got = []
+        deadline = time.time() + REPORT_TIMEOUT
+        while len(got) < n:
+            try:
+                (t, k, value) = self.reports.get( timeout=max(0, deadline - time.time()) )
+            except Queue.Empty:
+                raise RuntimeError, "%d of %d agents reported %s" % (len(got), n, kind)
+            if k == kind:
+                got.append( (t, value) )
+        return got
+
+
+def summary( samples ):
+    "min, median, 90th percentile, max and mean of a list of seconds"
+    s = sorted( samples )
+    if not s:
+        return {}
+    return {
+        'n': len(s),
+        'min': s[0],
+        'median': s[len(s) // 2],
+        'p90': s[min(len(s) - 1, int(len(s) * 0.9))],
+        'max': s[-1],
+        'mean': sum(s) / len(s)
+    }
+
+
+def bench_spawn( ac, api, n ):
+    results = {}
+    for (kind, poolSize) in (("cold", 0), ("warm", max(1, config.SandboxPoolSize))):
+        config.SandboxPoolSize = poolSize
+        latencies = []
+        for i in range(n):
+            if poolSize:
+                deadline = time.time() + REPORT_TIMEOUT
+                while ac.poolStats()['idle'] == 0 and time.time() < deadline:
+                    time.sleep( 0.01 )
+            start = time.time()
+            ac.hostTheAgent( SPAWN_AGENT, {'i': i} )
+            ((t, _i),) = api.wait( "ready", 1 )
+            latencies.append( t - start )
+        results[kind] = summary( latencies )
+    return results
+
+def bench_rpc( ac, api, calls ):
+    api.pings = 0
+    api.first_ping = None
+    ac.hostTheAgent( RPC_AGENT, {'calls': calls} )
+    api.wait( "done", 1 )
+    elapsed = api.last_ping - api.first_ping
+    return {
+        'calls': api.pings,
+        'seconds': elapsed,
+        'calls_per_sec': (api.pings - 1) / elapsed if elapsed else None
+    }
+
+def bench_fanout( ac, api, events, counts=(1, 4, 16) ):
+    results = {}
+    for agents in counts:
+        for i in range(agents):
+            ac.hostTheAgent( FANOUT_AGENT, {'i': i} )
+        api.wait( "ready", agents )
+        start = time.time()
+        for i in xrange(events):
+            ac.multicastEvent( "bench", i )
+        ac.multicastEvent( "bench-end" )
+        done = api.wait( "done", agents )
+        elapsed = max( t for (t, _n) in done ) - start
+        delivered = sum( n for (_t, n) in done )
+        results[str(agents)] = {
+            'events': events,
+            'delivered': delivered,
+            'seconds': elapsed,
+            'deliveries_per_sec': delivered / elapsed
+        }
+    return results
+
+
+def _serve_links( s, bulk ):
+    "accept links on s, answer handshakes and read what bulk links send"
+    while True:
+        try:
+            conn, _addr = s.accept()
+        except socket.error:
+            return
+        link = p2pp.SecureLink()
+        try:
+            link.setup( conn )
+            if bulk:
+                while True:
+                    link.recv( conn )
+        except socket.error:
+            pass
+        conn.close()
+
+def _listen( bulk ):
+    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    s.bind( ('127.0.0.1', 0) )
+    s.listen( 8 )
+    t = threading.Thread( target=_serve_links, args=(s, bulk) )
+    t.daemon = True
+    t.start()
+    return s
+
+def bench_handshake( n ):
+    s = _listen( False )
+    addr = s.getsockname()
+    results = {}
+    for kind in ("full", "resumed"):
+        start = time.time()
+        for i in range(n):
+            if kind == "full":
+                p2pp.ClientSessions.discard( addr )
+            c = socket.create_connection( addr )
+            p2pp.SecureLink().setup( c, initiator=True, peer=addr )
+            c.close()
+        elapsed = time.time() - start
+        results[kind] = {'handshakes': n, 'per_sec': n / elapsed}
+    s.close()
+    return results
+
+def bench_bulk( seconds, size=1024*1024 ):
+    s = _listen( True )
+    c = socket.create_connection( s.getsockname() )
+    link = p2pp.SecureLink()
+    link.setup( c, initiator=True, peer=s.getsockname() )
+    # incompressible, so the codec doesn't flatter the numbers
+    payload = os.urandom( size )
+    n = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        link.send( c, payload )
+        n += 1
+    elapsed = time.time() - start
+    c.close()
+    s.close()
+    return {
+        'link': {'suite': link.suite, 'codec': link.codec,
+                 'mb_per_sec': n * size / elapsed / (1024 * 1024)},
+        'suites_mb_per_sec': p2pp.benchmark( seconds=seconds )
+    }
+
+
+def run_peer( port ):
+    "body of a peer process, reports its agents on stdout as json lines"
+    config.BindHost = '127.0.0.1'
+    config.BindPort = port
+    api = BenchApi()
+    p = peer.Peer( api )
+    p.start()
+
+    def forward():
+        while True:
+            (t, kind, value) = api.reports.get()
+            sys.stdout.write( json.dumps( [t, kind, value] ) + "\n" )
+            sys.stdout.flush()
+    t = threading.Thread( target=forward )
+    t.daemon = True
+    t.start()
+
+    sys.stdout.write( json.dumps( [time.time(), "started", port] ) + "\n" )
+    sys.stdout.flush()
+    # run until the benchmark closes our stdin
+    sys.stdin.read()
+    p.stop()
+
+def _expect( child, kind ):
+    "the value of the next report of kind from a peer process"
+    while True:
+        line = child.stdout.readline()
+        if not line:
+            raise RuntimeError, "peer process exited"
+        try:
+            (t, k, value) = json.loads( line )
+        except ValueError:
+            # something else the peer or its sandboxes printed
+            continue
+        if k == kind:
+            return (t, value)
+
+def bench_peers( npeers, port, events ):
+    children = []
+    try:
+        for i in range(npeers):
+            children.append( subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--serve", str(port + i)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE ) )
+        for child in children:
+            _expect( child, "started" )
+        addrs = [('127.0.0.1', port + i) for i in range(npeers)]
+        for (i, addr) in enumerate(addrs):
+            Api.sendAgent( addr, FANOUT_AGENT, {'i': i} )
+        for child in children:
+            _expect( child, "ready" )
+
+        start = time.time()
+        for i in xrange(events):
+            for addr in addrs:
+                Api.sendBroadcast( addr, "bench", i )
+        for addr in addrs:
+            Api.sendBroadcast( addr, "bench-end" )
+        done = [_expect( child, "done" ) for child in children]
+        elapsed = max( t for (t, _n) in done ) - start
+        delivered = sum( n for (_t, n) in done )
+        return {
+            'peers': npeers,
+            'events': events * npeers,
+            'delivered': delivered,
+            'seconds': elapsed,
+            'events_per_sec': delivered / elapsed
+        }
+    finally:
+        for child in children:
+            child.stdin.close()
+        for child in children:
+            child.wait()
+
+
+def main( argv ):
+    parser = argparse.ArgumentParser( description="malib loopback benchmarks" )
+    parser.add_argument( "--quick", action="store_true",
+        help="smaller runs, for a smoke test" )
+    parser.add_argument( "--peers", type=int, default=3 )
+    parser.add_argument( "--port", type=int, default=config.BindPort + 100,
+        help="first port of the peer processes" )
+    parser.add_argument( "--only", default=None,
+        help="comma separated benchmarks to run" )
+    parser.add_argument( "--serve", type=int, default=None,
+        help=argparse.SUPPRESS )
+    args = parser.parse_args( argv )
+
+    logging.basicConfig( level=logging.WARNING, stream=sys.stderr )
+    if args.serve is not None:
+        run_peer( args.serve )
+        return
+
+    scale = 0.1 if args.quick else 1.0
+    names = ["spawn", "rpc", "fanout", "handshake", "bulk", "peers"]
+    if args.only:
+        names = [n for n in names if n in args.only.split(",")]
+    results = {}
+
+    def run( name, func, *args ):
+        "a benchmark that fails is reported as such, the others still run"
+        if name not in names:
+            return
+        try:
+            results[name] = func( *args )
+        except (RuntimeError, socket.error), e:
+            results[name] = {'error': str(e)}
+
+    if set(names) & set(["spawn", "rpc", "fanout"]):
+        api = BenchApi()
+        poolSize = config.SandboxPoolSize
+        config.SandboxPoolSize = 0
+        ac = agentController.AgentController( api )
+        # don't hang the benchmark on a controller that stopped answering
+        ac.daemon = True
+        ac.start()
+        try:
+            run( "spawn", bench_spawn, ac, api, max(3, int(20 * scale)) )
+            config.SandboxPoolSize = poolSize
+            run( "rpc", bench_rpc, ac, api, max(100, int(20000 * scale)) )
+            run( "fanout", bench_fanout, ac, api, max(100, int(5000 * scale)) )
+        finally:
+            ac.shutdown()
+            ac.join( REPORT_TIMEOUT )
+    run( "handshake", bench_handshake, max(5, int(100 * scale)) )
+    run( "bulk", bench_bulk, max(0.2, 2.0 * scale) )
+    if "peers" in names:
+        Api.ConnectionPool.start()
+        try:
+            run( "peers", bench_peers, args.peers, args.port,
+                max(100, int(5000 * scale)) )
+        finally:
+            Api.ConnectionPool.shutdown()
+            Api.ConnectionPool.join()
+
+    print json.dumps( {
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'config': {
+            'AgentIpc': config.AgentIpc,
+            'PeerServerMode': config.PeerServerMode,
+            'CipherSuites': config.CipherSuites,
+            'Compression': config.Compression,
+            'SandboxPoolSize': config.SandboxPoolSize
+        },
+        'results': results
+    }, indent=2, sort_keys=True )
+
+
+if __name__ == '__main__':
+    main( sys.argv[1:] )
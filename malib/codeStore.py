@@ -0,0 +1,140 @@
+"""
+Content addressed store of mobile agent code. Code is keyed by the sha1 of
+its source so a peer that already holds an agent's code only needs to be
+sent the hash. Next to the source each entry caches the codeIsValid verdict
+and the compiled code object, the store is bounded to config.CodeStoreSize
+entries and evicts the least recently used.
+"""
+
+import config
+import sandbox
+import hashlib
+import threading
+from collections import OrderedDict
+
+# position of the cached items in an entry
+CODE     = 0
+VERDICT  = 1
+COMPILED = 2
+
+
+def digest( code ):
+    return hashlib.sha1( code ).hexdigest()
+
+
+class CodeStore:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, codeHash):
+        "lookup and mark as recently used, call with the lock held"
+        entry = self.entries.pop( codeHash, None )
+        if entry is not None:
+            self.entries[codeHash] = entry
+        return entry
+
+    def put(self, code):
+        "store code, returns its hash"
+        codeHash = digest( code )
+        with self.lock:
+            if self._entry( codeHash ) is None:
+                self.entries[codeHash] = [code, None, None]
+                while len(self.entries) > config.CodeStoreSize:
+                    self.entries.popitem( last=False )
+        return codeHash
+
+    def get(self, codeHash):
+        "code for a hash, None if it is not in the store"
+        with self.lock:
+            entry = self._entry( codeHash )
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[CODE]
+
+    def isValid(self, api, code):
+        "api.codeIsValid(code), asked once per distinct code"
+        codeHash = self.put( code )
+        with self.lock:
+            entry = self._entry( codeHash )
+            if entry and entry[VERDICT] is not None:
+                return entry[VERDICT]
+        verdict = bool( api.codeIsValid( code ) )
+        with self.lock:
+            entry = self._entry( codeHash )
+            if entry:
+                entry[VERDICT] = verdict
+        return verdict
+
+    def compiled(self, code):
+        """ code object a sandbox can exec directly, see sandbox.compile_agent,
+            None if the code does not compile """
+        codeHash = self.put( code )
+        with self.lock:
+            entry = self._entry( codeHash )
+            if entry and entry[COMPILED] is not None:
+                return entry[COMPILED]
+        try:
+            cobj = sandbox.compile_agent( code )
+        except (SyntaxError, TypeError, ValueError):
+            # e.g. a NUL byte in the source, that is for the sandbox to fail on
+            return None
+        with self.lock:
+            entry = self._entry( codeHash )
+            if entry:
+                entry[COMPILED] = cobj
+        return cobj
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+# code store shared by the peer, the connection pool and the agent controller
+Store = CodeStore()
+
+
+def unittest():
+    store = CodeStore()
+    code = "x = 1\n"
+    codeHash = store.put( code )
+    assert codeHash == digest( code ) and store.get( codeHash ) == code
+    assert store.get( digest("missing") ) is None
+
+    cobj = store.compiled( code )
+    assert cobj is not None and store.compiled( code ) is cobj, "compiled once"
+    # code that doesn't compile is for the sandbox to fail on
+    assert store.compiled( "def (:\n" ) is None
+    assert store.compiled( "x = 1\0\n" ) is None
+
+    class Api:
+        asked = 0
+        def codeIsValid(self, code):
+            self.asked += 1
+            return "open" not in code
+    api = Api()
+    assert store.isValid( api, code ) and store.isValid( api, code )
+    assert not store.isValid( api, "open('f')\n" )
+    assert api.asked == 2, "codeIsValid asked once per distinct code"
+
+    size = config.CodeStoreSize
+    config.CodeStoreSize = 2
+    try:
+        first = store.put( "a = 1\n" )
+        store.put( "b = 1\n" )
+        store.put( "c = 1\n" )
+        assert store.get( first ) is None and len(store.entries) == 2, "least recently used evicted"
+    finally:
+        config.CodeStoreSize = size
+    print "codeStore unittest passed"
+
+if __name__ == '__main__':
+    unittest()
@@ -8,4 +8,109 @@ LogFile = "malib.log"
 LogLevel="info"
 PeerRequestQueueSize=10
 
-
+# number of idle, pre-started sandbox processes the agent controller
+# keeps warm for arriving agents (0 disables the pool)
+SandboxPoolSize = 2
+# maximum number of sandbox processes spawned per second when refilling
+SandboxPoolRefillRate = 4.0
+# seconds a new sandbox process has to connect back and present its token
+SandboxAttachTimeout = 30
+# how Peer serves inbound peer links, "threaded" uses a thread per link,
+# "eventloop" multiplexes every link on a single thread
+PeerServerMode = "threaded"
+# number of agent controller processes, 1 runs a single controller thread
+# inside the peer process
+ControllerShards = 1
+# how agents are assigned to shards, "leastload" or "hash" (of the code)
+ShardAssignment = "leastload"
+# transport between the agent controller and its sandboxes, "tcp" uses
+# loopback listeners, "unix" hands each sandbox pre-connected socketpairs
+AgentIpc = "tcp"
+# bytes of shared memory ring per sandbox in "unix" mode, 0 disables it
+AgentShmSize = 0
+# events at least this large go through the ring when there is one
+AgentShmThreshold = 65536
+# number of distinct agent codes kept in the code store (see codeStore)
+CodeStoreSize = 256
+# number of results of Api.cacheable methods kept (see Api.ResultCache)
+ApiCacheSize = 1024
+# threads running the api methods agents call, methods marked
+# Api.concurrent share them while all others run one at a time on a thread
+# of their own. 0 runs every method on the agent controller's thread
+ApiWorkers = 4
+# file holding this node's RSA identity key, generated (and saved there
+# when set) on first use
+IdentityKeyFile = None
+# number of SecureLink sessions remembered for resumption and their
+# lifetime in seconds
+SessionCacheSize = 1024
+SessionLifetime = 3600
+# SecureLink cipher suites in order of preference
+CipherSuites = ["aes-gcm", "chacha20-poly1305", "blowfish-cbc"]
+# SecureLink compression codecs in order of preference, an empty list turns
+# compression off
+Compression = ["zlib", "bz2"]
+# frames with a smaller marshalled payload are sent uncompressed
+CompressThreshold = 1024
+# zlib compression level, 1 (fastest) to 9 (smallest)
+CompressLevel = 6
+# seconds the connection pool waits for more messages to the same peer so a
+# burst goes out as one MULTI_MESSAGE frame, 0 only packs what is queued
+PoolCoalesceWindow = 0.002
+# most messages packed into one MULTI_MESSAGE frame
+PoolCoalesceMax = 64
+# connects and handshakes to other peers that may be in progress at once
+PoolMaxConnecting = 8
+# seconds allowed for the tcp connect to another peer
+PoolConnectTimeout = 10
+# after a failed connect a peer is not retried for PoolBackoffBase seconds,
+# doubling with every further failure up to PoolBackoffMax
+PoolBackoffBase = 1
+PoolBackoffMax = 60
+# how MalibApiBase.multicast reaches remote peers, "direct" sends to each,
+# "tree" relays along a spanning tree and "gossip" to random peers
+MulticastMode = "direct"
+# peers the origin, and every relaying peer, sends a multicast on to
+MulticastFanout = 3
+# number of relayed event ids remembered to drop duplicates
+MulticastSeenSize = 4096
+# largest frame payload in bytes accepted from another peer or a sandbox,
+# the connection of a larger one is closed (see framing)
+MaxFrameSize = 256 * 1024 * 1024
+# strings of at least this many bytes in a message travel out of band
+# (see wireCodec), 0 marshals everything into the message
+OutOfBandMin = 65536
+# limits every sandbox is spawned with (see quota), None for no limit:
+# nice value, open files, memory in bytes (address space and cgroup
+# memory.max) and cpu seconds an agent may use in total
+AgentNice = 10
+AgentMaxFiles = 64
+AgentMemoryBytes = None
+AgentCpuSeconds = None
+# cgroup v2 directory under which every sandbox gets a cgroup, None only
+# applies rlimits. cpu.weight of each agent and the fraction of one cpu it
+# may use (None for no cap)
+AgentCgroupRoot = None
+AgentCpuWeight = 100
+AgentCpuMax = None
+# what happens to an agent over quota, "throttle" caps its cpu at
+# AgentThrottleCpu of a cpu (or renices it without cgroups), "kill" kills it
+AgentQuotaPolicy = "throttle"
+AgentThrottleCpu = 0.05
+# seconds between usage samples of the running agents
+AgentUsageInterval = 1.0
+# seconds without rpc calls, events or cpu use after which an agent is hibernated
+# to disk, None never hibernates agents
+HibernateIdleTime = None
+# directory for the state of hibernated agents, None uses the temp dir
+HibernateDir = None
+# file the metrics are written to in Prometheus text format every
+# MetricsInterval seconds and (host, port) they are served on, None for
+# neither (see metrics)
+MetricsFile = None
+MetricsInterval = 10
+MetricsAddr = None
+# profile every agent from its start (see AgentController.profileAgent to
+# profile one agent) and the seconds between the profile reports it sends
+AgentProfile = False
+AgentProfileInterval = 5.0
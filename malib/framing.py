@@ -0,0 +1,193 @@
+"""
+Length prefixed framing shared by the peer protocol (p2pp) and the sandbox
+IPC. Every frame is a struct header whose first field is the payload size
+followed by the payload.
+
+Receiving reads straight into preallocated bytearrays with recv_into and
+hands payloads out as buffer objects over that memory, marshal.loads takes
+them as they are and memoryview() of them is what the ciphers want.
+FrameReader keeps reading ahead and parses every complete frame out of one
+buffer, recv_frame reads exactly one frame and never more, for callers that
+select on the socket between frames. The size in a header comes from the
+other side, a frame larger than config.MaxFrameSize (or the limit the caller
+gives) raises FrameTooLarge and the memory for a payload grows as it
+arrives rather than being set aside up front.
+
+Sending takes the frame as a list of parts that are handed to sendmsg where
+the socket has it, small frames are joined and large ones written part by
+part so a big payload is never copied just to put a header in front of it.
+"""
+
+import config
+import os
+import socket
+import struct
+
+# initial size of a FrameReader buffer, it grows to fit the largest frame
+READ_SIZE = 65536
+# frames with a payload at least this big are sent part by part
+SCATTER_MIN = 16384
+
+
+class Closed( socket.error ):
+    "the other side closed the connection"
+    pass
+
+class FrameTooLarge( socket.error ):
+    "the other side announced a frame larger than the limit"
+    pass
+
+
+def check_size( size, limit ):
+    if limit is None:
+        limit = config.MaxFrameSize
+    if size > limit:
+        raise FrameTooLarge, "frame of %d bytes exceeds the limit of %d" % (size, limit)
+
+
+def recv_into( conn, view ):
+    "fill view completely"
+    got = 0
+    while got < len(view):
+        n = conn.recv_into( view[got:] )
+        if n == 0:
+            raise Closed, "Unexpect disconnect"
+        got += n
+
+def recv_frame( conn, fmt, limit=None ):
+    """ read one frame, returns (header tuple, buffer over the payload).
+        limit is the largest payload accepted, config.MaxFrameSize if None """
+    hdr = bytearray( struct.calcsize(fmt) )
+    recv_into( conn, memoryview(hdr) )
+    hdr = struct.unpack( fmt, buffer(hdr) )
+    check_size( hdr[0], limit )
+    payload = bytearray( min(hdr[0], READ_SIZE) )
+    got = 0
+    while True:
+        recv_into( conn, memoryview(payload)[got:] )
+        got = len(payload)
+        if got == hdr[0]:
+            break
+        # at most double what has arrived
+        payload.extend( bytearray( min(hdr[0], 2 * got) - got ) )
+    return (hdr, buffer(payload))
+
+def send_parts( conn, parts ):
+    "send the parts of a frame as one"
+    if hasattr(conn, 'sendmsg'):
+        total = sum( len(p) for p in parts )
+        sent = conn.sendmsg( parts )
+        if sent < total:
+            conn.sendall( "".join( [str(p) for p in parts] )[sent:] )
+    elif sum( len(p) for p in parts ) < SCATTER_MIN:
+        conn.sendall( "".join( [str(p) for p in parts] ) )
+    else:
+        for p in parts:
+            conn.sendall( p )
+
+
+class FrameReader:
+    """ Read ahead buffer for one connection. fill() does a single
+        recv_into, frame() returns the next complete frame. A payload is a
+        buffer into the reader's memory and is only valid until the next
+        call to fill().
+    """
+    def __init__(self, size=READ_SIZE):
+        self.buf = bytearray( size )
+        self.start = 0
+        self.end = 0
+
+    def fill(self, conn):
+        "read what is available, returns the number of bytes, 0 at EOF"
+        if self.end == len(self.buf):
+            self._room( len(self.buf) + 1 )
+        n = conn.recv_into( memoryview(self.buf)[self.end:] )
+        self.end += n
+        return n
+
+    def feed(self, data):
+        "add data that was received some other way"
+        self._room( self.end - self.start + len(data) )
+        self.buf[self.end:self.end+len(data)] = data
+        self.end += len(data)
+
+    def frame(self, fmt, limit=None):
+        """ (header tuple, payload buffer) or None if no frame is complete,
+            limit is as for recv_frame """
+        hdrsize = struct.calcsize( fmt )
+        if self.end - self.start < hdrsize:
+            return None
+        hdr = struct.unpack_from( fmt, self.buf, self.start )
+        check_size( hdr[0], limit )
+        total = hdrsize + hdr[0]
+        if self.end - self.start < total:
+            # at most double what has arrived, fill() grows it further
+            self._room( min(total, 2 * (self.end - self.start)) )
+            return None
+        payload = buffer( self.buf, self.start + hdrsize, hdr[0] )
+        self.start += total
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > 4 * READ_SIZE:
+                # don't hold on to the memory of one huge frame
+                self.buf = bytearray( READ_SIZE )
+        return (hdr, payload)
+
+    def _room(self, size):
+        "make sure size bytes fit from the start of the unread data"
+        if len(self.buf) - self.start >= size:
+            return
+        pending = self.end - self.start
+        if size <= len(self.buf):
+            self.buf[0:pending] = self.buf[self.start:self.end]
+        else:
+            grown = bytearray( max(size, 2 * len(self.buf)) )
+            grown[0:pending] = self.buf[self.start:self.end]
+            self.buf = grown
+        self.start = 0
+        self.end = pending
+
+
+def unittest():
+    import threading
+
+    a, b = socket.socketpair()
+    for n in (0, 1, READ_SIZE + 1, 3 * READ_SIZE):
+        data = os.urandom( n )
+        t = threading.Thread( target=send_parts, args=(a, [struct.pack('>I', n), data]) )
+        t.start()
+        (hdr, payload) = recv_frame( b, '>I' )
+        t.join()
+        assert hdr == (n,) and str(payload) == data, "recv_frame of %d bytes" % n
+
+        r = FrameReader()
+        r.feed( struct.pack('>I', n) + data[:n // 2] )
+        assert n == 0 or r.frame( '>I' ) is None, "frame before the payload is complete"
+        r.feed( data[n // 2:] )
+        (hdr, payload) = r.frame( '>I' )
+        assert str(payload) == data, "FrameReader frame of %d bytes" % n
+
+    # the size in a header is not trusted
+    a.sendall( struct.pack('>I', 1000) + "x" )
+    try:
+        recv_frame( b, '>I', 100 )
+        assert False, "recv_frame took a frame over its limit"
+    except FrameTooLarge:
+        pass
+    r = FrameReader()
+    r.feed( struct.pack('>I', config.MaxFrameSize + 1) )
+    try:
+        r.frame( '>I' )
+        assert False, "FrameReader took a frame over config.MaxFrameSize"
+    except FrameTooLarge:
+        pass
+    r = FrameReader()
+    r.feed( struct.pack('>I', 100 * 1024 * 1024) + "x" * 10 )
+    assert r.frame( '>I' ) is None and len(r.buf) <= 2 * READ_SIZE, \
+        "memory set aside for a frame that has not arrived"
+    a.close()
+    b.close()
+    print "framing unittest passed"
+
+if __name__ == '__main__':
+    unittest()
@@ -0,0 +1,249 @@
+"""
+Runtime metrics of a peer. Counters, gauges and latency histograms live in
+one Registry, keyed by name and labels. The code being measured asks the
+registry for its metric once (a link when it is set up, the controller at
+start) and then only calls inc/observe, so measuring costs a lock and an
+add on the hot path.
+
+Registry.snapshot() returns everything as a dict, Registry.prometheus()
+in the Prometheus text exposition format. With config.MetricsFile set the
+text is rewritten there every config.MetricsInterval seconds (for the node
+exporter textfile collector), with config.MetricsAddr it is served to
+anything that connects there, as an HTTP/1.0 reply so Prometheus can scrape
+it. Controller shards run in processes of their own, their metrics are not
+in the registry of the peer.
+"""
+
+import config
+import os
+import bisect
+import socket
+import threading
+import time
+import logging
+
+Logger = logging.getLogger("malib")
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    "a count that only goes up"
+    kind = "counter"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    "a value that goes up and down, or fn() read when it is collected"
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.fn:
+            return self.fn()
+        return self.value
+
+
+class Histogram:
+    "counts of observed values per bucket, with their sum"
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left( self.bounds, value )
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        "{count, sum, buckets: [(upper bound, cumulative count)]}"
+        with self.lock:
+            counts = list(self.counts)
+            stats = {'count': self.count, 'sum': self.sum}
+        cumulative = []
+        total = 0
+        for (bound, n) in zip( self.bounds + [float('inf')], counts ):
+            total += n
+            cumulative.append( (bound, total) )
+        stats['buckets'] = cumulative
+        return stats
+
+
+class _Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (kind, help)
+        self.families = {}
+        # name -> {sorted label items: metric}
+        self.metrics = {}
+
+    def counter(self, name, help, **labels):
+        return self._get( name, help, labels, Counter )
+
+    def gauge(self, name, help, fn=None, **labels):
+        gauge = self._get( name, help, labels, Gauge )
+        if fn:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, **labels):
+        return self._get( name, help, labels, Histogram )
+
+    def remove(self, name, **labels):
+        "forget one labelled metric, e.g. of a peer that went away"
+        with self.lock:
+            self.metrics.get( name, {} ).pop( tuple(sorted(labels.items())), None )
+
+    def _get(self, name, help, labels, cls):
+        "the metric for name and labels, created on first use"
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.metrics.get( name )
+            if family is None:
+                self.families[name] = (cls.kind, help)
+                family = self.metrics[name] = {}
+            elif self.families[name][0] != cls.kind:
+                raise ValueError, "metric %s is a %s" % (name, self.families[name][0])
+            metric = family.get( key )
+            if metric is None:
+                metric = family[key] = cls()
+            return metric
+
+    def _collect(self):
+        with self.lock:
+            return [(name, self.families[name], family.items())
+                    for (name, family) in sorted(self.metrics.items())]
+
+    def snapshot(self):
+        "name -> {label items: value}, histograms as Histogram.snapshot()"
+        return dict( (name, dict( (key, m.snapshot()) for (key, m) in family ))
+                     for (name, _kind, family) in self._collect() )
+
+    def prometheus(self):
+        "the metrics in the Prometheus text exposition format"
+        lines = []
+        for (name, (kind, help), family) in self._collect():
+            lines.append( "# HELP %s %s" % (name, help) )
+            lines.append( "# TYPE %s %s" % (name, kind) )
+            for (key, metric) in sorted(family):
+                value = metric.snapshot()
+                if kind != "histogram":
+                    lines.append( "%s%s %s" % (name, _labels(key), _number(value)) )
+                    continue
+                for (bound, n) in value['buckets']:
+                    le = key + (('le', _number(bound)),)
+                    lines.append( "%s_bucket%s %d" % (name, _labels(le), n) )
+                lines.append( "%s_sum%s %s" % (name, _labels(key), _number(value['sum'])) )
+                lines.append( "%s_count%s %d" % (name, _labels(key), value['count']) )
+        return "\n".join( lines ) + "\n"
+
+    def dump(self, path):
+        "write prometheus() to path, replaced atomically"
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        f = open( tmp, "w" )
+        try:
+            f.write( self.prometheus() )
+        finally:
+            f.close()
+        os.rename( tmp, path )
+
+
+def _labels( key ):
+    if not key:
+        return ""
+    return "{%s}" % ",".join( '%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"'))
+                              for (k, v) in key )
+
+def _number( value ):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(value)
+
+
+# the metrics of this process
+Registry = _Registry()
+
+
+class Exporter( threading.Thread ):
+    """ Rewrites config.MetricsFile every config.MetricsInterval seconds
+        and answers connections to config.MetricsAddr with the metrics. """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="malib-metrics")
+        self.daemon = True
+        self.running = True
+        self.s = None
+        if config.MetricsAddr:
+            self.s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+            self.s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+            self.s.bind( config.MetricsAddr )
+            self.s.listen( 8 )
+            self.s.settimeout( 0.5 )
+
+    def shutdown(self):
+        self.running = False
+
+    def run(self):
+        next_dump = 0
+        while self.running:
+            if config.MetricsFile and time.time() >= next_dump:
+                next_dump = time.time() + config.MetricsInterval
+                try:
+                    Registry.dump( config.MetricsFile )
+                except (IOError, OSError), e:
+                    Logger.warning("can't write metrics to %s: %s" % (config.MetricsFile, str(e)))
+            if self.s is None:
+                time.sleep( 0.5 )
+                continue
+            try:
+                conn, _addr = self.s.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            self._serve( conn )
+        if self.s:
+            self.s.close()
+
+    def _serve(self, conn):
+        try:
+            conn.settimeout( 0.5 )
+            try:
+                # an http request, or nothing at all
+                conn.recv( 4096 )
+            except socket.timeout:
+                pass
+            body = Registry.prometheus()
+            conn.sendall( "HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n\r\n%s" % (len(body), body) )
+        except socket.error:
+            pass
+        finally:
+            conn.close()
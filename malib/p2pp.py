@@ -1,141 +1,651 @@
 """
-Allows for communication over a TCP link to be done using blowfish where the
-data used to make the cyphers on both sides of the connection use temporary
-RSA key pairs. After initialization the RSA keys are no longer needed and all
-communication is done using symetrical encryption. 
+Allows for communication over a TCP link to be done using symetrical
+encryption where the keys for the cyphers on both sides of the connection
+are derived from a secret the initiator sends encrypted with the responder's
+RSA identity key.
+Every node generates its identity key once (or loads it from
+config.IdentityKeyFile), so setting up a link costs no key generation. After
+initialization the RSA keys are no longer needed and all communication is
+done using symetrical encryption. 
+
+Both sides remember the secret of a completed handshake as a session. An
+initiator reconnecting to a peer it has a session with asks to resume it,
+if the responder still has the session both derive fresh keys from the
+secret and new nonces and the link is up after one round trip without any
+RSA operation.
+
+The cipher suite is negotiated during the handshake, the initiator offers
+the suites of config.CipherSuites this node supports and the responder
+picks the first of its own list that was offered. The AEAD suites (aes-gcm,
+chacha20-poly1305, available with pycryptodome) use a per message counter
+nonce, blowfish-cbc is kept for peers that offer nothing else. Every link
+keeps one cipher context per direction for its whole life.
+
+Nodes from before the negotiation open a link by sending their public key
+as a bare PEM string. A responder recognises that first frame and answers
+with the old handshake, the link then uses LegacyBlowfish and plain marshal
+data without compression. A legacy responder sends its key without waiting
+for the hello and then fails on it, so an initiator that gets a PEM string
+back raises LegacyPeer and remembers the peer in LegacyPeers, the next link
+to it is opened with the old handshake.
+
+A compression codec is negotiated the same way from config.Compression.
+With a codec every secure frame's plaintext starts with a flag byte that
+tells whether the payload was compressed, payloads smaller than
+config.CompressThreshold or that don't shrink are sent as they are. A
+payload that decompresses to more than config.MaxFrameSize is refused. Both
+ends count the bytes compression saved them, see SecureLink.stats().
+
+Handshake time and the frames and bytes of every link, labelled with the
+link's name, are recorded in metrics.Registry.
 """
 
 from Crypto.PublicKey import RSA
 from Crypto import Random
 from Crypto.Cipher import Blowfish
+from Crypto.Cipher import AES
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+from collections import OrderedDict
+import config
+import framing
+import wireCodec
+import metrics
+import hashlib
+import zlib
+import bz2
+import os
 import uuid
 import threading
 import marshal
 import struct
 import socket
+import time
 import logging
 import traceback
 
 Logger = logging.getLogger("malib")
 
+# wire framing, handshake frames are sent in the clear and carry
+# their length, secure frames also carry the cipher padding size.
+PLAIN_HDR  = '>I'
+SECURE_HDR = '>IB'
+SECURE_HDR_SIZE = struct.calcsize( SECURE_HDR )
+# largest handshake frame accepted, they hold keys and nonces only
+MAX_HANDSHAKE_FRAME = 65536
+
+# handshake coroutine operations, see SecureLink.handshake
+SEND = 0
+RECV = 1
+
+NONCE_SIZE = 16
+SECRET_SIZE = 32
+# cipher suite assumed for a peer whose hello offers none
+LEGACY_SUITE = "blowfish-cbc"
+
+# flag byte in front of the plaintext of links with a codec
+RAW        = "\000"
+COMPRESSED = "\001"
+
+
+class BlowfishCbc:
+    """ Legacy suite. The CBC state carries over from one message to the
+        next, so messages never reuse an IV. """
+    key_size = 16
+
+    def __init__(self, key, iv):
+        self.cipher = Blowfish.new( key, Blowfish.MODE_CBC, iv[:Blowfish.block_size] )
+
+    def seal(self, parts):
+        """ returns (list of encrypted chunks, padding size) of the joined
+            parts, only the last partial block is copied to be padded """
+        payload = wireCodec.join( parts )
+        padsize = Blowfish.block_size - len(payload) % Blowfish.block_size
+        whole = len(payload) - len(payload) % Blowfish.block_size
+        chunks = []
+        if whole:
+            chunks.append( self.cipher.encrypt( memoryview(payload)[:whole] ) )
+        chunks.append( self.cipher.encrypt( payload[whole:] + "\000" * padsize ) )
+        return (chunks, padsize)
+
+    def open(self, e_data, padsize):
+        data = self.cipher.decrypt( memoryview(e_data) )
+        return buffer( data, 0, len(data) - padsize )
+
+
+class LegacyBlowfish:
+    """ Framing of the legacy handshake. Every message is encrypted with a
+        new CBC cipher from the same key and iv and padded with 1 to 8 zero
+        bytes, as those nodes expect. """
+
+    def __init__(self, key, iv):
+        self.key = key
+        self.iv = iv
+
+    def seal(self, parts):
+        payload = wireCodec.join( parts )
+        padsize = Blowfish.block_size - len(payload) % Blowfish.block_size
+        cipher = Blowfish.new( self.key, Blowfish.MODE_CBC, self.iv )
+        return ([cipher.encrypt( payload + "\000" * padsize )], padsize)
+
+    def open(self, e_data, padsize):
+        cipher = Blowfish.new( self.key, Blowfish.MODE_CBC, self.iv )
+        data = cipher.decrypt( memoryview(e_data) )
+        return buffer( data, 0, len(data) - padsize )
+
+
+def legacy_encrypt( pub_key, data ):
+    "the unpadded RSA the legacy handshake uses, as PyCrypto 2 returned it"
+    return (long_to_bytes( pow( bytes_to_long(data), pub_key.e, pub_key.n ) ),)
+
+def legacy_decrypt( key, ciphertext ):
+    if type(ciphertext) is tuple:
+        ciphertext = ciphertext[0]
+    return long_to_bytes( pow( bytes_to_long(ciphertext), key.d, key.n ) )
+
+
+class _Aead:
+    """ Authenticated suites. Both ends count the messages sent in one
+        direction, the count is the nonce so it never goes on the wire. """
+    TAG_SIZE = 16
+
+    def __init__(self, key, iv):
+        self.key = key
+        self.counter = 0
+
+    def _cipher(self):
+        self.counter += 1
+        return self.new( struct.pack('>4xQ', self.counter) )
+
+    def seal(self, parts):
+        "encrypts the parts one after the other, no part is copied"
+        cipher = self._cipher()
+        chunks = []
+        for part in parts:
+            if type(part) is buffer:
+                part = memoryview( part )
+            chunks.append( cipher.encrypt( part ) )
+        chunks.append( cipher.digest() )
+        return (chunks, 0)
+
+    def open(self, e_data, padsize):
+        e_data = memoryview( e_data )
+        tag = e_data[-self.TAG_SIZE:]
+        try:
+            return self._cipher().decrypt_and_verify( e_data[:-self.TAG_SIZE], tag )
+        except ValueError:
+            raise socket.error, "message authentication failed"
+
+
+class AesGcm( _Aead ):
+    key_size = 16
+
+    def new(self, nonce):
+        return AES.new( self.key, AES.MODE_GCM, nonce=nonce )
+
+
+class ChaCha20Poly1305( _Aead ):
+    key_size = 32
+
+    def new(self, nonce):
+        return ChaCha20_Poly1305.new( key=self.key, nonce=nonce )
+
+
+# suites this node can use, pycrypto lacks the AEAD ones
+SUITES = {LEGACY_SUITE: BlowfishCbc}
+if hasattr(AES, 'MODE_GCM'):
+    SUITES["aes-gcm"] = AesGcm
+try:
+    from Crypto.Cipher import ChaCha20_Poly1305
+    SUITES["chacha20-poly1305"] = ChaCha20Poly1305
+except ImportError:
+    pass
+
+# bytes of compressed input handed to the bz2 decompressor at a time, one
+# call expands its input by a block (at most ~46 MB) at worst
+BZ2_CHUNK = 64
+
+def _too_large( limit ):
+    raise framing.FrameTooLarge, "payload decompresses to more than %d bytes" % limit
+
+def zlib_decompress( data, limit ):
+    "data decompressed, FrameTooLarge if that is more than limit bytes"
+    d = zlib.decompressobj()
+    out = d.decompress( data, limit + 1 )
+    if len(out) > limit:
+        _too_large( limit )
+    return out
+
+def bz2_decompress( data, limit ):
+    "data decompressed a chunk at a time, stopping once it exceeds limit"
+    d = bz2.BZ2Decompressor()
+    out = []
+    size = 0
+    for pos in xrange( 0, len(data), BZ2_CHUNK ):
+        chunk = d.decompress( data[pos:pos+BZ2_CHUNK] )
+        size += len(chunk)
+        if size > limit:
+            _too_large( limit )
+        out.append( chunk )
+    return "".join( out )
+
+# compression codecs, name -> (compress, decompress( data, limit ))
+CODECS = {
+    "zlib": (lambda data: zlib.compress( data, config.CompressLevel ),
+             zlib_decompress),
+    "bz2":  (bz2.compress, bz2_decompress)
+}
+
+def offered_codecs():
+    return [name for name in config.Compression if name in CODECS]
+
+def choose_codec( offered ):
+    "the first codec of ours the other side offered, None for no compression" 
+    for name in offered_codecs():
+        if name in (offered or []):
+            return name
+    return None
+
+def offered_suites():
+    return [name for name in config.CipherSuites if name in SUITES]
+
+def choose_suite( offered ):
+    "the first suite of ours the other side offered" 
+    if not offered:
+        return LEGACY_SUITE
+    for name in offered_suites():
+        if name in offered:
+            return name
+    raise socket.error, "no cipher suite in common with %s" % str(offered)
+
+
+_identity_lock = threading.Lock()
+_identity_key = None
+
+def identity_key():
+    "the RSA key pair of this node, created or loaded on first use"
+    global _identity_key
+
+    with _identity_lock:
+        if _identity_key is None:
+            path = config.IdentityKeyFile
+            if path and os.path.exists( path ):
+                f = open( path )
+                try:
+                    _identity_key = RSA.importKey( f.read() )
+                finally:
+                    f.close()
+            else:
+                Logger.info("generating node identity key")
+                _identity_key = RSA.generate( 1024, Random.new().read )
+                if path:
+                    # the private key, readable by this user only
+                    fd = os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600 )
+                    f = os.fdopen( fd, "w" )
+                    try:
+                        f.write( _identity_key.exportKey() )
+                    finally:
+                        f.close()
+        return _identity_key
+
+
+class SessionCache:
+    """ Secrets of completed handshakes, bounded to config.SessionCacheSize
+        entries (least recently used go first) that expire after
+        config.SessionLifetime seconds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def put(self, key, value):
+        with self.lock:
+            self.sessions.pop( key, None )
+            self.sessions[key] = (time.time() + config.SessionLifetime, value)
+            while len(self.sessions) > config.SessionCacheSize:
+                self.sessions.popitem( last=False )
+
+    def get(self, key):
+        with self.lock:
+            entry = self.sessions.pop( key, None )
+            if entry is None or entry[0] < time.time():
+                return None
+            self.sessions[key] = entry
+            return entry[1]
+
+    def discard(self, key):
+        with self.lock:
+            self.sessions.pop( key, None )
+
+# initiator side: peer -> (session id, secret)
+ClientSessions = SessionCache()
+# initiator side: peer -> True for peers that answered with the legacy
+# handshake, forgotten after config.SessionLifetime in case they upgrade
+LegacyPeers = SessionCache()
+# responder side: session id -> secret
+ServerSessions = SessionCache()
+
+
+def derive_cyphers( secret, nonce_c, nonce_s, suite ):
+    """ cipher contexts for initiator->responder and responder->initiator
+        traffic, fresh for every connection because of the nonces """
+    def kdf( label, size ):
+        return hashlib.sha256( label + secret + nonce_c + nonce_s ).digest()[:size]
+    cls = SUITES[suite]
+    return (cls( kdf("c2s key", cls.key_size), kdf("c2s iv", 16) ),
+            cls( kdf("s2c key", cls.key_size), kdf("s2c iv", 16) ))
+
+class LegacyPeer( socket.error ):
+    "the peer answered the hello with the legacy handshake, connect again"
+    pass
+
+
 class SecureLink:
 
     def __init__(self, name=None):
         self.send_cypher = None
         self.recv_cypher = None
+        self.suite = None
+        self.codec = None
+        self.resumed = False
+        # set up by the legacy handshake, see LegacyBlowfish
+        self.legacy = False
+        # plaintext bytes before and after compression, sent and received
+        self.raw_sent = 0
+        self.wire_sent = 0
+        self.raw_recv = 0
+        self.wire_recv = 0
         if name:
             self.name = name
         else:
             self.name = "noname_%ld" % id(self) 
+        peer = name or "unnamed"
+        self.frames_sent = metrics.Registry.counter( "malib_link_frames_sent_total",
+            "secure frames sent", peer=peer )
+        self.bytes_sent = metrics.Registry.counter( "malib_link_bytes_sent_total",
+            "bytes of secure frames sent", peer=peer )
+        self.frames_recv = metrics.Registry.counter( "malib_link_frames_received_total",
+            "secure frames received", peer=peer )
+        self.bytes_recv = metrics.Registry.counter( "malib_link_bytes_received_total",
+            "bytes of secure frames received", peer=peer )
 
-    def send(self, conn, obj):
-        
-        payload = marshal.dumps( obj )
-        (bf_key,iv) = self.send_cypher
-        cipher = Blowfish.new(bf_key, Blowfish.MODE_CBC, iv)
-        pad = "\000" * (8 - (len(payload) % 8))
-        payload += pad
-        e_payload = cipher.encrypt( payload )
+    def frame(self, obj):
+        "encrypt obj into a secure frame, returned as a list of parts" 
+        if self.legacy:
+            # legacy nodes know nothing of out of band data
+            parts = [marshal.dumps( obj )]
+        else:
+            parts = wireCodec.dumps( obj )
+        if self.codec is None:
+            (chunks, padsize) = self.send_cypher.seal( parts )
+        else:
+            flag = RAW
+            size = wireCodec.size( parts )
+            self.raw_sent += size
+            if size >= config.CompressThreshold:
+                packed = CODECS[self.codec][0]( wireCodec.join(parts) )
+                if len(packed) < size:
+                    (flag, parts, size) = (COMPRESSED, [packed], len(packed))
+            self.wire_sent += size
+            (chunks, padsize) = self.send_cypher.seal( [flag] + parts )
+        size = sum( len(c) for c in chunks )
+        self.frames_sent.inc()
+        self.bytes_sent.inc( size + SECURE_HDR_SIZE )
  
-        Logger.debug("send: %d %d" % (len(e_payload), len(pad)))
-        packet = struct.pack('>IB', len(e_payload), len(pad) ) + e_payload
-        conn.sendall( packet )
+        Logger.debug("send: %d %d" % (size, padsize))
+        return [struct.pack(SECURE_HDR, size, padsize )] + chunks
+
+    def pack(self, obj):
+        return "".join( self.frame(obj) )
+
+    def unpack(self, padsize, e_data):
+        "decrypt the payload of a secure frame" 
+        self.frames_recv.inc()
+        self.bytes_recv.inc( len(e_data) + SECURE_HDR_SIZE )
+        plain = self.recv_cypher.open( e_data, padsize )
+        if self.codec is None:
+            return wireCodec.loads( plain )
+        payload = buffer( plain, 1 )
+        self.wire_recv += len(payload)
+        if plain[0] == COMPRESSED:
+            # no bigger than an uncompressed frame could be
+            payload = CODECS[self.codec][1]( payload, config.MaxFrameSize )
+        self.raw_recv += len(payload)
+        return wireCodec.loads( payload )
+
+    def stats(self):
+        "negotiated suite and codec and the bytes compression saved" 
+        return {
+            'suite': self.suite,
+            'codec': self.codec,
+            'resumed': self.resumed,
+            'raw_sent': self.raw_sent,
+            'wire_sent': self.wire_sent,
+            'saved_sent': self.raw_sent - self.wire_sent,
+            'raw_recv': self.raw_recv,
+            'wire_recv': self.wire_recv,
+            'saved_recv': self.raw_recv - self.wire_recv
+        }
+
+    def send(self, conn, obj):
+        framing.send_parts( conn, self.frame(obj) )
 
     def recv(self, conn):
-        def _get_chunk( size ):
-            buf = "".encode()
-            while len(buf) < size:
-                x = conn.recv( size - len(buf) )
-                if len(x) == 0:
-                    raise socket.error, "Unexpect disconnect"    
-                buf += x
-            return buf
-
-        hdr = _get_chunk( struct.calcsize('>IB') )
-        Logger.debug("recv: %s" % repr(hdr))
-        (size,padsize) = struct.unpack('>IB', hdr)
+        ((size,padsize), e_data) = framing.recv_frame( conn, SECURE_HDR )
         Logger.debug("recv: %d %d" % (size, padsize))
-        e_data = _get_chunk(  size )
-        (bf_key,iv) = self.recv_cypher
-        cipher = Blowfish.new(bf_key, Blowfish.MODE_CBC, iv)
-        data = cipher.decrypt( e_data ) 
-        return marshal.loads( data[:-padsize] )
+        return self.unpack( padsize, e_data )
 
+    def decode(self, reader):
+        """ Event driven counterpart of recv()/_recv(). Decodes the next
+            frame buffered in reader (a framing.FrameReader), handshake
+            frames until setup has completed and secure frames afterwards.
+            Returns (True, obj) or (False, None) if no frame is complete.
+        """
+        if self.recv_cypher is None:
+            frame = reader.frame( PLAIN_HDR, MAX_HANDSHAKE_FRAME )
+            if frame is None:
+                return (False, None)
+            return (True, marshal.loads( frame[1] ))
+        frame = reader.frame( SECURE_HDR )
+        if frame is None:
+            return (False, None)
+        return (True, self.unpack( frame[0][1], frame[1] ))
 
+    def _pack(self, obj):
+        payload = marshal.dumps( obj )
+        return struct.pack(PLAIN_HDR,len(payload)) + payload
 
     def _send(self, conn, obj):
-        payload = marshal.dumps( obj )
-        packet = struct.pack('>I',len(payload)) + payload
-        conn.sendall( packet )
+        conn.sendall( self._pack(obj) )
 
 
     def _recv(self, conn):
-        def _get_chunk( size ):
-            buf = "".encode()
-            while len(buf) < size:
-                x = conn.recv( size - len(buf) )
-                if len(x) == 0:
-                    raise socket.error, "Unexpect disconnect"    
-                buf += x
-            return buf
-        hdr = _get_chunk( struct.calcsize('>I') )
-        size = struct.unpack('>I', hdr)[0]
-        data = _get_chunk( size )
+        (_hdr, data) = framing.recv_frame( conn, PLAIN_HDR, MAX_HANDSHAKE_FRAME )
         return marshal.loads( data )
 
         
 
-    def setup(self, conn ):
-        """
-        create pub/priv/cipher
-
-        send pub to other
-        get pub from other
+    def setup(self, conn, initiator=False, peer=None ):
+        "run the handshake over a blocking connection" 
+        steps = self.handshake( initiator, peer )
+        reply = None
+        try:
+            while True:
+                (op, obj) = steps.send( reply )
+                reply = None
+                if op == SEND:
+                    self._send( conn, obj )
+                else:
+                    reply = self._recv( conn )
+        except StopIteration:
+            pass
 
-        encrypt our cipher with other_pub and send back
-        receive other cipher and decrypt
+    def handshake(self, initiator=False, peer=None):
         """
+        initiator                        responder
+        ('hello', {nonce, session,
+                   suites, codecs})  ->
+                                     <-  ('resume', {nonce, suite, codec})
+                                         or ('full', {nonce, suite, codec,
+                                                      pubkey, session})
+        ('key', {secret encrypted
+                 with pubkey})       ->  (full handshake only)
 
+        The initiator is the side that connected, peer names the other end
+        (its address) to look up a session to resume. This is a coroutine
+        so it can be driven by a blocking socket, see setup(), or by an
+        event loop. It yields (SEND, obj) to have a handshake frame sent
+        and (RECV, None) to be sent the next frame received from the other
+        side.
+        """
         Logger.debug("entering setup")
+        if initiator:
+            if peer is not None and LegacyPeers.get( peer ):
+                return self._legacy( None, time.time() )
+            return self._initiate( peer )
+        return self._respond()
 
-        random_generator = Random.new().read
-        # temporary key pair just to encyript the blowfish cyphers
-        private_key = RSA.generate( 1024, random_generator )
-        public_key = private_key.publickey()
-        
-        bs = Blowfish.block_size
-        bf_key = uuid.uuid1().hex
-        iv = Random.new().read(bs)
-
-        # precalculated information for cypher   
-        self.send_cypher = (bf_key,iv) 
-
-        # send the our pubkey so the other peer can encrypt its
-        # cipher information and send it to us.
-        Logger.debug("%s: exporting public key to remote host" % self.name)
-        self._send( conn, public_key.exportKey() ) 
-
-        # get the other's pubkey so we can encrypt our cipher
-        # info.
-        other_pub_key = RSA.importKey( self._recv(conn) )
-        Logger.debug("%s: sending cypher bf=%s iv=%s" % (self.name,bf_key,iv))
-        self._send( conn, (other_pub_key.encrypt(bf_key,0),other_pub_key.encrypt(iv,0)) )
-        
-        (e_other_bf,e_other_iv) = self._recv( conn )
-        Logger.debug("%s: receiving cypher information" % self.name)
- 
-        other_bf = private_key.decrypt(e_other_bf)
-        other_iv = private_key.decrypt(e_other_iv) 
-        Logger.debug("%s: receiving cypher bf=%s iv=%s" % (self.name,other_bf,other_iv))
-        
-        self.recv_cypher = (other_bf,other_iv)
+    def _initiate(self, peer):
+        started = time.time()
+        nonce_c = os.urandom( NONCE_SIZE )
+        session = ClientSessions.get( peer )
+        hello = {'nonce': nonce_c, 'session': None, 'suites': offered_suites(),
+                 'codecs': offered_codecs()}
+        if session:
+            hello['session'] = session[0]
+        yield (SEND, ('hello', hello))
+
+        reply = yield (RECV, None)
+        if type(reply) is str:
+            # it has already given up on the hello
+            if peer is not None:
+                LegacyPeers.put( peer, True )
+            raise LegacyPeer, "%s speaks the legacy handshake" % str(peer)
+        (kind, reply) = reply
+        if kind == 'resume' and session:
+            Logger.debug("%s: resuming session with %s" % (self.name,str(peer)))
+            secret = session[1]
+            self.resumed = True
+        else:
+            # full handshake, send a new secret under the responder's key
+            secret = os.urandom( SECRET_SIZE )
+            pub_key = PKCS1_OAEP.new( RSA.importKey( reply['pubkey'] ) )
+            yield (SEND, ('key', {'secret': pub_key.encrypt( secret )}))
+            ClientSessions.put( peer, (reply['session'], secret) )
+            Logger.debug("%s: new session with %s" % (self.name,str(peer)))
+
+        self.suite = reply.get( 'suite', LEGACY_SUITE )
+        self.codec = reply.get( 'codec' )
+        (self.send_cypher, self.recv_cypher) = derive_cyphers( secret,
+            nonce_c, reply['nonce'], self.suite )
+        self._handshake_done( "initiator", started )
+
+    def _respond(self):
+        hello = yield (RECV, None)
+        # timed from the hello, a responder may wait long for it
+        started = time.time()
+        if type(hello) is str:
+            # the public key a legacy node opens with
+            steps = self._legacy( hello, started )
+            reply = None
+            while True:
+                try:
+                    step = steps.send( reply )
+                except StopIteration:
+                    return
+                reply = yield step
+        (kind, hello) = hello
+        if kind != 'hello':
+            raise socket.error, "handshake expected hello, got %s" % str(kind)
+        nonce_c = hello['nonce']
+        nonce_s = os.urandom( NONCE_SIZE )
+        self.suite = choose_suite( hello.get('suites') )
+        self.codec = choose_codec( hello.get('codecs') )
+
+        secret = None
+        if hello.get('session'):
+            secret = ServerSessions.get( hello['session'] )
+        if secret:
+            Logger.debug("%s: resuming session" % self.name)
+            self.resumed = True
+            yield (SEND, ('resume', {'nonce': nonce_s, 'suite': self.suite,
+                                     'codec': self.codec}))
+        else:
+            session_id = uuid.uuid4().hex
+            private_key = identity_key()
+            yield (SEND, ('full', {
+                'nonce': nonce_s,
+                'suite': self.suite,
+                'codec': self.codec,
+                'pubkey': private_key.publickey().exportKey(),
+                'session': session_id
+            }))
+            (kind, key) = yield (RECV, None)
+            if kind != 'key':
+                raise socket.error, "handshake expected key, got %s" % str(kind)
+            secret = PKCS1_OAEP.new( private_key ).decrypt( key['secret'] )
+            ServerSessions.put( session_id, secret )
 
+        (self.recv_cypher, self.send_cypher) = derive_cyphers( secret,
+            nonce_c, nonce_s, self.suite )
+        self._handshake_done( "responder", started )
         # each side now has an identical blowfish cypher for further communication.
+
+    def _legacy(self, pem, started):
+        """ the handshake of nodes from before the negotiation: both sides
+            send their public key and then a blowfish key and iv encrypted
+            under the other's. The key sent here is the identity key. pem
+            is the key the other side opened with, None when this side
+            connected and opens. """
+        Logger.info("%s: legacy handshake" % self.name)
+        role = "responder"
+        if pem is None:
+            role = "initiator"
+        else:
+            other_pub_key = self._legacy_key( pem )
+        private_key = identity_key()
+        yield (SEND, private_key.publickey().exportKey())
+        if pem is None:
+            other_pub_key = self._legacy_key( (yield (RECV, None)) )
+
+        bf_key = uuid.uuid4().hex
+        iv = os.urandom( Blowfish.block_size )
+        while iv[0] == "\000":
+            # the legacy rsa drops leading zero bytes
+            iv = os.urandom( Blowfish.block_size )
+        yield (SEND, (legacy_encrypt( other_pub_key, bf_key ),
+                      legacy_encrypt( other_pub_key, iv )))
+
+        reply = yield (RECV, None)
+        try:
+            (e_other_bf, e_other_iv) = reply
+        except (ValueError, TypeError):
+            raise socket.error, "legacy handshake expected the cypher"
+        other_bf = legacy_decrypt( private_key, e_other_bf )
+        other_iv = legacy_decrypt( private_key, e_other_iv ).rjust( Blowfish.block_size, "\000" )
+
+        self.legacy = True
+        self.suite = "blowfish-legacy"
+        self.codec = None
+        self.send_cypher = LegacyBlowfish( bf_key, iv )
+        self.recv_cypher = LegacyBlowfish( other_bf, other_iv )
+        self._handshake_done( role, started )
+
+    def _legacy_key(self, pem):
+        try:
+            return RSA.importKey( pem )
+        except (ValueError, IndexError, TypeError):
+            raise socket.error, "handshake expected hello or a public key"
+
+    def _handshake_done(self, role, started):
+        metrics.Registry.histogram( "malib_handshake_seconds",
+            "time to set up a secure link", role=role,
+            resumed=self.resumed ).observe( time.time() - started )
         
 
 def unittest():
-    import thread, time
-    Logger.basicConfig( filename="/dev/stdout", level=Logger.DEBUG )
+    import thread, tempfile
+    logging.basicConfig( filename="/dev/stdout", level=logging.INFO )
 
     Logger.debug( "unittest" )
  
@@ -143,6 +653,7 @@ def unittest():
         Logger.debug( "test_server" )
         
         s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
         s.bind( ('',2115) )
         s.listen(5)
         (conn,saddr) = s.accept()
@@ -159,14 +670,163 @@ def unittest():
      
     s.connect( ('',2115) )
     sl = SecureLink()
-    sl.setup( s )
+    sl.setup( s, initiator=True, peer=('',2115) )
     sl.send( s, "hello again" )
 
     time.sleep(1) 
     s.shutdown( socket.SHUT_RDWR )
 
+    def pair( initiator, responder, peer ):
+        "a socketpair with a handshake run over it"
+        a, b = socket.socketpair()
+        t = threading.Thread( target=responder.setup, args=(b,) )
+        t.start()
+        initiator.setup( a, initiator=True, peer=peer )
+        t.join()
+        return (a, b)
+
+    def echo( sender, a, receiver, b, obj ):
+        "obj as receiver got it, sent in a thread of its own"
+        t = threading.Thread( target=sender.send, args=(a, obj) )
+        t.start()
+        try:
+            return receiver.recv( b )
+        finally:
+            t.join()
+
+    saved = (config.CipherSuites, config.Compression, config.MaxFrameSize)
+    try:
+        big = ("evt", "z" * 200000, os.urandom( 1000 ))
+        for suite in SUITES:
+            for codec in [None] + CODECS.keys():
+                config.CipherSuites = [suite]
+                config.Compression = [codec] if codec else []
+                peer = ('unittest', suite, codec)
+                (c, r) = (SecureLink(), SecureLink())
+                (a, b) = pair( c, r, peer )
+                assert c.suite == r.suite == suite and c.codec == r.codec == codec
+                assert echo( c, a, r, b, big ) == big and echo( r, b, c, a, "back" ) == "back"
+                assert echo( c, a, r, b, big ) == big, "cipher state carries over"
+                (c2, r2) = (SecureLink(), SecureLink())
+                (a2, b2) = pair( c2, r2, peer )
+                assert c2.resumed and r2.resumed, "session resumed"
+                assert echo( c2, a2, r2, b2, "again" ) == "again"
+                for conn in (a, b, a2, b2):
+                    conn.close()
+
+        # a small frame may not decompress to more than MaxFrameSize
+        config.CipherSuites = saved[0]
+        config.Compression = ["zlib"]
+        config.MaxFrameSize = 1 << 20
+        (c, r) = (SecureLink(), SecureLink())
+        (a, b) = pair( c, r, None )
+        try:
+            echo( c, a, r, b, "\000" * (4 << 20) )
+            assert False, "decompression bomb accepted"
+        except framing.FrameTooLarge:
+            pass
+        a.close()
+        b.close()
+    finally:
+        (config.CipherSuites, config.Compression, config.MaxFrameSize) = saved
+
+    # a generated identity key is saved readable by its owner only
+    global _identity_key
+    (key, path) = (_identity_key, config.IdentityKeyFile)
+    config.IdentityKeyFile = os.path.join( tempfile.mkdtemp(), "identity" )
+    try:
+        _identity_key = None
+        identity_key()
+        assert os.stat( config.IdentityKeyFile ).st_mode & 0777 == 0600
+        os.unlink( config.IdentityKeyFile )
+        os.rmdir( os.path.dirname(config.IdentityKeyFile) )
+    finally:
+        (_identity_key, config.IdentityKeyFile) = (key, path)
+
+    # a legacy node opens with its key, whichever side connected
+    def legacy_node( conn ):
+        link = SecureLink()
+        steps = link._legacy( None, time.time() )
+        reply = None
+        try:
+            while True:
+                (op, obj) = steps.send( reply )
+                reply = None
+                if op == SEND:
+                    link._send( conn, obj )
+                else:
+                    reply = link._recv( conn )
+        except StopIteration:
+            pass
+        return link
+    peer = ('unittest', 'legacy')
+    a, b = socket.socketpair()
+    t = threading.Thread( target=_quietly, args=(legacy_node, b) )
+    t.start()
+    try:
+        SecureLink().setup( a, initiator=True, peer=peer )
+        assert False, "a legacy responder was taken for a current one"
+    except LegacyPeer:
+        pass
+    t.join()
+    a.close()
+    b.close()
+
+    a, b = socket.socketpair()
+    got = []
+    t = threading.Thread( target=lambda: got.append( legacy_node( b ) ) )
+    t.start()
+    c = SecureLink()
+    c.setup( a, initiator=True, peer=peer )
+    t.join()
+    assert c.suite == "blowfish-legacy"
+    assert echo( c, a, got[0], b, ("hi", 1) ) == ("hi", 1)
+    assert echo( got[0], b, c, a, "reply" ) == "reply"
+    a.close()
+    b.close()
+
+    r = SecureLink()
+    a, b = socket.socketpair()
+    t = threading.Thread( target=lambda: got.append( legacy_node( a ) ) )
+    t.start()
+    r.setup( b )
+    t.join()
+    assert r.suite == "blowfish-legacy" and echo( got[1], a, r, b, "in" ) == "in"
+    a.close()
+    b.close()
+    print "p2pp unittest passed"
+
+def _quietly( func, *args ):
+    "func(*args), a socket.error is expected"
+    try:
+        return func( *args )
+    except socket.error:
+        return None
+
+def benchmark( size=65536, seconds=1.0 ):
+    "seal+open throughput of every available suite in MB/s"
+    payload = os.urandom( size )
+    results = {}
+    for (name, cls) in sorted(SUITES.items()):
+        key, iv = os.urandom( cls.key_size ), os.urandom( 16 )
+        sealer, opener = cls( key, iv ), cls( key, iv )
+        n = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            (chunks, padsize) = sealer.seal( [payload] )
+            opener.open( "".join(chunks), padsize )
+            n += 1
+        results[name] = n * size / (time.time() - start) / (1024 * 1024)
+    return results
+
 if __name__ == '__main__':
-    unittest()
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        for (name, mbps) in sorted(benchmark().items()):
+            print "%-20s %8.1f MB/s" % (name, mbps)
+    else:
+        unittest()
            
                 
 
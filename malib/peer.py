@@ -1,17 +1,122 @@
 import agentController
+import shardedController
 import config
 import p2pp
+import framing
+import codeStore
+import wireCodec
+import metrics
 import SocketServer
 import socket
 import threading
 import Api
 import logging
 import traceback
+import select
+import time
 from pubsub import pub
 
 Logger = logging.getLogger('malib')
 
 
+class LinkDispatcher:
+    """ Acts on the messages received over one inbound peer link. reply
+        sends a message back to the peer over the same link, it is used
+        to fetch code a HOST_AGENT_REF refers to that is not in the
+        codeStore. Agents waiting for their code are kept in pending,
+        expire() asks again for code that is overdue and in the end gives
+        up on it. local is the address the link arrived at, a relayed
+        event is not passed on to it.
+    """
+    def __init__(self, api, agentCtrl, reply, local=None):
+        self.api = api
+        self.agentCtrl = agentCtrl
+        self.reply = reply
+        self.local = local
+        # code hash -> briefcases of the agents waiting for CODE_PUT
+        self.pending = {}
+        # code hash -> (time of the last CODE_FETCH, fetches sent)
+        self.fetches = {}
+
+    def hostAgent(self, code, briefcase):
+        valid = True
+        if hasattr(self.api,"codeIsValid"):        
+            if not codeStore.Store.isValid( self.api, code ):
+                valid = False
+                Logger.warning("codeIsValid failed") 
+        else:
+            codeStore.Store.put( code )
+
+        if valid:
+            self.agentCtrl.hostTheAgent( code, briefcase )
+
+    def hostAgentRef(self, codeHash, briefcase):
+        code = codeStore.Store.get( codeHash )
+        if code is not None:
+            self.hostAgent( code, briefcase )
+            return
+        if codeHash not in self.pending:
+            self.pending[codeHash] = []
+            self._fetch( codeHash, 1 )
+        self.pending[codeHash].append( briefcase )
+
+    def _fetch(self, codeHash, tries):
+        Logger.info("fetching code %s" % codeHash)
+        self.fetches[codeHash] = (time.time(), tries)
+        self.reply( (Api.CODE_FETCH, codeHash) )
+
+    def expire(self, now):
+        """ fetch code again whose CODE_PUT is Api.CODE_FETCH_TIMEOUT
+            overdue, the agents waiting for it are dropped after
+            Api.CODE_FETCH_TRIES fetches """
+        for (codeHash, (sent, tries)) in self.fetches.items():
+            if now - sent < Api.CODE_FETCH_TIMEOUT:
+                continue
+            if tries < Api.CODE_FETCH_TRIES:
+                self._fetch( codeHash, tries + 1 )
+                continue
+            del self.fetches[codeHash]
+            briefcases = self.pending.pop( codeHash, [] )
+            Logger.error("peer never sent code %s, dropping %d agents" % (codeHash, len(briefcases)))
+
+    def codePut(self, codeHash, code):
+        if codeStore.digest( code ) != codeHash:
+            Logger.error("peer sent code that does not match %s" % codeHash)
+            return
+        self.fetches.pop( codeHash, None )
+        for briefcase in self.pending.pop( codeHash, [] ):
+            self.hostAgent( code, briefcase )
+
+    def dispatch(self, args):
+        "act on a message received from a peer" 
+        Logger.debug("handle request %s" % str(args)) 
+        msgType = args[0]
+        
+        if msgType == Api.HOST_AGENT:
+            _p1, code, briefcase = args
+            self.hostAgent( wireCodec.detach( code ), briefcase )
+        elif msgType == Api.HOST_AGENT_REF:
+            _p1, codeHash, briefcase = args
+            self.hostAgentRef( codeHash, briefcase )
+        elif msgType == Api.CODE_PUT:
+            _p1, codeHash, code = args
+            self.codePut( codeHash, wireCodec.detach( code ) )
+        elif msgType == Api.MULTI_MESSAGE:
+            for msg in args[1]:
+                self.dispatch( msg )
+        elif msgType == Api.RELAY_EVENT:
+            _p1, msgid, event, evt_args, route = args
+            if Api.SeenIds.seen( msgid ):
+                return
+            self.agentCtrl.multicastEvent( event, *evt_args )
+            Api.sendRelay( msgid, event, evt_args, route, self.local )
+        elif msgType == Api.BROADCAST_EVENT:
+            _p1, event, evt_args = args
+            self.agentCtrl.multicastEvent( event, *evt_args )
+        else:
+            Logger.error("Unknown message type %s" % str(msgType)) 
+
+
 class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
 
     def onShutdown(self):
@@ -24,8 +129,11 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
     def setup(self):
         pub.subscribe(self.onShutdown, "sys-shutdown")
         self.running = True
-        self.sl = p2pp.SecureLink()
+        # links are named after the remote host, client ports are ephemeral
+        self.sl = p2pp.SecureLink( self.client_address[0] )
         self._addr = self.request.getsockname()
+        self.dispatcher = LinkDispatcher( self.api, self.agentCtrl,
+            lambda msg: self.sl.send( self.request, msg ), self._addr )
   
         allowed = True
         if hasattr(self.api,"addressIsAllowed"):
@@ -38,33 +146,20 @@ class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
         else:
             self.request.shutdown( socket.SHUT_RDWR ) 
 
-    def _handle_host_agent(self, code, briefcase):
-        valid = True
-        if hasattr(self.api,"codeIsValid"):        
-            if not self.api.codeIsValid( code ):
-                valid = False
-                Logger.warning("codeIsValid failed") 
-
-        if valid:
-            self.agentCtrl.hostTheAgent( code, briefcase )
-
     def _handle(self):        
+        if self.dispatcher.fetches:
+            # don't block on the link while code fetches may expire
+            ready, _p1, _p2 = select.select( [self.request], [], [], 1 )
+            self.dispatcher.expire( time.time() )
+            if not ready:
+                return
         try: 
             args = self.sl.recv( self.request )
         except socket.error:
+            self.running = False
             return
   
-        Logger.debug("handle request %s" % str(args)) 
-        msgType = args[0]
-        
-        if msgType == Api.HOST_AGENT:
-            _p1, code, briefcase = args
-            self._handle_host_agent( code, briefcase )
-        elif msgType == Api.BROADCAST_EVENT:
-            _p1, event, evt_args = args
-            self.agentCtrl.multicastEvent( event, *evt_args )
-        else:
-            Logger.error("Unknown message type %s" % str(msgType)) 
+        self.dispatcher.dispatch( args )
 
     def handle(self):        
         try:
@@ -78,26 +173,190 @@ class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     pass
 
 
+class _PeerLink:
+    "state of one inbound connection served by EventLoopServer"
+
+    def __init__(self, conn, host):
+        self.conn = conn
+        self.dispatcher = None
+        self.sl = p2pp.SecureLink( host )
+        self.steps = self.sl.handshake()
+        self.reader = framing.FrameReader()
+        self.outbuf = ""
+        self.closed = False
+
+
+class EventLoopServer:
+    """ Single threaded alternative to ThreadedTCPServer. All inbound peer
+        links are multiplexed on one Poller, the SecureLink handshake runs
+        as a coroutine per link and received frames are dispatched to the
+        agent controller as they complete, so an idle link costs a socket
+        and a few buffers rather than a thread. Has the serve_forever,
+        shutdown and server_close methods Peer uses on ThreadedTCPServer.
+    """
+    def __init__(self, addr, api, agentCtrl):
+        self.api = api
+        self.agentCtrl = agentCtrl
+        self.socket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.socket.bind( addr )
+        self.socket.listen( config.PeerRequestQueueSize )
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+
+        self.poller = agentController.Poller()
+        self.links = {}
+        self.running = False
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        self.running = True
+        lfd = self.socket.fileno()
+        self.poller.register( lfd )
+        try:
+            while self.running:
+                for (fd, mask) in self.poller.poll( 0.5 ):
+                    if fd == lfd:
+                        self._accept()
+                        continue
+                    link = self.links.get( fd )
+                    if link and mask & agentController.WRITE:
+                        self._flush( link )
+                    # _flush may have closed the link
+                    if link and not link.closed and mask & agentController.READ:
+                        self._read( link )
+                now = time.time()
+                for link in self.links.values():
+                    if link.dispatcher.fetches:
+                        link.dispatcher.expire( now )
+        finally:
+            for link in self.links.values():
+                self._close( link )
+            self.poller.unregister( lfd )
+            self.stopped.set()
+
+    def shutdown(self):
+        self.running = False
+        self.stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.poller.close()
+
+    def _accept(self):
+        try:
+            conn, remote = self.socket.accept()
+        except socket.error:
+            return
+        addr = conn.getsockname()
+        if hasattr(self.api,"addressIsAllowed"):
+            if not self.api.addressIsAllowed( addr ):
+                conn.close()
+                return
+        conn.setblocking(0)
+        link = _PeerLink( conn, remote[0] )
+        link.dispatcher = LinkDispatcher( self.api, self.agentCtrl,
+            lambda msg: self._reply( link, msg ), addr )
+        self.links[conn.fileno()] = link
+        self.poller.register( conn.fileno() )
+        Logger.info("starting handshake with %s" % str(addr))
+        self._advance( link, None )
+
+    def _advance(self, link, reply):
+        "run the handshake coroutine until it waits for the other side" 
+        try:
+            while True:
+                (op, obj) = link.steps.send( reply )
+                reply = None
+                if op == p2pp.RECV:
+                    break
+                link.outbuf += link.sl._pack( obj )
+        except StopIteration:
+            link.steps = None
+            Logger.info("setup complete")
+        self._flush( link )
+
+    def _reply(self, link, msg):
+        link.outbuf += link.sl.pack( msg )
+        self._flush( link )
+
+    def _flush(self, link):
+        if link.closed:
+            return
+        if link.outbuf:
+            try:
+                n = link.conn.send( link.outbuf )
+            except socket.error:
+                self._close( link )
+                return
+            link.outbuf = link.outbuf[n:]
+        self.poller.modify( link.conn.fileno(), len(link.outbuf) > 0 )
+
+    def _read(self, link):
+        try:
+            n = link.reader.fill( link.conn )
+        except socket.error:
+            n = 0
+        if n == 0:
+            self._close( link )
+            return
+
+        try:
+            while not link.closed:
+                (complete, obj) = link.sl.decode( link.reader )
+                if not complete:
+                    break
+                if link.steps:
+                    self._advance( link, obj )
+                else:
+                    link.dispatcher.dispatch( obj )
+        except:
+            Logger.error( traceback.format_exc() )
+            self._close( link )
+
+    def _close(self, link):
+        if link.closed:
+            return
+        link.closed = True
+        fd = link.conn.fileno()
+        del self.links[fd]
+        self.poller.unregister( fd )
+        try:
+            link.conn.close()
+        except socket.error:
+            pass
+
+
 class Peer:
 
     def __init__(self, api):
-        self.agentCtrl = agentController.AgentController( api )
+        if config.ControllerShards > 1:
+            self.agentCtrl = shardedController.ShardedController( api,
+                config.ControllerShards )
+        else:
+            self.agentCtrl = agentController.AgentController( api )
         self.api = api
+        self.exporter = None
 
     def start(self):
+        # controller shards are forked, start them before any other thread
+        self.agentCtrl.start()
+
         # start connection pool  
         Api.ConnectionPool.start() 
 
         ThreadedTCPRequestHandler.api = self.api
         ThreadedTCPRequestHandler.agentCtrl = self.agentCtrl
 
-        self.agentCtrl.start()
         addr = (config.BindHost, config.BindPort)  
 
-        ThreadedTCPServer.allow_reuse_address = True
+        if config.PeerServerMode == "eventloop":
+            server = EventLoopServer(addr, self.api, self.agentCtrl)
+        else:
+            ThreadedTCPServer.allow_reuse_address = True
+            ThreadedTCPServer.request_queue_size = config.PeerRequestQueueSize
 
-        server = ThreadedTCPServer(addr, ThreadedTCPRequestHandler)
-        server.request_queue_size = config.PeerRequestQueueSize
+            server = ThreadedTCPServer(addr, ThreadedTCPRequestHandler)
 
         #ip, port = server.server_address
 
@@ -111,7 +370,25 @@ class Peer:
         self.server = server
         self.server_thread = server_thread
 
+        if config.MetricsFile or config.MetricsAddr:
+            self.exporter = metrics.Exporter()
+            self.exporter.start()
+
+    def metrics(self):
+        "name -> {label items: value} of the runtime metrics, see metrics"
+        return metrics.Registry.snapshot()
+
+    def metricsText(self):
+        "the runtime metrics in Prometheus text format"
+        return metrics.Registry.prometheus()
+
+    def dumpMetrics(self, path):
+        "write the runtime metrics in Prometheus text format to path"
+        metrics.Registry.dump( path )
+
     def stop(self):
+        if self.exporter:
+            self.exporter.shutdown()
         self.server.shutdown()
         self.server.server_close()
         self.agentCtrl.shutdown()
@@ -137,6 +414,20 @@ def unittest( peer ):
 
     testApi = TestApi()
 
+    assert peer.agentCtrl is not None, "the controller exists from __init__"
+
+    # code that is never sent is fetched again and then given up on
+    sent = []
+    d = LinkDispatcher( testApi, peer.agentCtrl, sent.append )
+    missing = codeStore.digest( "never sent" )
+    d.hostAgentRef( missing, {'a': 1} )
+    d.hostAgentRef( missing, {'a': 2} )
+    now = time.time()
+    for i in range(1, Api.CODE_FETCH_TRIES + 1):
+        d.expire( now + i * Api.CODE_FETCH_TIMEOUT + 0.1 )
+    assert sent == [(Api.CODE_FETCH, missing)] * Api.CODE_FETCH_TRIES, str(sent)
+    assert not d.pending and not d.fetches, "expired fetches are forgotten"
+
     code = \
 """
 running = True
@@ -0,0 +1,240 @@
+"""
+Resource limits of sandbox processes. Every sandbox gets rlimits on its
+address space, open files and core dumps, a raised nice value and, with
+config.AgentQuotaPolicy "kill", an rlimit on its cpu time. The controller
+passes them on the sandbox's command line (see limits) and the sandbox
+applies them to itself before it runs agent code (see apply), a preexec_fn
+could deadlock the child of the multithreaded controller.
+
+When config.AgentCgroupRoot names a cgroup v2 directory with the cpu and
+memory controllers enabled for its children, each sandbox also gets a
+cgroup of its own that it joins the same way. cpu.weight shares the cpu
+fairly among agents, cpu.max caps an agent at config.AgentCpuMax of a cpu
+and memory.max/memory.high bound its memory.
+
+Usage is read from the cgroup or, without one, from /proc. An agent that
+goes over its cpu time (or, with the "kill" policy, memory) quota is killed
+or, with the "throttle" policy, has its cpu capped to
+config.AgentThrottleCpu (reniced to the lowest priority without a cgroup).
+"""
+
+import config
+import os
+import errno
+import logging
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+Logger = logging.getLogger("malib")
+
+# cgroup v2 cpu.max period in microseconds
+CPU_PERIOD = 100000
+# memory.high is set to this fraction of memory.max so an agent is slowed
+# by reclaim before it is oom killed
+MEMORY_HIGH = 0.9
+# lowest scheduling priority
+NICE_MAX = 19
+
+
+class Cgroup:
+    "cgroup v2 directory of one sandbox"
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, name, value):
+        f = open( os.path.join(self.path, name), "w" )
+        try:
+            f.write( str(value) )
+        finally:
+            f.close()
+
+    def read(self, name):
+        f = open( os.path.join(self.path, name) )
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def join(self):
+        "move the calling process into the cgroup"
+        self.write( "cgroup.procs", os.getpid() )
+
+    def usage(self):
+        stat = dict( line.split() for line in self.read("cpu.stat").splitlines() )
+        return {
+            'cpu_seconds': int(stat.get('usage_usec', 0)) / 1e6,
+            'memory': int( self.read("memory.current") ),
+            'throttled': int(stat.get('nr_throttled', 0))
+        }
+
+    def capCpu(self, fraction):
+        "limit the cgroup to fraction of one cpu, None lifts the cap"
+        if fraction is None:
+            self.write( "cpu.max", "max %d" % CPU_PERIOD )
+        else:
+            self.write( "cpu.max", "%d %d" % (max(1000, fraction * CPU_PERIOD), CPU_PERIOD) )
+
+    def remove(self):
+        "returns False while the cgroup still has processes"
+        try:
+            os.rmdir( self.path )
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return True
+            return False
+        return True
+
+
+_cgroups_checked = False
+_cgroups_ok = False
+
+def cgroupsAvailable():
+    "config.AgentCgroupRoot is usable, checked once"
+    global _cgroups_checked, _cgroups_ok
+
+    if not _cgroups_checked:
+        _cgroups_checked = True
+        root = config.AgentCgroupRoot
+        try:
+            if root:
+                if not os.path.isdir( root ):
+                    os.mkdir( root )
+                enabled = open( os.path.join(root, "cgroup.subtree_control") ).read().split()
+                if "cpu" not in enabled or "memory" not in enabled:
+                    open( os.path.join(root, "cgroup.subtree_control"), "w" ).write( "+cpu +memory" )
+                _cgroups_ok = True
+        except (IOError, OSError), e:
+            Logger.warning("cgroups unavailable under %s: %s" % (root, str(e)))
+    return _cgroups_ok
+
+def createCgroup( name ):
+    "a configured cgroup for a new sandbox, None without cgroup support"
+    if not cgroupsAvailable():
+        return None
+    cg = Cgroup( os.path.join(config.AgentCgroupRoot, name) )
+    try:
+        os.mkdir( cg.path )
+        cg.write( "cpu.weight", config.AgentCpuWeight )
+        if config.AgentCpuMax is not None:
+            cg.capCpu( config.AgentCpuMax )
+        if config.AgentMemoryBytes is not None:
+            cg.write( "memory.max", config.AgentMemoryBytes )
+            cg.write( "memory.high", int(config.AgentMemoryBytes * MEMORY_HIGH) )
+    except (IOError, OSError), e:
+        Logger.warning("could not set up cgroup %s: %s" % (cg.path, str(e)))
+        cg.remove()
+        return None
+    return cg
+
+def limits( cgroup=None ):
+    """ the limits of a new sandbox as a dict of plain values, to hand to
+        the sandbox process which applies them with apply() """
+    cpu = None
+    if config.AgentQuotaPolicy == "kill":
+        cpu = config.AgentCpuSeconds
+    path = None
+    if cgroup:
+        path = cgroup.path
+    return {
+        'cgroup': path,
+        'nice': config.AgentNice,
+        'files': config.AgentMaxFiles,
+        'memory': config.AgentMemoryBytes,
+        'cpu': cpu
+    }
+
+def apply( limits ):
+    "called by a sandbox on itself before it runs any agent code"
+    if limits['cgroup']:
+        Cgroup( limits['cgroup'] ).join()
+    if limits['nice'] and hasattr(os, 'nice'):
+        os.nice( limits['nice'] )
+    if resource is None:
+        return
+    resource.setrlimit( resource.RLIMIT_CORE, (0, 0) )
+    if limits['files'] is not None:
+        resource.setrlimit( resource.RLIMIT_NOFILE, (limits['files'], limits['files']) )
+    if limits['memory'] is not None:
+        resource.setrlimit( resource.RLIMIT_AS, (limits['memory'], limits['memory']) )
+    if limits['cpu'] is not None:
+        # the kernel enforces it even if the controller is busy
+        resource.setrlimit( resource.RLIMIT_CPU, (limits['cpu'], limits['cpu'] + 1) )
+
+def procUsage( pid ):
+    "usage of a process without a cgroup, from /proc (linux only)"
+    try:
+        stat = open( "/proc/%d/stat" % pid ).read()
+        # the command may hold spaces, fields start after its ')'
+        fields = stat[stat.rindex(')')+2:].split()
+        ticks = float( os.sysconf('SC_CLK_TCK') )
+        rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        return {
+            'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,
+            'memory': rss,
+            'throttled': 0
+        }
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def renice( pid, value ):
+    "set the nice value of another process"
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL( ctypes.util.find_library("c"), use_errno=True )
+    PRIO_PROCESS = 0
+    if libc.setpriority( PRIO_PROCESS, pid, value ) != 0:
+        Logger.warning("renice of %d failed, errno %d" % (pid, ctypes.get_errno()))
+
+def overQuota( usage ):
+    """ name of the quota usage exceeds, None if within quota. Memory only
+        counts with the "kill" policy, otherwise memory.max and RLIMIT_AS
+        leave the agent to the kernel """
+    if config.AgentCpuSeconds is not None and usage['cpu_seconds'] > config.AgentCpuSeconds:
+        return "cpu"
+    if config.AgentQuotaPolicy != "kill":
+        return None
+    if config.AgentMemoryBytes is not None and usage['memory'] > config.AgentMemoryBytes:
+        return "memory"
+    return None
+
+
+def unittest():
+    saved = (config.AgentQuotaPolicy, config.AgentCpuSeconds, config.AgentMemoryBytes)
+    try:
+        config.AgentQuotaPolicy = "throttle"
+        config.AgentCpuSeconds = 5
+        config.AgentMemoryBytes = 1 << 30
+        l = limits()
+        assert l['cpu'] is None, "only the kill policy has the kernel kill"
+        assert overQuota( {'cpu_seconds': 6, 'memory': 0} ) == "cpu"
+        assert overQuota( {'cpu_seconds': 1, 'memory': 2 << 30} ) is None
+        config.AgentQuotaPolicy = "kill"
+        assert limits()['cpu'] == 5
+        assert overQuota( {'cpu_seconds': 1, 'memory': 2 << 30} ) == "memory"
+    finally:
+        (config.AgentQuotaPolicy, config.AgentCpuSeconds, config.AgentMemoryBytes) = saved
+
+    if resource is not None and hasattr(os, 'fork'):
+        # applied by the sandbox to itself, here a child stands in for it
+        l = {'cgroup': None, 'nice': 5, 'files': 32, 'memory': 1 << 30, 'cpu': 100}
+        pid = os.fork()
+        if pid == 0:
+            nice = os.nice( 0 )
+            apply( l )
+            ok = os.nice( 0 ) == min(NICE_MAX, nice + 5) and \
+                resource.getrlimit( resource.RLIMIT_NOFILE ) == (32, 32) and \
+                resource.getrlimit( resource.RLIMIT_AS ) == (1 << 30, 1 << 30) and \
+                resource.getrlimit( resource.RLIMIT_CPU ) == (100, 101) and \
+                resource.getrlimit( resource.RLIMIT_CORE ) == (0, 0)
+            os._exit( 0 if ok else 1 )
+        (_pid, status) = os.waitpid( pid, 0 )
+        assert status == 0, "limits applied in the sandbox"
+    print "quota unittest passed"
+
+if __name__ == '__main__':
+    unittest()
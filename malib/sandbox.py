@@ -1,55 +1,318 @@
 #!/usr/bin/env python
 
-import marshal
 import socket
 import struct
 import traceback
 import select
+import marshal
+import mmap
+import os
+import sys
+import time
+import errno
+import signal
+import framing
+import wireCodec
 
 HDR_FORMAT=">I"
 
+# descriptors a sandbox spawned in unix ipc mode inherits
+RPC_FD = 3
+EVT_FD = 4
+SHM_FD = 5
+
 class Disconnect( RuntimeError ):
     pass
 
+class RingCorrupt( ValueError ):
+    "the sandbox wrote a read counter the ring can't have"
+    pass
+
+# rpc methods handled by the agent controller itself rather than the api
+SUBSCRIBE   = "__subscribe__"
+UNSUBSCRIBE = "__unsubscribe__"
+# event whose args locate the real, encoded, event in the ShmRing
+SHM_EVENT   = "__shm__"
+# event asking an idle agent to hand over its Briefcase and exit, the agent
+# answers with a rpc call of the same name (see AgentController hibernation)
+HIBERNATE   = "__hibernate__"
+# event turning the profiler on (args (interval,)) or off (args (None,)),
+# on posix the controller sends PROFILE_ON/PROFILE_OFF instead so a busy
+# agent that does not listen is profiled too. The sandbox ships its
+# profile in rpc calls of the same name (see Profiler)
+PROFILE     = "__profile__"
+PROFILE_ON  = getattr( signal, 'SIGUSR1', None )
+PROFILE_OFF = getattr( signal, 'SIGUSR2', None )
+# seconds between profile reports unless the init message says otherwise
+PROFILE_INTERVAL = 5.0
+
+def frameParts( parts ):
+    "one string framing the parts of an encoded message"
+    return wireCodec.join( [struct.pack(HDR_FORMAT,wireCodec.size(parts))] + parts )
+
+def packMessage( obj ):
+    return frameParts( wireCodec.dumps(obj) )
+
 def sendMessage( s, obj ):
-    payload = marshal.dumps(obj)
-    packet = struct.pack(HDR_FORMAT,len(payload)) + payload
-    s.sendall( packet )
+    parts = wireCodec.dumps(obj)
+    framing.send_parts( s, [struct.pack(HDR_FORMAT,wireCodec.size(parts))] + parts )
 
 def recvMessage( s ):
-    def _getChunk(n):
-        buf = ""
-        while len(buf) < n:
-            x = s.recv(n - len(buf))
-            if x == "":                
-                s.shutdown( socket.SHUT_RDWR ) 
-                raise Disconnect, "Disconnected"     
-            buf += x
-        return buf
-    hdr = _getChunk(struct.calcsize(HDR_FORMAT))        
-    size = struct.unpack(HDR_FORMAT,hdr)[0]
-    data = _getChunk( size )
-    return marshal.loads( data )
+    try:
+        (_hdr, data) = framing.recv_frame( s, HDR_FORMAT )
+    except framing.Closed:
+        s.shutdown( socket.SHUT_RDWR ) 
+        raise Disconnect, "Disconnected"     
+    # agent code is handed strings, as before large ones went out of band
+    return wireCodec.loads( data, copy=True )
+
+
+class ShmRing:
+    """ Single producer, single consumer ring buffer in a shared mapping
+        that carries large events from the agent controller to a sandbox
+        without pushing them through the socket. The mapping starts with
+        the write and read counters, both only ever grow and a position
+        in the data area is a counter modulo the size. put() returns None
+        when the data does not fit, the caller then uses the socket.
+        The sandbox can write the whole mapping, so the writer keeps its
+        own write counter and only trusts a read counter in range.
+    """
+    COUNTERS = '>QQ'
+
+    def __init__(self, fileno, size):
+        self.size = size
+        self.base = struct.calcsize(self.COUNTERS)
+        self.mm = mmap.mmap( fileno, self.base + size )
+        self.wr = 0
+
+    def put(self, parts):
+        "store the parts of an encoded message as one entry"
+        n = wireCodec.size( parts )
+        wr = self.wr
+        (rd,) = struct.unpack_from( '>Q', self.mm, 8 )
+        if rd > wr or rd < wr - self.size:
+            raise RingCorrupt, "read counter %d, write counter %d" % (rd, wr)
+        offset = wr % self.size
+        if offset + n > self.size:
+            # doesn't fit before the end of the area, wrap around
+            wr += self.size - offset
+            offset = 0
+        if wr + n - rd > self.size:
+            return None
+        self.mm.seek( self.base + offset )
+        for data in parts:
+            self.mm.write( data )
+        self.wr = wr + n
+        struct.pack_into( '>Q', self.mm, 0, self.wr )
+        return (wr, n)
+
+    def get(self, pos, n):
+        start = self.base + pos % self.size
+        data = self.mm[start:start+n]
+        struct.pack_into( '>Q', self.mm, 8, pos + n )
+        return data
+
+
+class Future:
+    "result of an api call made through a Batch" 
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.reqid = None
+
+    def result(self):
+        "wait for the result, sends the batch if it is still pending" 
+        if self.reqid is None:
+            self.batch.send()
+        return self.batch.api._wait( self.reqid )
+
+
+class Profiler:
+    """ sys.setprofile hook timing every function the agent calls, python
+        and builtin. Per function it keeps the number of calls, the time
+        including callees and the time spent in the function itself,
+        keyed "file:line(name)" (builtins "<module or type>.name"), agent
+        code is "<string>" with the line numbers of its source. Time the agent
+        spends blocked on rpc replies and waiting in listen is counted
+        apart. The totals since profiling started are sent to the
+        controller every interval seconds, but only while the ApiIface is
+        not in the middle of its own socket io.
+    """
+    def __init__(self, api, interval):
+        self.api = api
+        self.interval = interval
+        self.started = time.time()
+        self.next_report = self.started + interval
+        # key -> [calls, total, own]
+        self.functions = {}
+        # [key, start, time spent in callees] of the active calls
+        self.stack = []
+        # key -> activations on the stack, a recursive function's total
+        # only counts its outermost call
+        self.active = {}
+        self.rpc_wait = 0.0
+        self.rpc_calls = 0
+        self.listen_wait = 0.0
+
+    def hook(self, frame, event, arg):
+        now = time.time()
+        if event == 'call':
+            code = frame.f_code
+            line = code.co_firstlineno
+            if code.co_filename == "<string>":
+                line -= AGENT_LINE_OFFSET
+            key = "%s:%d(%s)" % (code.co_filename, line, code.co_name)
+            self.stack.append( [key, now, 0.0] )
+            self.active[key] = self.active.get( key, 0 ) + 1
+        elif event == 'c_call':
+            owner = getattr( arg, '__module__', None )
+            if owner is None:
+                # a method of a builtin type
+                owner = type( getattr(arg, '__self__', None) ).__name__
+            key = "<%s>.%s" % (owner, arg.__name__)
+            self.stack.append( [key, now, 0.0] )
+            self.active[key] = self.active.get( key, 0 ) + 1
+        elif self.stack:
+            # returns of calls made before profiling started find it empty
+            (key, start, callees) = self.stack.pop()
+            elapsed = now - start
+            entry = self.functions.get( key )
+            if entry is None:
+                entry = self.functions[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            self.active[key] -= 1
+            if not self.active[key]:
+                entry[1] += elapsed
+            entry[2] += elapsed - callees
+            if self.stack:
+                self.stack[-1][2] += elapsed
+        if now >= self.next_report and not self.api.busy:
+            self.report()
+
+    def report(self):
+        "send the profile, called with the hook inactive"
+        self.next_report = time.time() + self.interval
+        # the report's own rpc is not the agent's
+        (wait, calls) = (self.rpc_wait, self.rpc_calls)
+        self.api._ApiIface__transaction( PROFILE, {
+            'elapsed': time.time() - self.started,
+            'functions': self.functions,
+            'rpc_wait': wait,
+            'rpc_calls': calls,
+            'listen_wait': self.listen_wait
+        } )
+        (self.rpc_wait, self.rpc_calls) = (wait, calls)
+
+
+class Batch:
+    """ Collects api calls and sends them to the controller in one frame,
+        the controller answers all of them in one frame too. Every call
+        returns a Future. Batches may be sent back to back before any of
+        their results are read, which pipelines them.
+
+            with Api.batch() as b:
+                a = b.getA()
+                c = b.getC(1)
+            print a.result(), c.result()
+    """
+    def __init__(self, api):
+        self.api = api
+        self.calls = []
+        self.futures = []
 
+    def __getattr__(self, name):
+        def call(*args):
+            f = Future( self )
+            self.calls.append( (name,args) )
+            self.futures.append( f )
+            return f
+        return call
 
-class ApiIface:
-    def __transaction(self, func, *args):
-        sendMessage( self.s, (func,args) )
-        return recvMessage( self.s )
+    def send(self):
+        if self.calls:
+            for (f, reqid) in zip(self.futures, self.api._submit(self.calls)):
+                f.reqid = reqid
+        self.calls = []
+        self.futures = []
 
-    def __init__(self, rpcPort, eventPort ):
-        # sequence matters here with the event port being connected
-        # after the rpcPort, see peer._service_msg
-        self.s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-        self.s.connect( ('127.0.0.1',rpcPort) )
+    def __enter__(self):
+        return self
 
-        self.e = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
-        self.e.connect( ('127.0.0.1',eventPort) )
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+
+
+class ApiIface:
+    """ The Api object agent code sees. Calls on unknown attributes are
+        forwarded to the host api over the rpc connection. Every request
+        frame is a list of (request id, method, args) and is answered with
+        a list of (request id, result).
+    """
+    def __transaction(self, func, *args):
+        (reqid,) = self._submit( [(func,args)] )
+        return self._wait( reqid )
+
+    def _submit(self, calls):
+        "send [(method, args), ...] in one frame, returns the request ids"
+        frame = []
+        for (func, args) in calls:
+            self.next_reqid += 1
+            frame.append( (self.next_reqid, func, args) )
+        self.busy = True
+        try:
+            sendMessage( self.s, frame )
+        finally:
+            self._idle()
+        if self.profiler:
+            self.profiler.rpc_calls += len(frame)
+        return [reqid for (reqid, _func, _args) in frame]
+
+    def _wait(self, reqid):
+        started = time.time()
+        self.busy = True
+        try:
+            # answers to other outstanding requests are parked in results
+            while reqid not in self.results:
+                for (rid, result) in recvMessage( self.s ):
+                    self.results[rid] = result
+        finally:
+            if self.profiler:
+                self.profiler.rpc_wait += time.time() - started
+            self._idle()
+        return self.results.pop( reqid )
+
+    def _idle(self):
+        "the socket io is done, send what the profiler held back meanwhile"
+        self.busy = False
+        if self.profile_pending:
+            self.profile_pending = False
+            self._profile( self.profile_pending_interval )
+
+    def batch(self):
+        return Batch( self )
+
+    def __init__(self, s, e, ring=None ):
+        self.s = s
+        self.e = e
+        self.ring = ring
 
         self.dispatch = {} 
+        self.next_reqid = 0
+        self.results = {}
+        # globals of the agent code, see execute_agent_code
+        self.namespace = {}
+        # Profiler while profiling. busy is set during socket io, a
+        # profiler switch requested meanwhile waits in profile_pending
+        self.profiler = None
+        self.busy = False
+        self.profile_pending = False
+        self.profile_pending_interval = None
  
     def register(self, event, cb, pri=0):
         if event not in self.dispatch:
+            # the controller only sends events someone subscribed to
+            self.__transaction( SUBSCRIBE, event )
             self.dispatch[event] = []
         self.dispatch[event].append( (cb,pri) )
         def sfunc( x, y ):  
@@ -63,15 +326,65 @@ class ApiIface:
                     return 0
                 return 1
             self.dispatch[event] = filter( ff, self.dispatch[event] )
+            if not self.dispatch[event]:
+                del self.dispatch[event]
+                self.__transaction( UNSUBSCRIBE, event )
       
     def listen(self, timeout=-1):
-        r = select.select([self.e],[],[],timeout)
+        started = time.time()
+        self.busy = True
+        try:
+            while True:
+                try:
+                    r = select.select([self.e],[],[],timeout)
+                    break
+                except select.error, e:
+                    # a profiler signal arrived
+                    if e.args[0] != errno.EINTR:
+                        raise
+            if len(r) > 0:
+                (event,args) = recvMessage( self.e )
+                if event == SHM_EVENT:
+                    (event,args) = wireCodec.loads( self.ring.get( *args ), copy=True )
+        finally:
+            if self.profiler:
+                self.profiler.listen_wait += time.time() - started
+            self._idle()
         if len(r) > 0:
-            (event,args) = recvMessage( self.e )
+            if event == HIBERNATE:
+                self._hibernate()
+            if event == PROFILE:
+                self._profile( *args )
             if event in self.dispatch:
                 for (cb,pri) in self.dispatch[event]:
                     cb( *args )
+
+    def _profile(self, interval):
+        """ start profiling with reports every interval seconds, None
+            stops it and sends the final report """
+        if self.busy:
+            self.profile_pending = True
+            self.profile_pending_interval = interval
+            return
+        profiler = self.profiler
+        if profiler:
+            sys.setprofile( None )
+            self.profiler = None
+            profiler.report()
+        if interval:
+            self.profiler = Profiler( self, interval )
+            sys.setprofile( self.profiler.hook )
         
+    def _hibernate(self):
+        "hand the Briefcase to the controller and exit if it takes it"
+        try:
+            taken = self.__transaction( HIBERNATE, self.namespace.get('Briefcase') )
+        except ValueError:
+            # the briefcase holds something that can't be marshalled
+            taken = self.__transaction( HIBERNATE, None )
+        if taken:
+            os._exit(0)
+
     def __getattr__(self, name):
         class datalink:
             def __init__(self, func):
@@ -81,33 +394,90 @@ class ApiIface:
         return datalink( self.__transaction )
         
 
-def execute_agent_code( cobj, __api, __briefcase ):
-    exec cobj
+BOOTSTRAP = \
+"""
+Api = __api
+Briefcase = __briefcase
+"""
+# line numbers of compiled agent code are this far off the agent's source
+AGENT_LINE_OFFSET = BOOTSTRAP.count("\n")
+
+def compile_agent( code ):
+    "compile agent code together with the bootstrap that binds Api/Briefcase"
+    return compile(BOOTSTRAP + code,"<string>","exec") 
 
-def sandbox( rpcPort, eventPort ):
-    __api = ApiIface( rpcPort, eventPort )  
+def execute_agent_code( cobj, __api, __briefcase ):
+    # the agent's globals are its own dict so the functions it defines see
+    # Api and Briefcase, and the Briefcase can be found for hibernation
+    __api.namespace = {
+        '__api': __api,
+        '__briefcase': __briefcase,
+        '__builtins__': __builtins__
+    }
+    exec cobj in __api.namespace
+
+def connect_tcp( rpcPort, eventPort, token ):
+    # the token is presented on both connections so the agent
+    # controller can pair them, see AgentController._attach
+    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    s.connect( ('127.0.0.1',rpcPort) )
+    sendMessage( s, token )
+
+    e = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    e.connect( ('127.0.0.1',eventPort) )
+    sendMessage( e, token )
+    return ApiIface( s, e )
+
+def connect_inherited( shmSize ):
+    "use the descriptors handed down by create_agent_socketpair_subprocess"
+    conns = []
+    for fd in (RPC_FD, EVT_FD):
+        conns.append( socket.fromfd( fd, socket.AF_UNIX, socket.SOCK_STREAM ) )
+        os.close( fd )
+    ring = None
+    if shmSize > 0:
+        ring = ShmRing( SHM_FD, shmSize )
+        os.close( SHM_FD )
+    return ApiIface( conns[0], conns[1], ring )
+
+def sandbox( __api ):
 
     # reuse the api event service to trap the init message 
-    cfg = {'wait':True}
+    cfg = {'wait':True, 'profile':(False, PROFILE_INTERVAL)}
     def init( *args ):
-        cfg['code'], cfg['briefcase'] = args 
+        cfg['code'], cfg['briefcase'] = args[:2]
+        if len(args) > 2:
+            # (profile from the start, report interval)
+            cfg['profile'] = args[2]
         cfg['wait'] = False 
-    __api.register("init",init)
-    while cfg['wait']: 
-        __api.listen(60)
+    # init is sent to this sandbox directly, don't subscribe to it
+    __api.dispatch["init"] = [(init,0)]
+    if PROFILE_ON is not None:
+        signal.signal( PROFILE_ON, lambda *args: __api._profile( cfg['profile'][1] ) )
+        signal.signal( PROFILE_OFF, lambda *args: __api._profile( None ) )
+        # restart interrupted socket calls instead of failing them
+        signal.siginterrupt( PROFILE_ON, False )
+        signal.siginterrupt( PROFILE_OFF, False )
+    try:
+        while cfg['wait']: 
+            __api.listen(60)
+    except Disconnect:
+        # the controller let go of an unused warm sandbox
+        return
 
     code = cfg['code']
     __briefcase = cfg['briefcase']
 
-    bootstrap = \
-"""
-Api = __api
-Briefcase = __briefcase
-"""
-
-    # compile the agent code 
-    cobj = compile(bootstrap + code,"<string>","exec") 
+    # the controller normally sends the code already compiled
+    if hasattr(code, 'co_code'):
+        cobj = code
+    else:
+        cobj = compile_agent( code )
  
+    (profile, interval) = cfg['profile']
+    if profile:
+        __api._profile( interval )
+
     # prevent this process from performing any I/O outside
     # of using the api for communication.
     del socket.socket
@@ -117,6 +487,9 @@ Briefcase = __briefcase
 
     # execute the agent code
     execute_agent_code( cobj, __api, __briefcase )
+    if __api.profiler:
+        # the final profile
+        __api._profile( None )
 
     
 
@@ -153,14 +526,14 @@ api.log('info','test briefcase=%s' % str(briefcase))
             print r
             if r is rpc_s:
                 conn, addr = rpc_s.accept()
-                print "server accepting rpc connection "
+                print "server accepting rpc connection ", recvMessage( conn )
                 client['rpc'] = conn
                 connList.append( conn )
 
             elif r is evt_s:
                 conn, addr = evt_s.accept()
 
-                print "server accepting event connection "
+                print "server accepting event connection ", recvMessage( conn )
 
                 client['evt'] = conn
                 connList.append( conn )
@@ -171,17 +544,24 @@ api.log('info','test briefcase=%s' % str(briefcase))
 
             elif r is client.get('rpc',None):
                 try:
-                    meth,args = recvMessage( client['rpc'] )
+                    frame = recvMessage( client['rpc'] )
                 except Disconnect:
                     return
  
-                print meth, args
-                func = getattr(api,meth)
-                r = func( *args )
-                sendMessage( client['rpc'], r )
-
-def create_agent_subprocess( rpcPort, eventPort ):
-    """ Create a child process for executing the mobile
+                answer = []
+                for (reqid, meth, args) in frame:
+                    print meth, args
+                    func = getattr(api,meth)
+                    answer.append( (reqid, func( *args )) )
+                sendMessage( client['rpc'], answer )
+
+def encodeLimits( limits ):
+    "limits as a command line argument"
+    return marshal.dumps( limits ).encode('hex')
+
+def create_agent_subprocess( rpcPort, eventPort, token, limits=None ):
+    """ Create a child process for executing the mobile, limits are the
+        resource limits (see quota.limits) the child applies to itself
     """
     import subprocess     
     import inspect
@@ -189,7 +569,9 @@ def create_agent_subprocess( rpcPort, eventPort ):
     import logging
 
     filename = inspect.getfile(inspect.currentframe())
-    args = [sys.executable, filename, "agent", str(rpcPort), str(eventPort)]
+    args = [sys.executable, filename, "agent", str(rpcPort), str(eventPort), token]
+    if limits:
+        args.append( encodeLimits( limits ) )
 
     
     del sys
@@ -198,15 +580,107 @@ def create_agent_subprocess( rpcPort, eventPort ):
     logging.info("Executing '%s'" % ' '.join(args))
     return subprocess.Popen(args,close_fds=True,env={}) 
 
+def create_agent_socketpair_subprocess( shmSize=0, limits=None ):
+    """ Create a child process for executing the mobile agent that talks
+        to the controller over pre-connected unix socketpairs instead of
+        loopback tcp, optionally with a ShmRing of shmSize bytes. limits
+        are applied as in create_agent_subprocess.
+        Returns (proc, rpc socket, event socket, ring or None).
+    """
+    import subprocess     
+    import inspect
+    import sys
+    import logging
+    import tempfile
+    import fcntl
+
+    filename = inspect.getfile(inspect.currentframe())
+    args = [sys.executable, filename, "agent-unix", str(shmSize)]
+    if limits:
+        args.append( encodeLimits( limits ) )
+
+    rpc, child_rpc = socket.socketpair( socket.AF_UNIX, socket.SOCK_STREAM )
+    evt, child_evt = socket.socketpair( socket.AF_UNIX, socket.SOCK_STREAM )
+    inherit = [child_rpc.fileno(), child_evt.fileno()]
+    ring = None
+    if shmSize > 0:
+        shm = tempfile.TemporaryFile()
+        shm.truncate( struct.calcsize(ShmRing.COUNTERS) + shmSize )
+        ring = ShmRing( shm.fileno(), shmSize )
+        inherit.append( shm.fileno() )
+
+    def preexec():
+        # move the inherited descriptors to RPC_FD, EVT_FD, SHM_FD and
+        # close everything else, the same as close_fds would
+        high = [fcntl.fcntl(fd, fcntl.F_DUPFD, 64) for fd in inherit]
+        for (n, fd) in enumerate(high):
+            os.dup2( fd, RPC_FD + n )
+        os.closerange( RPC_FD + len(high), subprocess.MAXFD )
+
+    logging.info("Executing '%s'" % ' '.join(args))
+    try:
+        proc = subprocess.Popen(args,close_fds=False,env={},preexec_fn=preexec) 
+    finally:
+        child_rpc.close()
+        child_evt.close()
+        if ring:
+            shm.close()
+    return (proc, rpc, evt, ring)
+
+
+def unittest():
+    import tempfile
+
+    size = 4096
+    shm = tempfile.TemporaryFile()
+    shm.truncate( struct.calcsize(ShmRing.COUNTERS) + size )
+    writer = ShmRing( shm.fileno(), size )
+    reader = ShmRing( shm.fileno(), size )
+    for i in range(20):
+        data = chr(65 + i) * 1000
+        pos = writer.put( ["head", data] )
+        assert pos is not None, "entry %d fits once the last was read" % i
+        assert reader.get( *pos ) == "head" + data
+    pos = writer.put( ["x" * 3000] )
+    assert writer.put( ["y" * 3000] ) is None, "no room until the reader catches up"
+    reader.get( *pos )
+
+    # the sandbox can write the counters, the writer keeps its own
+    struct.pack_into( '>Q', reader.mm, 0, 0 )
+    assert writer.put( ["z" * 10] ) is not None
+    for rd in (writer.wr + 1, writer.wr - size - 1, 2 ** 64 - 1):
+        struct.pack_into( '>Q', reader.mm, 8, max(0, rd) )
+        try:
+            writer.put( ["z" * 10] )
+            assert False, "read counter %d accepted" % rd
+        except RingCorrupt:
+            pass
+    shm.close()
+    print "sandbox unittest passed"
+
     
 if __name__ == '__main__':
     import sys
 
+    if PROFILE_ON is not None:
+        # a profiler signal must not kill a sandbox that is still starting
+        signal.signal( PROFILE_ON, signal.SIG_IGN )
+        signal.signal( PROFILE_OFF, signal.SIG_IGN )
+
     mode = sys.argv[1]
+    # the resource limits come last, applied before anything else happens
+    nargs = {"agent": 5, "agent-unix": 3}.get( mode )
+    if nargs and len(sys.argv) > nargs:
+        import quota
+        quota.apply( marshal.loads( sys.argv[nargs].decode('hex') ) )
     if mode == "agent":
         rpcPort, eventPort = int(sys.argv[2]), int(sys.argv[3])
-        sandbox( rpcPort, eventPort )
+        sandbox( connect_tcp( rpcPort, eventPort, sys.argv[4] ) )
+    elif mode == "agent-unix":
+        sandbox( connect_inherited( int(sys.argv[2]) ) )
     elif mode == "test":
         test_server()
+    elif mode == "unittest":
+        unittest()
      
       
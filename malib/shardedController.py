@@ -0,0 +1,202 @@
+import agentController
+import wireCodec
+import Api
+import config
+import multiprocessing
+import Queue
+import threading
+import hashlib
+import time
+import uuid
+import logging
+import traceback
+
+Logger = logging.getLogger("malib")
+
+# seconds between load reports from a shard
+LOAD_REPORT_INTERVAL = 1
+# seconds to wait for a shard to answer a statistics query
+QUERY_TIMEOUT = 5
+# command asking a shard for the result of an AgentController method
+QUERY = "__query__"
+
+
+class ControllerShard( multiprocessing.Process ):
+    """ Child process running its own AgentController. Commands from the
+        parent arrive on cmdq as (method name, args), the answers to QUERY
+        commands go back on replyq and the number of agents the shard hosts
+        is published in load every LOAD_REPORT_INTERVAL seconds.
+    """
+    def __init__(self, index, agentApi):
+        multiprocessing.Process.__init__(self, name="malib-shard-%d" % index)
+        self.daemon = True
+        self.agentApi = agentApi
+        self.cmdq = multiprocessing.Queue()
+        self.replyq = multiprocessing.Queue()
+        self.load = multiprocessing.Value('i', 0)
+
+    def run(self):
+        # threads do not survive the fork, the shard needs its own
+        # connection pool for agents that call sendAgent/multicast
+        Api.ConnectionPool = Api._ConnectionPool()
+        Api.ConnectionPool.start()
+
+        ctrl = agentController.AgentController( self.agentApi )
+        ctrl.start()
+        Logger.info("%s started" % self.name)
+        next_report = 0
+        try:
+            while True:
+                # on time whatever the command traffic
+                now = time.time()
+                if now >= next_report:
+                    self.load.value = ctrl.load()
+                    next_report = now + LOAD_REPORT_INTERVAL
+                try:
+                    (meth, args) = self.cmdq.get( timeout=next_report - now )
+                except Queue.Empty:
+                    continue
+                if meth is None:
+                    break
+                if meth == QUERY:
+                    (seq, name, qargs) = args
+                    self.replyq.put( (seq, getattr(ctrl, name)( *qargs )) )
+                    continue
+                getattr(ctrl, meth)( *args )
+        except:
+            Logger.error( traceback.format_exc() )
+
+        ctrl.shutdown()
+        Api.ConnectionPool.shutdown()
+        ctrl.join()
+        Api.ConnectionPool.join()
+        Logger.info("%s exiting" % self.name)
+
+
+class ShardedController:
+    """ Drop in replacement for AgentController that spreads the hosted
+        agents over config.ControllerShards processes so rpc handling and
+        event fan out are not bound to one core.
+
+        Agents are assigned to a shard by config.ShardAssignment, "hash"
+        sends the same agent code to the same shard while "leastload" picks
+        the shard hosting the fewest agents. Events are multicast to every
+        shard.
+
+        The statistics are collected from every shard and merged, a shard
+        that does not answer within QUERY_TIMEOUT is left out.
+    """
+    def __init__(self, agentApi, shards):
+        self.shards = [ControllerShard(i, agentApi) for i in range(shards)]
+        # one query at a time, replies are matched by sequence number
+        self.query_lock = threading.Lock()
+        self.query_seq = 0
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def shutdown(self):
+        for shard in self.shards:
+            shard.cmdq.put( (None, None) )
+
+    def join(self):
+        for shard in self.shards:
+            shard.join()
+
+    def shardLoads(self):
+        return [shard.load.value for shard in self.shards]
+
+    def hostTheAgent(self, code, briefcase):
+        agentId = uuid.uuid4().hex
+        shard = self._pick( code )
+        # count the agent right away, the shard corrects it on its next report
+        with shard.load.get_lock():
+            shard.load.value += 1
+        # memoryviews of out of band data don't pickle
+        briefcase = wireCodec.detach( briefcase )
+        shard.cmdq.put( ('hostTheAgent', (code, briefcase, agentId)) )
+        return agentId
+
+    def multicastEvent(self, eventId, *args):
+        args = wireCodec.detach( args )
+        for shard in self.shards:
+            shard.cmdq.put( ('multicastEvent', (eventId,) + args) )
+
+    def _pick(self, code):
+        if config.ShardAssignment == "hash":
+            digest = hashlib.md5( code ).hexdigest()
+            return self.shards[ int(digest, 16) % len(self.shards) ]
+        return min( self.shards, key=lambda shard: shard.load.value )
+
+    def load(self):
+        return sum( self.shardLoads() )
+
+    def profileAgent(self, agentId, on=True):
+        for shard in self.shards:
+            shard.cmdq.put( ('profileAgent', (agentId, on)) )
+
+    def invalidateCache(self, meth=None, *args):
+        args = wireCodec.detach( args )
+        for shard in self.shards:
+            shard.cmdq.put( ('invalidateCache', (meth,) + args) )
+
+    def agentStats(self, agentId):
+        for stats in self._query( 'agentStats', agentId ):
+            if stats is not None:
+                return stats
+
+    def agentProfile(self, agentId):
+        for profile in self._query( 'agentProfile', agentId ):
+            if profile is not None:
+                return profile
+
+    def usageStats(self):
+        usage = {}
+        for stats in self._query( 'usageStats' ):
+            usage.update( stats )
+        return usage
+
+    def poolStats(self):
+        return self._sum( self._query( 'poolStats' ),
+            ('size', 'refill_rate', 'idle', 'hits', 'misses') )
+
+    def cacheStats(self):
+        stats = self._sum( self._query( 'cacheStats' ),
+            ('size', 'hits', 'misses', 'expired', 'evictions') )
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+    def hibernationStats(self):
+        answers = self._query( 'hibernationStats' )
+        stats = self._sum( answers, ('resident', 'hibernated', 'hibernations', 'wakes') )
+        latency = sum( s['wake_latency_avg'] * s['wakes'] for s in answers )
+        stats['wake_latency_avg'] = latency / stats['wakes'] if stats['wakes'] else 0.0
+        stats['wake_latency_max'] = max( [0.0] + [s['wake_latency_max'] for s in answers] )
+        return stats
+
+    def _sum(self, answers, keys):
+        return dict( (key, sum( s[key] for s in answers )) for key in keys )
+
+    def _query(self, meth, *args):
+        "the results of meth(*args) of the AgentController of every shard"
+        results = []
+        with self.query_lock:
+            self.query_seq += 1
+            for shard in self.shards:
+                shard.cmdq.put( (QUERY, (self.query_seq, meth, args)) )
+            deadline = time.time() + QUERY_TIMEOUT
+            for shard in self.shards:
+                while True:
+                    try:
+                        (seq, result) = shard.replyq.get(
+                            timeout=max(0, deadline - time.time()) )
+                    except Queue.Empty:
+                        Logger.warning("%s did not answer %s" % (shard.name, meth))
+                        break
+                    # late answers to queries that timed out are dropped
+                    if seq == self.query_seq:
+                        results.append( result )
+                        break
+        return results
@@ -0,0 +1,141 @@
+"""
+Message codec used by the peer protocol (p2pp) and the sandbox IPC. A
+message is marshalled as before unless it holds large binary data, strings
+of config.OutOfBandMin bytes or more and any bytearray or buffer at any
+depth of its tuples, lists and dicts. Those are taken out of the object and
+travel out of band as segments after the marshalled head:
+
+    marshal( (Ellipsis, [segment sizes], obj with (Ellipsis, index) refs) )
+    segment 0
+    segment 1 ...
+
+dumps() returns the head and the segments as separate parts that are sent
+(or encrypted) one after the other and never copied into the marshalled
+head. marshal.loads ignores the segments trailing the head, loads() then
+hands the receiver each segment as a memoryview into the receive buffer.
+Sandboxes decode with copy, agent code is handed strings as it always was.
+Messages without large data are plain marshal data, exactly as before.
+"""
+
+import config
+import marshal
+
+OOB = Ellipsis
+
+
+def _segment( obj, segments ):
+    "take obj out of band, returns the ref left in its place"
+    if type(obj) is bytearray:
+        obj = buffer( obj )
+    elif type(obj) is memoryview:
+        # python 2 memoryviews don't export the old buffer interface
+        obj = obj.tobytes()
+    segments.append( obj )
+    return (OOB, len(segments) - 1)
+
+def _out( obj, segments ):
+    t = type(obj)
+    if t is str:
+        if len(obj) >= config.OutOfBandMin:
+            return _segment( obj, segments )
+        return obj
+    if t is bytearray or t is buffer or t is memoryview:
+        return _segment( obj, segments )
+    n = len(segments)
+    if t is tuple or t is list:
+        items = [_out( x, segments ) for x in obj]
+        if len(segments) == n:
+            return obj
+        return t( items )
+    if t is dict:
+        items = [(k, _out( v, segments )) for (k, v) in obj.iteritems()]
+        if len(segments) == n:
+            return obj
+        return dict( items )
+    return obj
+
+def _in( obj, segments ):
+    t = type(obj)
+    if t is tuple:
+        if len(obj) == 2 and obj[0] is OOB:
+            return segments[obj[1]]
+        return tuple( [_in( x, segments ) for x in obj] )
+    if t is list:
+        return [_in( x, segments ) for x in obj]
+    if t is dict:
+        return dict( (k, _in( v, segments )) for (k, v) in obj.iteritems() )
+    return obj
+
+
+def dumps( obj ):
+    "list of parts that make up the encoded obj"
+    segments = []
+    if config.OutOfBandMin > 0:
+        obj = _out( obj, segments )
+    if not segments:
+        return [marshal.dumps( obj )]
+    head = marshal.dumps( (OOB, [len(s) for s in segments], obj) )
+    return [head] + segments
+
+def loads( data, copy=False ):
+    """ decode data, a str or buffer. Segments are memoryviews into data,
+        with copy they are strings, for data whose memory is reused. """
+    obj = marshal.loads( data )
+    if type(obj) is not tuple or len(obj) != 3 or obj[0] is not OOB:
+        return obj
+    (_p1, sizes, obj) = obj
+    segments = []
+    view = memoryview( data )
+    pos = len(data) - sum( sizes )
+    for n in sizes:
+        if copy:
+            segments.append( view[pos:pos+n].tobytes() )
+        else:
+            segments.append( view[pos:pos+n] )
+        pos += n
+    return _in( obj, segments )
+
+def size( parts ):
+    return sum( len(p) for p in parts )
+
+def join( parts ):
+    "the encoded message in one string"
+    if len(parts) == 1:
+        return parts[0]
+    return "".join( [str(p) for p in parts] )
+
+def detach( obj ):
+    "obj with its memoryviews replaced by strings, to keep or pickle it"
+    t = type(obj)
+    if t is memoryview:
+        return obj.tobytes()
+    if t is tuple or t is list:
+        return t( [detach( x ) for x in obj] )
+    if t is dict:
+        return dict( (k, detach( v )) for (k, v) in obj.iteritems() )
+    return obj
+
+
+def unittest():
+    big = "x" * max(1, config.OutOfBandMin)
+    msg = ("evt", {'blob': big, 'n': 1}, [bytearray("ab"), "small"])
+    parts = dumps( msg )
+    assert len(parts) == 3, "large strings and bytearrays travel out of band"
+    assert size( parts ) < 2 * len(big), "segments are not copied into the head"
+
+    obj = loads( join(parts) )
+    assert type(obj[1]['blob']) is memoryview and obj[1]['blob'].tobytes() == big
+    assert obj[2][0].tobytes() == "ab" and obj[2][1] == "small" and obj[1]['n'] == 1
+    expected = ("evt", {'blob': big, 'n': 1}, ["ab", "small"])
+    assert detach( obj ) == expected, "detach gives back strings"
+    # copy is for data whose memory is reused, like a FrameReader's
+    obj = loads( buffer(bytearray(join(parts))), copy=True )
+    assert type(obj[1]['blob']) is str and obj == expected
+
+    # messages without large data are plain marshal data, as before
+    assert dumps( ("evt", (1, "a")) ) == [marshal.dumps( ("evt", (1, "a")) )]
+    assert loads( marshal.dumps( None ) ) is None
+    print "wireCodec unittest passed"
+
+if __name__ == '__main__':
+    unittest()